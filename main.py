@@ -8,7 +8,10 @@ import json
 import base64
 import io
 import math
+import re
 import uuid
+import zlib
+import hashlib
 import ctypes
 from ctypes import wintypes
 import webbrowser
@@ -16,12 +19,16 @@ import subprocess
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from PIL import Image, ImageTk, ImageGrab, ImageChops
-import pyautogui
-from pynput import keyboard
-from pynput.keyboard import Controller as KeyboardController
 import copy
 from datetime import datetime
-from collections import namedtuple
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+from abc import ABC, abstractmethod
+from collections import namedtuple, OrderedDict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait as futures_wait, FIRST_COMPLETED, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
 
 # 尝试导入 pyperclip 用于剪贴板粘贴模式
 try:
@@ -32,6 +39,16 @@ except ImportError:
     print("⚠️ 提示: 未安装 pyperclip，键盘'粘贴模式'和剪贴板节点将不可用。")
 
 # --- 1. 依赖库检查 ---
+# 鼠标键盘控制需要桌面环境；无显示器的 Linux（CI 回放、基准测试）下只能使用视觉引擎
+try:
+    import pyautogui
+    from pynput import keyboard
+    from pynput.keyboard import Controller as KeyboardController
+    HAS_DESKTOP = True
+except Exception:
+    pyautogui = keyboard = KeyboardController = None
+    HAS_DESKTOP = False
+
 try:
     import cv2
     import numpy as np
@@ -40,6 +57,18 @@ except ImportError:
     HAS_OPENCV = False
     print("⚠️ 警告: 未安装 opencv-python，高级图像识别功能受限。")
 
+try:
+    import mss
+    HAS_MSS = True
+except ImportError:
+    HAS_MSS = False
+
+try:
+    import dxcam
+    HAS_DXCAM = True
+except Exception:
+    HAS_DXCAM = False
+
 try:
     from comtypes import CLSCTX_ALL
     from pycaw.pycaw import AudioUtilities, IAudioMeterInformation
@@ -49,15 +78,17 @@ except ImportError:
     HAS_AUDIO = False
 
 # --- 2. 系统与配置管理 ---
-pyautogui.FAILSAFE = False
-pyautogui.PAUSE = 0.05  # 全局操作间隔，提升稳定性
+if HAS_DESKTOP:
+    pyautogui.FAILSAFE = False
+    pyautogui.PAUSE = 0.05  # 全局操作间隔，提升稳定性
 
-# Windows API 常量
-user32 = ctypes.windll.user32
-shcore = ctypes.windll.shcore
+# Windows API 常量（非 Windows 平台为 None）
+user32 = ctypes.windll.user32 if hasattr(ctypes, 'windll') else None
+shcore = ctypes.windll.shcore if hasattr(ctypes, 'windll') else None
 
 def get_virtual_screen_geometry():
     """获取所有屏幕组成的虚拟桌面坐标范围 (修复多屏截图问题)"""
+    if not user32: return 0, 0, 1920, 1080  # 非 Windows（回放/基准测试）默认 1080p 画布
     try:
         return (
             user32.GetSystemMetrics(76), # SM_XVIRTUALSCREEN
@@ -85,6 +116,57 @@ def get_scale_factor():
 SCALE_X, SCALE_Y = get_scale_factor()
 SCALE_FACTOR = (SCALE_X + SCALE_Y) / 2.0
 Box = namedtuple('Box', 'left top width height')
+Frame = namedtuple('Frame', 'image bbox timestamp')
+Monitor = namedtuple('Monitor', 'left top right bottom scale')
+_MONITOR_CACHE = {'list': None, 'time': 0.0, 'reliable': False}
+
+def _capture_dpis(hmons):
+    """返回各显示器在截图坐标系中的 DPI 缩放 [缩放, ...]（即 ImageGrab 截到的像素实际对应的 DPI），无法确定时返回 None。
+    截图与 EnumDisplayMonitors 矩形都处于本线程 DPI 感知模式的坐标系：每显示器感知时才是各显示器自己的 DPI；
+    系统级感知（本程序默认 SetProcessDpiAwareness(1)）下其它 DPI 的显示器被系统按系统 DPI 缩放，截图里所有显示器都是系统 DPI；不感知时为 96。"""
+    get_ctx, awareness = (getattr(user32, n, None) for n in ('GetThreadDpiAwarenessContext', 'GetAwarenessFromDpiAwarenessContext')) if user32 else (None, None)
+    if not shcore or not get_ctx or not awareness: return None  # Win10 1607 之前无法确认感知模式
+    try:
+        get_ctx.restype = ctypes.c_void_p; awareness.argtypes = [ctypes.c_void_p]
+        mode = awareness(get_ctx())  # 0 不感知 / 1 系统级 / 2 每显示器
+        if mode == 0: return [1.0] * len(hmons)
+        if mode == 1:
+            system = user32.GetDpiForSystem() if getattr(user32, 'GetDpiForSystem', None) else 0
+            return [system / 96.0 if system else SCALE_X] * len(hmons)
+        scales, dx, dy = [], wintypes.UINT(), wintypes.UINT()
+        for hmon in hmons:
+            if shcore.GetDpiForMonitor(wintypes.HMONITOR(hmon), 0, ctypes.byref(dx), ctypes.byref(dy)) != 0 or not dx.value: return None  # MDT_EFFECTIVE_DPI
+            scales.append(dx.value / 96.0)
+        return scales
+    except Exception: return None
+
+def get_monitors(max_age=5.0):
+    """枚举各显示器的屏幕矩形与截图坐标系下的 DPI 缩放（见 _capture_dpis），结果缓存 max_age 秒；
+    非 Windows 或枚举失败时返回覆盖整个虚拟桌面、缩放为系统缩放的单个显示器；无法确定时各显示器都记为系统缩放"""
+    if _MONITOR_CACHE['list'] is not None and time.time() - _MONITOR_CACHE['time'] < max_age: return _MONITOR_CACHE['list']
+    found = []
+    if user32:
+        try:
+            def _on_monitor(hmon, hdc, lprc, lparam):
+                r = lprc.contents; found.append((hmon, (r.left, r.top, r.right, r.bottom))); return 1
+            proc = ctypes.WINFUNCTYPE(ctypes.c_int, wintypes.HMONITOR, wintypes.HDC, ctypes.POINTER(wintypes.RECT), wintypes.LPARAM)(_on_monitor)
+            user32.EnumDisplayMonitors(None, None, proc, 0)
+        except Exception: found = []
+    scales = _capture_dpis([h for h, _ in found]) if found else None
+    monitors = [Monitor(*rect, round(scales[i] if scales else SCALE_X, 3)) for i, (_, rect) in enumerate(found)]
+    if not monitors: monitors = [Monitor(VX, VY, VX + VW, VY + VH, round(SCALE_X, 3))]
+    _MONITOR_CACHE.update(list=monitors, time=time.time(), reliable=scales is not None)
+    return monitors
+
+def monitor_dpi_reliable():
+    """各显示器缩放是否可信：确认了截图坐标系的 DPI，或只有一个显示器（系统 DPI 即其 DPI）"""
+    monitors = get_monitors()
+    return _MONITOR_CACHE['reliable'] or len(monitors) == 1
+
+def monitor_at(x, y):
+    """返回包含屏幕点 (x, y) 的显示器；点不在任何显示器上时返回第一个"""
+    monitors = get_monitors()
+    return next((m for m in monitors if m.left <= x < m.right and m.top <= y < m.bottom), monitors[0])
 
 def safe_float(value, default=0.0):
     try: return float(value)
@@ -133,7 +215,15 @@ FONTS = {
 SETTINGS = {
     'hotkey_start': '<f9>',
     'hotkey_stop': '<f10>',
-    'theme': 'Dark'
+    'theme': 'Dark',
+    'match_threads': 1,  # 找图并行线程数，<=1 为串行
+    'vision_processes': 0,  # 视觉工作进程数，0 为不启用多进程
+    'capture_max_age': 0.05,  # 共享截图帧的最大复用时长(秒)
+    'feature_matcher': 'auto',  # 特征匹配器: auto / bf / flann
+    'capture_backend': 'pil',  # 截图后端: pil / mss / dxgi / replay / auto
+    'capture_source': '',  # replay 后端的图片目录或视频文件
+    'capture_replay_fps': 0,  # replay 帧率，<=0 为每次截图前进一帧
+    'template_optimize': True  # 截取模板时自动裁掉均匀边框并检查信息量
 }
 
 LOG_LEVELS = {
@@ -165,6 +255,7 @@ NODE_CONFIG = {
     'web':      {'title': '🔗 网页', 'outputs': ['out'], 'color': '#0277bd', 'desc': '打开指定的URL'},
     'image':    {'title': '🎯 找图', 'outputs': ['found', 'timeout'], 'color': '#ef6c00', 'desc': '在屏幕上查找图片并操作'},
     'if_img':   {'title': '🔍 检测', 'outputs': ['yes', 'no'], 'color': '#ef6c00', 'desc': '检测屏幕是否包含指定图像'},
+    'race':     {'title': '🏁 竞速', 'outputs': ['timeout'], 'color': '#ef6c00', 'desc': '同时等待多张图片，先出现哪张就走哪条路径'},
     'if_static':{'title': '⏸️ 静止', 'outputs': ['yes', 'no'], 'color': '#d84315', 'desc': '检测画面是否保持静止'},
     'if_sound': {'title': '🔊 声音', 'outputs': ['yes', 'no'], 'color': '#d84315', 'desc': '检测是否有声音输出'},
     'set_var':  {'title': '[x] 变量', 'outputs': ['out'], 'color': '#00838f', 'desc': '设置或修改内存变量'},
@@ -173,11 +264,21 @@ NODE_CONFIG = {
     'reroute':  {'title': '●', 'outputs': ['out'], 'color': '#777777', 'desc': '线路中继点'}
 }
 
+def node_outputs(ntype, data):
+    """节点的输出端口列表（序列/分流/竞速节点随参数变化）"""
+    if ntype == 'sequence': return [str(i) for i in range(1, safe_int(data.get('num_steps', 3)) + 1)] + ['else']
+    if ntype == 'var_switch': return ['yes', 'no'] if data.get('var_name') else [c['id'] for c in data.get('cases', [])] + ['else']
+    if ntype == 'race': return [img['id'] for img in data.get('images', [])] + ['timeout']  # 每张候选图对应一个输出端口
+    return list(NODE_CONFIG.get(ntype, {}).get('outputs', []))
+
 PORT_TRANSLATION = {'out': '继续', 'yes': '是', 'no': '否', 'found': '找到', 'timeout': '超时', 'loop': '循环', 'exit': '退出', 'else': '否则', 'success': '成功', 'fail': '失败'}
 MOUSE_ACTIONS = {'click': '点击', 'move': '移动', 'drag': '拖拽', 'scroll': '滚动', 'double_click': '双击'}
 MOUSE_BUTTONS = {'left': '左键', 'right': '右键', 'middle': '中键'}
 ACTION_MAP = {'click': '单击左键', 'double_click': '双击左键', 'right_click': '单击右键', 'none': '不执行操作'}
-MATCH_STRATEGY_MAP = {'hybrid': '智能混合', 'template': '模板匹配', 'feature': '特征匹配'}
+MATCH_STRATEGY_MAP = {'hybrid': '智能混合', 'template': '模板匹配', 'feature': '特征匹配', 'pyramid': '金字塔加速'}
+MATCH_STAGE_MAP = {'template': '模板匹配', 'pyramid': '金字塔加速', 'feature': '特征匹配', 'pyautogui': 'PyAutoGUI'}
+DEFAULT_PIPELINE = [{'stage': 'template', 'enabled': True, 'budget': 1000}, {'stage': 'feature', 'enabled': False, 'budget': 300}, {'stage': 'pyautogui', 'enabled': True, 'budget': 500}]  # budget 单位 ms，0 为不限
+CAPTURE_BACKEND_MAP = {'pil': 'PIL ImageGrab', 'mss': 'MSS', 'dxgi': 'DXGI 桌面复制', 'replay': '录制回放', 'auto': '自动选择'}
 
 # --- 3. 基础工具类 ---
 class ToolTip:
@@ -207,7 +308,7 @@ class ToolTip:
             self.tip_window = None
 
 class KeyboardEngine:
-    _controller = KeyboardController()
+    _controller = KeyboardController() if HAS_DESKTOP else None
     
     @staticmethod
     def safe_write(text, mode='direct'):
@@ -410,6 +511,37 @@ class ImageUtils:
         try: thumb = image.copy(); thumb.thumbnail(size); return ImageTk.PhotoImage(thumb)
         except: return None
 
+    @staticmethod
+    def optimize_template(image, tolerance=8, min_side=8, min_entropy=3.0):
+        """模板图优化：裁掉四周的背景边（整行/整列像素与外圈主色的各通道差都 <= tolerance），统计灰度熵，并挑选方差最大的正方形子块供首轮匹配。
+        外圈主色取四条边上出现最多的颜色；颜色均匀但与背景不同的细边框、下划线（往往是按钮最有辨识度的部分）会保留。
+        返回 (裁剪后的图片, {'crop': (左, 上, 右, 下), 'size': (宽, 高), 'entropy': 熵, 'low_entropy': bool, 'patch': (x, y, 边长) 或 None})；无 OpenCV 时返回 (原图, None)"""
+        if not HAS_OPENCV or not isinstance(image, Image.Image): return image, None
+        rgb = np.asarray(image.convert('RGB')).astype(np.int16); H, W = rgb.shape[:2]
+        rim = np.concatenate([rgb[0], rgb[-1], rgb[:, 0], rgb[:, -1]])
+        colors, counts = np.unique(rim, axis=0, return_counts=True); bg = colors[int(np.argmax(counts))]
+        background = lambda block: int(np.abs(block.reshape(-1, 3) - bg).max()) <= tolerance
+        t, b, l, r = 0, H, 0, W
+        while not background(rgb[t:b, l:r]):
+            before = (t, b, l, r)
+            while b - t > min_side and background(rgb[t, l:r]): t += 1
+            while b - t > min_side and background(rgb[b - 1, l:r]): b -= 1
+            while r - l > min_side and background(rgb[t:b, l]): l += 1
+            while r - l > min_side and background(rgb[t:b, r - 1]): r -= 1
+            if (t, b, l, r) == before: break
+        cropped = image if (t, b, l, r) == (0, H, 0, W) else image.crop((l, t, r, b))
+        gray = cv2.cvtColor(np.ascontiguousarray(rgb[t:b, l:r].astype(np.uint8)), cv2.COLOR_RGB2GRAY); ch, cw = gray.shape
+        p = np.bincount(gray.ravel(), minlength=256) / gray.size; p = p[p > 0]
+        entropy = float(abs((p * np.log2(p)).sum()))
+        patch, side = None, max(16, min(cw, ch) // 2)
+        if cw * ch >= 4 * side * side:
+            g = gray.astype(np.float32)
+            var = cv2.blur(g * g, (side, side)) - cv2.blur(g, (side, side)) ** 2
+            valid = var[side // 2:ch - side + side // 2 + 1, side // 2:cw - side + side // 2 + 1]
+            py, px = np.unravel_index(int(np.argmax(valid)), valid.shape)
+            if valid[py, px] > 0: patch = (int(px), int(py), side)
+        return cropped, {'crop': (l, t, W - r, H - b), 'size': (cw, ch), 'entropy': round(entropy, 2), 'low_entropy': entropy < min_entropy, 'patch': patch}
+
 class AudioEngine:
     @staticmethod
     def get_max_audio_peak():
@@ -427,28 +559,678 @@ class AudioEngine:
             return max_peak
         except Exception: return 0.0
 
+class CaptureBackend(ABC):
+    """截图后端接口：grab(bbox) 返回覆盖 bbox（虚拟桌面坐标 x1, y1, x2, y2）的 RGB PIL 图片，失败返回 None。
+    子类实现 _grab；stats 累计每次截图耗时，用于比较各后端的截图延迟。"""
+    name = 'base'
+    def __init__(self): self.stats = {'grabs': 0, 'failures': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
+    def grab(self, bbox):
+        t0 = time.perf_counter()
+        try: img = self._grab(bbox)
+        except Exception: img = None
+        ms = (time.perf_counter() - t0) * 1000; s = self.stats
+        s['grabs'] += 1; s['total_ms'] += ms; s['max_ms'] = max(s['max_ms'], ms)
+        if img is None: s['failures'] += 1
+        return img
+
+    def latency(self): return self.stats['total_ms'] / self.stats['grabs'] if self.stats['grabs'] else 0.0
+    @abstractmethod
+    def _grab(self, bbox): ...
+    def close(self): pass
+
+class PILCaptureBackend(CaptureBackend):
+    name = 'pil'
+    def _grab(self, bbox): return ImageGrab.grab(bbox=bbox, all_screens=True)
+
+class MSSCaptureBackend(CaptureBackend):
+    """mss 截图：直接读取 BGRA 缓冲，省去 ImageGrab 的额外格式转换；mss 实例不能跨线程使用，按线程各建一个"""
+    name = 'mss'
+    def __init__(self): super().__init__(); self._local = threading.local()
+
+    def _grab(self, bbox):
+        if (sct := getattr(self._local, 'sct', None)) is None: sct = self._local.sct = mss.mss()
+        shot = sct.grab({'left': bbox[0], 'top': bbox[1], 'width': bbox[2] - bbox[0], 'height': bbox[3] - bbox[1]})
+        return Image.frombuffer('RGB', shot.size, shot.bgra, 'raw', 'BGRX')
+
+class DXGICaptureBackend(CaptureBackend):
+    """DXGI 桌面复制截图（dxcam）：由显卡直接输出主显示器帧缓冲，适合高频轮询。
+    请求区域超出主显示器（跨屏或副屏）时回退 PIL；画面没有变化时 dxcam 不产生新帧，沿用上一帧。"""
+    name = 'dxgi'
+    def __init__(self):
+        super().__init__(); self._lock = threading.Lock(); self._last = None; self._fallback = PILCaptureBackend()
+        self._camera = dxcam.create(output_color='RGB'); self._rect = (0, 0, self._camera.width, self._camera.height)
+
+    def _grab(self, bbox):
+        if not CaptureService._covers(self._rect, bbox): return self._fallback._grab(bbox)
+        with self._lock:
+            if (arr := self._camera.grab()) is not None: self._last = arr
+            arr = self._last
+        if arr is None: return self._fallback._grab(bbox)
+        return Image.fromarray(arr[bbox[1]:bbox[3], bbox[0]:bbox[2]])
+
+    def close(self):
+        try: self._camera.release()
+        except Exception: pass
+
+class ReplayCaptureBackend(CaptureBackend):
+    """回放截图源：从图片目录（按文件名排序）或视频文件读取录制帧，帧左上角对齐虚拟桌面原点，无需显示器即可运行找图流程。
+    fps<=0 时每次截图前进一帧（结果可复现，适合基准与回归测试）；fps>0 时按墙钟时间推进。播放到末尾后循环，loop=False 时停在最后一帧。"""
+    name = 'replay'
+    EXTS = ('.png', '.jpg', '.jpeg', '.bmp')
+    def __init__(self, source, fps=0, loop=True):
+        super().__init__(); self.source = source; self.fps = fps; self.loop = loop
+        self._lock = threading.Lock(); self._start = None; self.index = -1; self._image = None; self._video = None; self._pos = 0
+        if os.path.isdir(source):
+            self.frames = sorted(os.path.join(source, f) for f in os.listdir(source) if f.lower().endswith(self.EXTS))
+            self.count = len(self.frames)
+        elif HAS_OPENCV and os.path.isfile(source):
+            self._video = cv2.VideoCapture(source); self.frames = None
+            self.count = int(self._video.get(cv2.CAP_PROP_FRAME_COUNT)) if self._video.isOpened() else 0
+        else: raise ValueError(f"回放源不存在: {source}")
+        if self.count <= 0: raise ValueError(f"回放源中没有可用的帧: {source}")
+
+    def _target(self):
+        if self.fps > 0:
+            if self._start is None: self._start = time.time()
+            target = int((time.time() - self._start) * self.fps)
+        else: target = self.index + 1
+        return target % self.count if self.loop else min(target, self.count - 1)
+
+    def _read_video(self, target):
+        if target < self._pos: self._video.set(cv2.CAP_PROP_POS_FRAMES, 0); self._pos = 0
+        while self._pos < target: self._video.grab(); self._pos += 1
+        ok, bgr = self._video.read()
+        if not ok: return None
+        self._pos += 1
+        return Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+
+    def frame(self):
+        """前进到当前应播放的帧并返回整帧图片"""
+        with self._lock:
+            target = self._target()
+            if target != self.index or self._image is None:
+                if self._video is not None: img = self._read_video(target)
+                else:
+                    with Image.open(self.frames[target]) as f: img = f.convert('RGB')
+                if img is not None: self._image = img
+                self.index = target
+            return self._image
+
+    def _grab(self, bbox):
+        if (img := self.frame()) is None: return None
+        return img.crop((bbox[0] - VX, bbox[1] - VY, bbox[2] - VX, bbox[3] - VY))
+
+    def close(self):
+        if self._video is not None: self._video.release()
+
+class CaptureService:
+    """共享截图服务：并发分支在同一节拍内请求的区域合并为一次截图（取并集），再裁剪分发给各请求方；
+    max_age 内的最近一帧若已覆盖请求区域则直接复用，不再重复截图。
+    帧时间戳取截图开始的时刻；流程执行键鼠输入后调用 invalidate()，输入之前（或输入时正在截取）的帧不再被复用。"""
+    def __init__(self, tick=0.01):
+        self.tick = tick; self._cond = threading.Condition()
+        self._frame = None; self._frame_array = (None, None); self._pending = []; self._gen = 0; self._capturing = False; self._requesters = {}; self._epoch = 0
+        self.stats = {'requests': 0, 'captures': 0, 'reused': 0}
+
+    @staticmethod
+    def _norm(bbox): return tuple(int(v) for v in bbox) if bbox else (VX, VY, VX + VW, VY + VH)
+
+    @staticmethod
+    def _covers(outer, inner): return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+    @staticmethod
+    def _crop(frame, bbox):
+        if frame.bbox == bbox: return frame
+        ox, oy = frame.bbox[0], frame.bbox[1]
+        return Frame(frame.image.crop((bbox[0] - ox, bbox[1] - oy, bbox[2] - ox, bbox[3] - oy)), bbox, frame.timestamp)
+
+    def _fresh_hit(self, bbox, max_age):
+        frame = self._frame
+        if frame and time.time() - frame.timestamp <= max_age and self._covers(frame.bbox, bbox): return frame
+        return None
+
+    def invalidate(self):
+        """丢弃缓存帧，并使正在进行的截图结果不再进入缓存（屏幕内容可能已被输入改变）"""
+        with self._cond: self._epoch += 1; self._frame = None; self._frame_array = (None, None)
+
+    def grab(self, bbox=None, max_age=None):
+        """返回 Frame(image, bbox, timestamp)；截图失败时返回 None"""
+        bbox = self._norm(bbox)
+        frame = self._acquire(bbox, max_age)
+        return self._crop(frame, bbox) if frame else None
+
+    def grab_array(self, bbox=None, max_age=None):
+        """返回 Frame(array, bbox, timestamp)，array 为整帧 RGB 数组上的只读切片视图（不复制像素）。
+        同一帧的 PIL→NumPy 转换只做一次，由所有请求方共享。"""
+        bbox = self._norm(bbox)
+        if not (frame := self._acquire(bbox, max_age)): return None
+        with self._cond:
+            owner, arr = self._frame_array
+            if owner is not frame:
+                arr = np.asarray(frame.image)
+                if frame is self._frame: self._frame_array = (frame, arr)
+        ox, oy = frame.bbox[0], frame.bbox[1]
+        return Frame(arr[bbox[1] - oy:bbox[3] - oy, bbox[0] - ox:bbox[2] - ox], bbox, frame.timestamp)
+
+    def _acquire(self, bbox, max_age):
+        """返回覆盖 bbox 的整帧（可能是多个请求区域的并集）"""
+        max_age = safe_float(SETTINGS.get('capture_max_age', 0.05)) if max_age is None else max_age
+        me = threading.get_ident()
+        with self._cond:
+            self.stats['requests'] += 1; now = time.time(); self._requesters[me] = now
+            queued_gen = None
+            while True:
+                if (hit := self._fresh_hit(bbox, max_age)):
+                    if queued_gen == self._gen and bbox in self._pending: self._pending.remove(bbox)
+                    self.stats['reused'] += 1; return hit
+                if queued_gen != self._gen: self._pending.append(bbox); queued_gen = self._gen
+                if not self._capturing: break
+                self._cond.wait(0.5)
+            self._capturing = True
+            # 最近有其它线程也在截图时，稍等一个节拍收集它们的区域，一次截取并集
+            shared = any(t != me and now - ts < 0.5 for t, ts in self._requesters.items())
+        frame = epoch = None
+        try:
+            if shared and self.tick > 0: time.sleep(self.tick)
+            with self._cond:
+                pending, self._pending = self._pending or [bbox], []; self._gen += 1; epoch = self._epoch
+                self._requesters = {t: ts for t, ts in self._requesters.items() if time.time() - ts < 1.0}
+            union = (min(b[0] for b in pending), min(b[1] for b in pending), max(b[2] for b in pending), max(b[3] for b in pending))
+            started = time.time()  # 以截图开始时刻计龄：截取期间发生的变化不会让这帧显得更新
+            if (img := VisionEngine._grab_raw(union)) is not None: frame = Frame(img, union, started)
+        finally:
+            with self._cond:
+                self._capturing = False; self.stats['captures'] += 1
+                if frame and epoch == self._epoch: self._frame = frame
+                self._cond.notify_all()
+        return frame
+
+class FrameBuffers:
+    """按线程复用的 NumPy 缓冲区：每个名称保留一块只增不减的平坦内存，按需 reshape 成视图返回，
+    轮询热路径上的颜色转换、缩放与匹配结果都写入这些缓冲区而不再逐次分配。
+    返回的数组在同一线程下次以相同名称取用时会被覆盖，调用方不能长期持有。"""
+    _local = threading.local()
+
+    @staticmethod
+    def get(name, shape, dtype='uint8'):
+        pool = FrameBuffers._local.__dict__.setdefault('pool', {})
+        key, n = (name, np.dtype(dtype).str), math.prod(shape)
+        if (flat := pool.get(key)) is None or flat.size < n: flat = pool[key] = np.empty(n, dtype)
+        return flat[:n].reshape(shape)
+
+class AnyEvent:
+    """多个 threading.Event 的“或”组合，供匹配循环轮询 is_set()；set() 只置位自身的事件，不影响外部事件。
+    deadline 为 time.perf_counter() 时间点，超过后 is_set() 也返回 True（用于匹配阶段的时间预算）"""
+    def __init__(self, *events, deadline=None):
+        self.own = threading.Event(); self.events = [e for e in events if e is not None] + [self.own]; self.deadline = deadline
+    def is_set(self): return (self.deadline is not None and time.perf_counter() >= self.deadline) or any(e.is_set() for e in self.events)
+    def set(self): self.own.set()
+
+def sleep_unless(stop_event, seconds):
+    """可被 stop_event 立即打断的等待（threading.Event 直接 wait；AnyEvent 等组合事件退化为普通 sleep）；返回是否已停止"""
+    if isinstance(stop_event, threading.Event): return stop_event.wait(seconds)
+    time.sleep(seconds); return bool(stop_event and stop_event.is_set())
+
+def merge_rois(rois):
+    """合并相互重叠的矩形 [(x1, y1, x2, y2), ...]，直到互不重叠"""
+    merged = []
+    for roi in rois:
+        roi = list(roi)
+        while (hits := [r for r in merged if r[0] < roi[2] and roi[0] < r[2] and r[1] < roi[3] and roi[1] < r[3]]):
+            for other in hits: merged.remove(other); roi = [min(roi[0], other[0]), min(roi[1], other[1]), max(roi[2], other[2]), max(roi[3], other[3])]
+        merged.append(roi)
+    return [tuple(int(v) for v in r) for r in merged]
+
+class DirtyTileTracker:
+    """找图轮询的增量匹配：记录上一次未命中时每个分块像素字节的 CRC32，下一轮只在变化过的分块（外扩一个模板尺寸）内重新匹配。
+    分块内任何像素改变（包括块内平移、置换这类像素和不变的变化）都会改变 CRC，未变化区域的匹配分数与上一轮完全相同，
+    因此除 CRC32 碰撞（约 2^-32）外跳过它们不会漏检；整帧都没变化时直接跳过本轮匹配。"""
+    def __init__(self, tile=32, max_dirty_ratio=0.6):
+        self.tile = tile; self.max_dirty_ratio = max_dirty_ratio; self.prev = None
+        self.stats = {'full': 0, 'partial': 0, 'skipped': 0}
+
+    def signature(self, hA):
+        """每个 tile×tile 分块的 CRC32（边缘不足一块的部分补零），形状为 (行块数, 列块数)"""
+        t = self.tile; hH, hW = hA.shape[:2]; ny, nx = -(-hH // t), -(-hW // t)
+        if hH % t or hW % t:
+            padded = np.zeros((ny * t, nx * t) + hA.shape[2:], hA.dtype); padded[:hH, :hW] = hA; hA = padded
+        tiles = np.ascontiguousarray(hA.reshape(ny, t, nx, t, *hA.shape[2:]).swapaxes(1, 2)).reshape(ny * nx, -1)
+        return np.fromiter(map(zlib.crc32, tiles), np.uint32, ny * nx).reshape(ny, nx)
+
+    def dirty_rois(self, sig, shape, margin):
+        """返回需要重新匹配的 [(x1, y1, x2, y2), ...]；[] 表示无变化，None 表示需要整帧匹配"""
+        if self.prev is None or self.prev.shape != sig.shape: return None
+        mask = self.prev != sig
+        if not mask.any(): return []
+        hH, hW = shape[:2]; mW, mH = margin; t = self.tile
+        _, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+        rois = merge_rois((max(0, x * t - mW + 1), max(0, y * t - mH + 1), min(hW, (x + w) * t + mW - 1), min(hH, (y + h) * t + mH - 1)) for x, y, w, h, _ in stats[1:])
+        if sum((r[2] - r[0]) * (r[3] - r[1]) for r in rois) > self.max_dirty_ratio * hW * hH: return None
+        return rois
+
+    def commit(self, sig, unsearched=()):
+        """记录本轮签名；unsearched 中的区域（未实际匹配）保留旧签名，下一轮仍视为变化"""
+        if unsearched and self.prev is not None and self.prev.shape == sig.shape:
+            t = self.tile; sig = sig.copy()
+            for x1, y1, x2, y2 in unsearched: sig[y1 // t:-(-y2 // t), x1 // t:-(-x2 // t)] = self.prev[y1 // t:-(-y2 // t), x1 // t:-(-x2 // t)]
+        self.prev = sig
+    def reset(self): self.prev = None
+
+class StaticDetector:
+    """静止检测：帧转灰度（可选按整数倍面积降采样）后写入复用缓冲，用 absdiff + 阈值 + 计数统计变化像素比例，轮询时不再分配整帧临时图。
+    参考帧只在检测到运动时更新（与原逐帧比较语义一致）；motion 为变化比例的指数滑动平均，供监控面板显示运动强度。"""
+    def __init__(self, threshold=0.98, downsample=1, pixel_delta=10, smoothing=0.3):
+        self.threshold = threshold; self.downsample = max(1, int(downsample or 1)); self.pixel_delta = pixel_delta; self.smoothing = smoothing
+        self.ref = self.cur = self.diff = self._gray = None; self.ratio = 0.0; self.motion = 0.0
+
+    @staticmethod
+    def _fit(buf, shape): return buf if buf is not None and buf.shape == shape else np.empty(shape, np.uint8)
+
+    def _prepare(self, frame, out):
+        src = frame if isinstance(frame, np.ndarray) else np.asarray(frame.convert('RGB'))
+        if src.ndim == 3:
+            self._gray = self._fit(self._gray, src.shape[:2])
+            gray = cv2.cvtColor(src, cv2.COLOR_RGBA2GRAY if src.shape[2] == 4 else cv2.COLOR_RGB2GRAY, dst=self._gray)
+        else: gray = src
+        f = self.downsample; h, w = gray.shape
+        shape = (max(1, h // f), max(1, w // f)) if f > 1 else gray.shape
+        out = self._fit(out, shape)
+        if f > 1: cv2.resize(gray, (shape[1], shape[0]), dst=out, interpolation=cv2.INTER_AREA)
+        else: np.copyto(out, gray)
+        return out
+
+    def reset(self, frame=None):
+        """设置参考帧（窗口被拉回前台等情况下重新计时）"""
+        if frame is None: self.ref = None; return
+        if not HAS_OPENCV: self.ref = frame; return
+        self.ref = self._prepare(frame, self.ref)
+
+    def check(self, frame):
+        """与参考帧比较，返回是否静止；运动时当前帧成为新的参考帧"""
+        if frame is None or self.ref is None: self.reset(frame); return False
+        if not HAS_OPENCV:
+            static = VisionEngine.compare_images(self.ref, frame, self.threshold)
+            if not static: self.ref = frame
+            return static
+        self.cur = self._prepare(frame, self.cur)
+        cur = self.cur if self.cur.shape == self.ref.shape else cv2.resize(self.cur, self.ref.shape[::-1], interpolation=cv2.INTER_AREA)
+        self.diff = self._fit(self.diff, self.ref.shape)
+        cv2.absdiff(self.ref, cur, dst=self.diff)
+        cv2.threshold(self.diff, self.pixel_delta - 1, 255, cv2.THRESH_BINARY, dst=self.diff)
+        self.ratio = cv2.countNonZero(self.diff) / self.diff.size
+        self.motion += self.smoothing * (self.ratio - self.motion)
+        static = 1.0 - self.ratio >= self.threshold
+        if not static:
+            if cur is self.cur: self.ref, self.cur = self.cur, self.ref
+            else: self.ref = cur
+        return static
+
+class TargetTracker:
+    """目标跟踪：找到目标后只在上次位置（按上一帧位移预测）外扩 expand 倍目标尺寸的小窗口内局部搜索，
+    只使用与当前目标宽度最接近的一级及相邻尺度，每帧代价与目标大小相关而与屏幕分辨率无关。
+    连续 lost_after 帧未命中视为丢失；follow() 在后台线程中逐帧更新 box，供后续节点读取。"""
+    def __init__(self, needle, box, confidence=0.8, grayscale=True, expand=1.0, lost_after=3):
+        self.cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle)
+        self.box = Box(*(int(v) for v in box)); self.confidence = confidence; self.grayscale = grayscale
+        self.expand = expand; self.lost_after = lost_after
+        self.velocity = (0, 0); self.score = 1.0; self.misses = 0; self.lost = False; self.updated = time.time()
+        self.stats = {'frames': 0, 'hits': 0, 'misses': 0}
+        self._lock = threading.Lock(); self._thread = None; self._stop = threading.Event()
+
+    @staticmethod
+    def key(cache, confidence, grayscale=True):
+        """跟踪器身份：模板内容令牌 + 匹配参数；任何节点以相同模板和参数查找时都可复用同一跟踪器"""
+        return cache.token, round(float(confidence), 3), bool(grayscale)
+
+    @property
+    def token(self): return TargetTracker.key(self.cache, self.confidence, self.grayscale)
+
+    def update(self, stop_event=None):
+        """局部搜索一帧，返回新的 Box；未命中返回 None（连续未命中达到上限时 lost 置为 True）"""
+        with self._lock:
+            if self.lost or (stop_event and stop_event.is_set()): return None
+            b, (vx, vy) = self.box, self.velocity
+            m = max(16, int(max(b.width, b.height) * self.expand))
+            x1, y1 = max(VX, b.left + vx - m), max(VY, b.top + vy - m)
+            x2, y2 = min(VX + VW, b.left + vx + b.width + m), min(VY + VH, b.top + vy + b.height + m)
+            self.stats['frames'] += 1; rect = None
+            if x2 > x1 and y2 > y1 and (frame := VisionEngine.capture_array(bbox=(x1, y1, x2, y2))) is not None:
+                levels = self.cache.pyramid(self.grayscale, True, 1.0)
+                idx = min(range(len(levels)), key=lambda i: abs(levels[i][1].shape[1] - b.width)) if levels else 0
+                hA = VisionEngine._haystack_array(frame, self.grayscale)
+                rect, self.score = VisionEngine._template_sweep(hA, levels[max(0, idx - 1):idx + 2], stop_event, offset=(x1, y1), confidence=self.confidence, parallel=False)
+            if rect and self.score >= self.confidence:
+                self.velocity = (rect.left - b.left, rect.top - b.top); self.box = rect
+                self.misses = 0; self.updated = time.time(); self.stats['hits'] += 1
+                return rect
+            self.misses += 1; self.stats['misses'] += 1; self.velocity = (0, 0)
+            if self.misses >= self.lost_after: self.lost = True
+            return None
+
+    def current(self, max_age=0.1, stop_event=None):
+        """返回最新位置：后台跟随中且结果足够新时直接返回，否则同步更新一帧；已丢失返回 None"""
+        if self.lost: return None
+        if self._thread and self._thread.is_alive() and time.time() - self.updated <= max_age: return self.box
+        return self.update(stop_event) or (None if self.lost else self.box)
+
+    def follow(self, stop_event, interval=0.03, on_update=None):
+        """启动后台跟随线程，直到 stop_event / stop() / 丢失；每次命中调用 on_update(box)"""
+        def _run():
+            while not self._stop.is_set() and not stop_event.is_set() and not self.lost:
+                t0 = time.time()
+                if (box := self.update(stop_event)) and on_update: on_update(box)
+                self._stop.wait(max(0.0, interval - (time.time() - t0)))
+        self._stop.clear(); self._thread = threading.Thread(target=_run, daemon=True); self._thread.start()
+
+    def stop(self): self._stop.set()
+
+class NeedleCache:
+    """模板图预处理缓存：加载工程时一次性完成颜色转换与多尺度金字塔，轮询时只需处理屏幕截图"""
+    def __init__(self, image, patch=None):
+        self.image = image; self.width, self.height = image.size
+        self.patch = tuple(patch) if patch and patch[0] + patch[2] <= self.width and patch[1] + patch[2] <= self.height else None  # (x, y, 边长) 首轮匹配用的特征子块
+        rgb = np.array(image.convert('RGB'))
+        self.token = hashlib.blake2b(rgb.tobytes() + repr((rgb.shape, self.patch)).encode(), digest_size=16).hexdigest()  # 按内容取值：不同节点的相同模板得到相同令牌
+        self.gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY); self.bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+        self._cache = {}; self.stage_cost = {}  # 不可中断匹配阶段在该模板上的耗时滑动平均(ms)
+
+    def array(self, grayscale=True): return self.gray if grayscale else self.bgr
+
+    def features(self, grayscale=True):
+        """模板图的 AKAZE 关键点与描述子，只计算一次"""
+        key = ('akaze', bool(grayscale))
+        if (feats := self._cache.get(key)) is None:
+            feats = self._cache[key] = VisionEngine._akaze().detectAndCompute(self.array(grayscale), None)
+        return feats
+
+    def color_bins(self, grayscale=True, top=3, min_share=0.05):
+        """预筛选用的主色区间 [(下限, 上限, 像素数), ...]：灰度按 32 级、彩色按每通道 8 级量化，取像素占比不低于 min_share 的前 top 个"""
+        key = ('bins', bool(grayscale))
+        if (bins := self._cache.get(key)) is None:
+            nA = self.array(grayscale)
+            q = (nA >> 3).ravel() if grayscale else (((nA[..., 0] >> 5).astype(np.int32) << 6) | ((nA[..., 1] >> 5) << 3) | (nA[..., 2] >> 5)).ravel()
+            counts = np.bincount(q, minlength=32 if grayscale else 512); bins = []
+            for b in np.argsort(-counts, kind='stable')[:top]:
+                if counts[b] < min_share * q.size: break
+                lo = (int(b) * 8,) if grayscale else (int(b >> 6) * 32, int((b >> 3) & 7) * 32, int(b & 7) * 32)
+                bins.append((np.array(lo, np.uint8), np.array([v + (7 if grayscale else 31) for v in lo], np.uint8), int(counts[b])))
+            self._cache[key] = bins
+        return bins
+
+    def pyramid(self, grayscale=True, multiscale=True, scaling_ratio=1.0):
+        """返回 [(缩放比, 模板数组), ...]，按 (灰度, 多尺度, 缩放比) 缓存"""
+        key = (bool(grayscale), bool(multiscale), round(float(scaling_ratio), 4))
+        if (levels := self._cache.get(key)) is None:
+            nA = self.array(grayscale); nH, nW = nA.shape[:2]; levels = []
+            for s in VisionEngine._match_scales(multiscale, scaling_ratio):
+                tW, tH = int(nW * s), int(nH * s)
+                if tW < 5 or tH < 5: continue
+                levels.append((s, nA if (tW, tH) == (nW, nH) else cv2.resize(nA, (tW, tH), interpolation=cv2.INTER_AREA)))
+            self._cache[key] = levels
+        return levels
+
+    def min_size(self, grayscale=True, multiscale=True, scaling_ratio=1.0):
+        """实际搜索的最小一级模板的 (宽, 高)；区域比它还小时放不下任何尺度的目标"""
+        levels = self.pyramid(grayscale, multiscale, scaling_ratio)
+        return min((tA.shape[1] for _, tA in levels), default=self.width), min((tA.shape[0] for _, tA in levels), default=self.height)
+
+    def patch_levels(self, grayscale=True, multiscale=True, scaling_ratio=1.0):
+        """与 pyramid() 一一对应的 [(缩放比, 模板数组, (子块x, 子块y, 子块数组)), ...]，子块从缩放后的模板中按比例截取"""
+        key = (bool(grayscale), bool(multiscale), round(float(scaling_ratio), 4), 'patch')
+        if (levels := self._cache.get(key)) is None:
+            px, py, side = self.patch; levels = []
+            for s, tA in self.pyramid(grayscale, multiscale, scaling_ratio):
+                sx, sy = tA.shape[1] / self.width, tA.shape[0] / self.height
+                x, y = int(px * sx), int(py * sy); pA = tA[y:y + max(1, int(side * sy)), x:x + max(1, int(side * sx))]
+                levels.append((s, tA, (x, y, pA)))
+            self._cache[key] = levels
+        return levels
+
+    def coarse_pyramid(self, factor, grayscale=True, multiscale=True, scaling_ratio=1.0):
+        """与 pyramid() 一一对应的 1/factor 缩小版模板，用于金字塔粗搜索"""
+        key = (bool(grayscale), bool(multiscale), round(float(scaling_ratio), 4), factor)
+        if (levels := self._cache.get(key)) is None:
+            levels = [(s, cv2.resize(tA, (max(1, tA.shape[1] // factor), max(1, tA.shape[0] // factor)), interpolation=cv2.INTER_AREA)) for s, tA in self.pyramid(grayscale, multiscale, scaling_ratio)]
+            self._cache[key] = levels
+        return levels
+
+class VisionProcessPool:
+    """可选的多进程视觉执行器（SETTINGS['vision_processes'] > 0 时启用）：模板匹配在独立进程中运行，不与 Tk 界面和其它分支争抢 GIL。
+    截图数组只复制一次到 multiprocessing.shared_memory 段，工作进程按段名映射为数组视图（不 pickle 像素）；
+    模板像素同样按令牌放入共享内存（每个模板只复制一次），任务只携带段名，工作进程按令牌缓存 NeedleCache，缺失时才读取共享内存构建；
+    同一帧的截图特征点也在进程内复用。"""
+    _worker_state = {'segments': OrderedDict(), 'needles': OrderedDict(), 'frames': OrderedDict()}
+    NEEDLE_LIMIT = 128  # 常驻共享内存的模板数上限，超出时回收最久未用且没有进行中任务的模板
+
+    def __init__(self, workers):
+        self.workers = workers; self._lock = threading.Lock(); self._free = []; self._segments = []
+        self._needles = OrderedDict()  # 令牌 → [共享内存段, 形状, 进行中任务数]
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _lease(self, nbytes):
+        """取一个不小于 nbytes 的空闲共享内存段；都不够大时新建，并回收一个过小的空闲段"""
+        with self._lock:
+            for seg in self._free:
+                if seg.size >= nbytes: self._free.remove(seg); return seg
+            if self._free: self._destroy(self._free.pop(0))
+            seg = shared_memory.SharedMemory(create=True, size=max(nbytes, 1 << 20)); self._segments.append(seg)
+            return seg
+
+    def _release(self, seg):
+        with self._lock: self._free.append(seg)
+
+    def _destroy(self, seg):
+        if seg in self._segments: self._segments.remove(seg)
+        try: seg.close(); seg.unlink()
+        except Exception: pass
+
+    def match_many(self, needles, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, first_hit=False, params=None):
+        """把 hA 写入共享内存后，所有模板同时提交到进程池，返回 [(Box|None, 分数), ...]。
+        stop_event 置位时放弃等待；first_hit=True 时最先完成的命中即返回并取消其余任务；共享内存段在全部任务结束后才归还，避免被下一帧覆盖。"""
+        seg = self._lease(hA.nbytes); payloads = []
+        try:
+            np.copyto(np.ndarray(hA.shape, hA.dtype, buffer=seg.buf), hA)
+            ref = (seg.name, hA.shape, hA.dtype.str, uuid.uuid4().hex)
+            params = params or [(multiscale, scaling_ratio)] * len(needles)  # 每个模板的 (多尺度, 缩放比)
+            for n in needles: payloads.append(self._needle_ref(n) if n else None)
+            futures = [self.executor.submit(VisionProcessPool._worker_match, ref, p, confidence, grayscale, ms, sr, strategy) if p else None for p, (ms, sr) in zip(payloads, params)]
+        except Exception:
+            self._release(seg)
+            for p in payloads:
+                if p: self._unref_needle(p[0])
+            raise
+        for f, p in zip(futures, payloads):
+            if f: f.add_done_callback(lambda _, token=p[0]: self._unref_needle(token))
+        pending = [f for f in futures if f]; remaining = [len(pending)]; count_lock = threading.Lock()
+        def done(_):
+            with count_lock: remaining[0] -= 1; last = remaining[0] == 0
+            if last: self._release(seg)
+        if not pending: self._release(seg)
+        for f in pending: f.add_done_callback(done)
+        results = [(None, 0.0)] * len(needles); index = {f: i for i, f in enumerate(futures) if f}; waiting = set(pending)
+        while waiting:
+            if stop_event and stop_event.is_set():
+                for p in waiting: p.cancel()
+                return [(None, 0.0)] * len(needles)
+            finished, waiting = futures_wait(waiting, timeout=0.05, return_when=FIRST_COMPLETED)
+            for f in finished:
+                rect, score = f.result(); results[index[f]] = (Box(*rect) if rect else None, score)
+                if first_hit and rect:
+                    for p in waiting: p.cancel()
+                    return results
+        return results
+
+    def _needle_ref(self, needle):
+        """返回任务用的模板引用 (令牌, (段名, 形状), 子块)；模板像素首次提交时复制进共享内存，之后只传段名"""
+        cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle)
+        with self._lock:
+            if (entry := self._needles.get(cache.token)) is None:
+                for token in [t for t, e in self._needles.items() if e[2] <= 0][:max(0, len(self._needles) + 1 - self.NEEDLE_LIMIT)]:
+                    old = self._needles.pop(token)[0]
+                    try: old.close(); old.unlink()
+                    except Exception: pass
+                arr = np.asarray(cache.image.convert('RGB'))
+                seg = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+                np.copyto(np.ndarray(arr.shape, arr.dtype, buffer=seg.buf), arr)
+                entry = self._needles[cache.token] = [seg, arr.shape, 0]
+            self._needles.move_to_end(cache.token); entry[2] += 1
+        return cache.token, (entry[0].name, entry[1]), cache.patch
+
+    def _unref_needle(self, token):
+        with self._lock:
+            if (entry := self._needles.get(token)): entry[2] -= 1
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self._lock:
+            for seg in list(self._segments): self._destroy(seg)
+            for seg, _, _ in self._needles.values():
+                try: seg.close(); seg.unlink()
+                except Exception: pass
+            self._free = []; self._needles.clear()
+
+    # --- 以下在工作进程中执行 ---
+    @staticmethod
+    def _worker_cached(bucket, key, factory, limit):
+        cache = VisionProcessPool._worker_state[bucket]
+        if key in cache: cache.move_to_end(key); return cache[key]
+        value = cache[key] = factory()
+        while len(cache) > limit:
+            _, old = cache.popitem(last=False)
+            if isinstance(old, shared_memory.SharedMemory):
+                try: old.close()
+                except Exception: pass
+        return value
+
+    @staticmethod
+    def _worker_needle(name, shape, patch):
+        """从共享内存读出模板像素（复制后立即断开映射）并构建 NeedleCache"""
+        seg = shared_memory.SharedMemory(name=name)
+        try: image = Image.fromarray(np.ndarray(shape, np.uint8, buffer=seg.buf).copy())
+        finally: seg.close()
+        return NeedleCache(image, patch)
+
+    @staticmethod
+    def _worker_match(ref, needle, confidence, grayscale, multiscale, scaling_ratio, strategy):
+        (name, shape, dtype, frame_token), (token, needle_ref, patch) = ref, needle
+        seg = VisionProcessPool._worker_cached('segments', name, lambda: shared_memory.SharedMemory(name=name), 8)
+        hA = np.ndarray(shape, dtype, buffer=seg.buf)
+        cache = VisionProcessPool._worker_cached('needles', token, lambda: VisionProcessPool._worker_needle(*needle_ref, patch), 64)
+        shared = VisionProcessPool._worker_cached('frames', frame_token, lambda: {'lock': threading.Lock()}, 4)
+        rect, score = VisionEngine._match_array_local(cache, hA, confidence, None, grayscale, multiscale, scaling_ratio, strategy, parallel=False, shared=shared)
+        del hA
+        # Box 在 spawn 子进程中属于 __mp_main__ 模块，以普通元组返回
+        return (tuple(int(v) for v in rect) if rect else None), float(score)
+
 class VisionEngine:
+    _pool = None; _pool_size = 0; _pool_lock = threading.Lock()
+    _backend = None; _backend_key = None; _procs = None; _proc_failures = 0
+    PROCESS_FAILURE_LIMIT = 3  # 进程池连续失败该次数后才关闭多进程模式（进程池损坏时立即关闭）
+    on_log = None  # 引擎日志回调 (msg, level)，由 AutomationCore 设置；未设置时输出到控制台
+    TILE_PIXELS = 2_000_000  # 截图超过该像素数时按行切块并行匹配
+
+    capture_service = CaptureService()
+    prior_stats = {'hits': 0, 'misses': 0}  # 位置先验快速路径的命中统计
+    prescreen_stats = {'checked': 0, 'rejected': 0, 'pruned': 0, 'passed': 0}  # 预筛选：整帧排除 / 缩小到候选区域 / 无法筛选
+    stage_stats = {}  # 匹配流水线各阶段的执行次数、命中次数、累计耗时、超预算与跳过次数
+
+    @staticmethod
+    def capture_screen(bbox=None, max_age=None):
+        """经共享截图服务获取屏幕图像；bbox 为 None 时返回整个虚拟桌面"""
+        frame = VisionEngine.capture_service.grab(bbox, max_age)
+        return frame.image if frame else None
+
+    @staticmethod
+    def capture_frame(bbox=None, max_age=None): return VisionEngine.capture_service.grab(bbox, max_age)
+
+    @staticmethod
+    def capture_array(bbox=None, max_age=None):
+        """与 capture_screen 相同，但返回共享整帧上的 RGB 数组视图（不复制）；无 NumPy 时退回 PIL 图片"""
+        frame = VisionEngine.capture_service.grab_array(bbox, max_age) if HAS_OPENCV else VisionEngine.capture_service.grab(bbox, max_age)
+        return frame.image if frame else None
+
+    @staticmethod
+    def _image_size(img):
+        if HAS_OPENCV and isinstance(img, np.ndarray): return img.shape[1], img.shape[0]
+        return img.size
+
     @staticmethod
-    def capture_screen(bbox=None):
-        try: return ImageGrab.grab(bbox=bbox, all_screens=True)
-        except OSError: return None
+    def _grab_raw(bbox): return VisionEngine.capture_backend().grab(bbox)
 
     @staticmethod
-    def locate(needle, confidence=0.8, timeout=0, stop_event=None, grayscale=True, multiscale=True, scaling_ratio=1.0, strategy='hybrid', region=None):
+    def capture_backend():
+        """按 SETTINGS['capture_backend'] 懒加载截图后端，设置变化时重建"""
+        key = (SETTINGS.get('capture_backend', 'pil'), SETTINGS.get('capture_source', ''), safe_float(SETTINGS.get('capture_replay_fps', 0)))
+        with VisionEngine._pool_lock:
+            if VisionEngine._backend_key != key:
+                if VisionEngine._backend: VisionEngine._backend.close()
+                VisionEngine._backend = VisionEngine._create_backend(*key); VisionEngine._backend_key = key
+            return VisionEngine._backend
+
+    @staticmethod
+    def _create_backend(name, source='', fps=0):
+        """auto 依次尝试 dxgi / mss；依赖缺失或初始化失败时回退 PIL"""
+        if name == 'auto': name = 'dxgi' if HAS_DXCAM else ('mss' if HAS_MSS else 'pil')
+        try:
+            if name == 'dxgi' and HAS_DXCAM: return DXGICaptureBackend()
+            if name == 'mss' and HAS_MSS: return MSSCaptureBackend()
+            if name == 'replay': return ReplayCaptureBackend(source, fps)
+            if name != 'pil': print(f"⚠️ 截图后端 {name} 不可用，回退 PIL")
+        except Exception as e: print(f"⚠️ 截图后端 {name} 初始化失败，回退 PIL: {e}")
+        return PILCaptureBackend()
+
+    @staticmethod
+    def prepare_needle(image, grayscale=True, multiscale=True, scaling_ratio=1.0, strategy='hybrid', patch=None):
+        """为模板图构建 NeedleCache 并按匹配策略预热金字塔或特征点；patch 为 (x, y, 边长) 时模板匹配先搜索该子块。无 OpenCV 或图片无效时返回 None"""
+        if not HAS_OPENCV or not isinstance(image, Image.Image): return None
+        try:
+            cache = NeedleCache(image, patch)
+            if strategy == 'feature': cache.features(grayscale)
+            elif cache.patch: cache.patch_levels(grayscale, multiscale, scaling_ratio)
+            else: cache.pyramid(grayscale, multiscale, scaling_ratio)
+            return cache
+        except Exception: return None
+
+    @staticmethod
+    def _match_scales(multiscale, scaling_ratio):
+        if not multiscale: return [scaling_ratio]  # 精确尺度（已知显示器 DPI 时）
+        return np.unique(np.append(np.linspace(scaling_ratio * 0.8, scaling_ratio * 1.2, 10), [1.0, scaling_ratio]))
+
+    @staticmethod
+    def dpi_plan(region, capture_dpi):
+        """按显示器 DPI 规划搜索：返回 [(子区域 (x, y, w, h) 或 None, 精确缩放比), ...]。
+        缩放比 = 显示器在截图坐标系中的 DPI 缩放 / 截取模板时所在显示器的缩放（同一坐标系，见 _capture_dpis）；搜索区域所跨的显示器缩放相同时只返回一项（区域不变），否则按显示器切分。"""
+        if not capture_dpi or capture_dpi <= 0: return None
+        if not monitor_dpi_reliable(): return None  # 多显示器但无法确认截图坐标系的 DPI：保留多尺度扫描，不用统一的系统缩放冒充
+        rx, ry, rw, rh = region if region else (VX, VY, VW, VH); plan = []
+        for m in get_monitors():
+            x1, y1, x2, y2 = max(rx, m.left), max(ry, m.top), min(rx + rw, m.right), min(ry + rh, m.bottom)
+            if x2 > x1 and y2 > y1: plan.append(((x1, y1, x2 - x1, y2 - y1), round(m.scale / capture_dpi, 4)))
+        if not plan: return None
+        if len({r for _, r in plan}) == 1: return [(region, plan[0][1])]
+        return plan
+
+    @staticmethod
+    def locate(needle, confidence=0.8, timeout=0, stop_event=None, grayscale=True, multiscale=True, scaling_ratio=1.0, strategy='hybrid', region=None, tracker=None, prior=None, prescreen=False, pipeline=None, report=None):
+        """tracker 为 DirtyTileTracker 时，在多次调用之间只对上次未命中后变化过的区域重新匹配；
+        prior 为上次命中记录 {'x','y','w','h'}（相对 region 左上角）时先在其附近按该尺度查找；
+        prescreen=True 时先用模板主色排除不可能命中的整帧或区域；
+        pipeline 为匹配阶段列表时按流水线执行（忽略 strategy），report 字典记录命中阶段与耗时"""
         start_time = time.time()
         while True:
             if stop_event and stop_event.is_set(): return None
             
             capture_bbox = (region[0], region[1], region[0] + region[2], region[1] + region[3]) if region else None
-            haystack = VisionEngine.capture_screen(bbox=capture_bbox)
+            haystack = VisionEngine.capture_array(bbox=capture_bbox)
             
             if haystack is None:
-                time.sleep(0.5) 
+                sleep_unless(stop_event, 0.5)
                 if timeout <= 0 or (time.time()-start_time >= timeout): break
                 continue
             
             try:
-                result, _ = VisionEngine._advanced_match(needle, haystack, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy)
+                result, _ = VisionEngine._advanced_match(needle, haystack, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, tracker, prior, prescreen, pipeline, report)
                 if result:
                     offset_x = region[0] if region else 0
                     offset_y = region[1] if region else 0
@@ -456,58 +1238,558 @@ class VisionEngine:
             except Exception: pass
             
             if timeout <= 0 or (time.time()-start_time >= timeout): break
-            time.sleep(0.1)
+            sleep_unless(stop_event, 0.1)
         return None
 
     @staticmethod
-    def _advanced_match(needle, haystack, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy):
-        if not needle or not haystack: return None, 0.0
-        if needle.width > haystack.width or needle.height > haystack.height: return None, 0.0
+    def _advanced_match(needle, haystack, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, tracker=None, prior=None, prescreen=False, pipeline=None, report=None):
+        """needle 可以是 PIL 图片或 NeedleCache；传入缓存时跳过模板图的转换与缩放"""
+        if not needle or haystack is None: return None, 0.0
+        hW, hH = VisionEngine._image_size(haystack)
+        if needle.width > hW or needle.height > hH: return None, 0.0
         if HAS_OPENCV:
             try:
-                if grayscale: 
-                    nA = cv2.cvtColor(np.array(needle), cv2.COLOR_RGB2GRAY)
-                    hA = cv2.cvtColor(np.array(haystack), cv2.COLOR_RGB2GRAY)
-                else: 
-                    nA = cv2.cvtColor(np.array(needle), cv2.COLOR_RGB2BGR)
-                    hA = cv2.cvtColor(np.array(haystack), cv2.COLOR_RGB2BGR)
-                
-                if strategy == 'feature': 
-                    return VisionEngine._feature_match_akaze(nA, hA)
-                
-                nH, nW = nA.shape[:2]; hH, hW = hA.shape[:2]; scales = [1.0]
-                if multiscale: scales = np.unique(np.append(np.linspace(scaling_ratio * 0.8, scaling_ratio * 1.2, 10), [1.0, scaling_ratio]))
-                best_max, best_rect = -1, None
-                for s in scales:
-                    if stop_event and stop_event.is_set(): return None, 0.0
-                    tW, tH = int(nW * s), int(nH * s)
-                    if tW < 5 or tH < 5 or tW > hW or tH > hH: continue
-                    res = cv2.matchTemplate(hA, cv2.resize(nA, (tW, tH), interpolation=cv2.INTER_AREA), cv2.TM_CCOEFF_NORMED)
-                    _, max_val, _, max_loc = cv2.minMaxLoc(res)
-                    if max_val > best_max: best_max, best_rect = max_val, Box(max_loc[0], max_loc[1], tW, tH)
-                    if best_max > 0.99: break
-                if best_rect and best_max >= confidence: return best_rect, best_max
-            except Exception: pass
+                hA = VisionEngine._haystack_array(haystack, grayscale)
+                if prior:
+                    result = VisionEngine._prior_match(needle, hA, prior, confidence, grayscale, multiscale, scaling_ratio)
+                    VisionEngine.prior_stats['hits' if result[0] else 'misses'] += 1
+                    if result[0]:
+                        if report is not None: report.update(stage='prior', timings={})
+                        return result
+                screen = VisionEngine._prescreen(needle, hA, grayscale, multiscale, scaling_ratio) if prescreen and strategy != 'feature' else None
+                if screen == []:
+                    if tracker is not None: tracker.commit(tracker.signature(hA))
+                    return None, 0.0
+                if pipeline: return VisionEngine._run_pipeline(needle, haystack, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, pipeline, tracker, screen, report)
+                if tracker is not None: return VisionEngine._incremental_match(needle, haystack, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, tracker, screen)
+                if screen: result = VisionEngine._match_rois(needle, hA, screen, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy)
+                else: result = VisionEngine._match_array(needle, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy)
+                # 预筛选缩小了范围时，候选区域外不可能命中，不再做整帧 pyautogui 兜底
+                if result[0] or screen or strategy == 'feature' or (stop_event and stop_event.is_set()): return result
+            except Exception:
+                if pipeline: return None, 0.0  # 流水线模式下不做预算之外的兜底
+        return VisionEngine._fallback_locate(needle, haystack, confidence, grayscale)
+
+    @staticmethod
+    def _prior_match(needle, hA, prior, confidence, grayscale, multiscale, scaling_ratio):
+        """先验快速路径：只用宽度最接近上次命中的那一级模板，在上次命中框外扩半个模板（至少 16px）的 ROI 内匹配"""
+        cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle)
+        if not (levels := cache.pyramid(grayscale, multiscale, scaling_ratio)): return None, 0.0
+        pw = safe_int(prior.get('w'), cache.width)
+        s, tA = min(levels, key=lambda l: abs(l[1].shape[1] - pw))
+        (hH, hW), (tH, tW) = hA.shape[:2], tA.shape[:2]
+        x, y, m = safe_int(prior.get('x')), safe_int(prior.get('y')), max(16, max(tW, tH) // 2)
+        x1, y1, x2, y2 = max(0, x - m), max(0, y - m), min(hW, x + tW + m), min(hH, y + tH + m)
+        if x2 - x1 < tW or y2 - y1 < tH: return None, 0.0
+        rect, score = VisionEngine._template_sweep(hA[y1:y2, x1:x2], [(s, tA)], offset=(x1, y1), confidence=confidence, parallel=False)
+        return (rect, score) if rect and score >= confidence else (None, max(0.0, score))
+
+    @staticmethod
+    def _prescreen(needle, hA, grayscale, multiscale, scaling_ratio, max_ratio=0.6):
+        """廉价预筛选：模板的主色在任何位置的模板窗口内都至少占到 最小尺度² × 一半 的像素。
+        先按主色掩码计数排除整帧，再用积分图在步长网格上求窗口内主色像素和，只保留满足条件的候选区域。
+        返回 []（整帧可排除）、ROI 列表，或 None（无法预筛，需整帧匹配）。假设目标按原色渲染，亮度或色调整体变化时不应开启。"""
+        cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle)
+        stats = VisionEngine.prescreen_stats; stats['checked'] += 1
+        bins, levels = cache.color_bins(grayscale), cache.pyramid(grayscale, multiscale, scaling_ratio)
+        if not bins or not levels: stats['passed'] += 1; return None
+        (hH, hW), s_min = hA.shape[:2], min(s for s, _ in levels)
+        tW, tH = max(tA.shape[1] for _, tA in levels), max(tA.shape[0] for _, tA in levels)
+        mask, best = FrameBuffers.get('prescreen', (hH, hW)), None
+        for lo, hi, count in bins:
+            need = max(1, int(count * s_min * s_min * 0.5))
+            present = cv2.countNonZero(cv2.inRange(hA, lo, hi, dst=mask))
+            if present < need: stats['rejected'] += 1; return []
+            if best is None or present < best[0]: best = (present, need, lo, hi)
+        present, need, lo, hi = best
+        if present > 0.3 * hH * hW: stats['passed'] += 1; return None
+        cv2.threshold(cv2.inRange(hA, lo, hi, dst=mask), 127, 1, cv2.THRESH_BINARY, dst=mask)
+        ii = cv2.integral(mask, sdepth=cv2.CV_32S)
+        # 网格点 (gx, gy) 的窗口 [gx, gx+tW+step) 覆盖左上角落在该网格单元内的任意尺度模板
+        step = max(4, min(tW, tH) // 2)
+        gy, gx = np.arange(0, hH, step), np.arange(0, hW, step)
+        y2, x2 = np.minimum(gy + tH + step, hH), np.minimum(gx + tW + step, hW)
+        sums = ii[np.ix_(y2, x2)] - ii[np.ix_(gy, x2)] - ii[np.ix_(y2, gx)] + ii[np.ix_(gy, gx)]
+        if not (cand := sums >= need).any(): stats['rejected'] += 1; return []
+        _, _, comps, _ = cv2.connectedComponentsWithStats(cand.astype(np.uint8), connectivity=8)
+        rois = merge_rois((x * step, y * step, min(hW, (x + w - 1) * step + tW + step), min(hH, (y + h - 1) * step + tH + step)) for x, y, w, h, _ in comps[1:])
+        if sum((r[2] - r[0]) * (r[3] - r[1]) for r in rois) > max_ratio * hW * hH: stats['passed'] += 1; return None
+        stats['pruned'] += 1
+        return rois
+
+    @staticmethod
+    def _intersect_rois(a_rois, b_rois):
+        return [(max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])) for a in a_rois for b in b_rois if max(a[0], b[0]) < min(a[2], b[2]) and max(a[1], b[1]) < min(a[3], b[3])]
+
+    @staticmethod
+    def _run_pipeline(needle, haystack, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, pipeline, tracker=None, screen=None, report=None):
+        """按节点配置的匹配流水线依次执行各阶段（template / pyramid / feature / pyautogui），第一个命中的阶段即返回。
+        每个阶段受自身时间预算(ms)约束：可中断的阶段在尺度之间检查期限，不可中断的阶段（特征、PyAutoGUI）在该模板上的实测耗时超过预算后不再执行。
+        有阶段因预算被截断时不提交增量匹配签名，避免把未搜索完的区域当作“已确认未命中”。report 记录命中阶段与各阶段耗时。"""
+        cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle)
+        rois, sig, complete, timings, best, unsearched = screen, None, True, {}, 0.0, []
+        if tracker is not None:
+            sig = tracker.signature(hA); levels = cache.pyramid(grayscale, multiscale, scaling_ratio)
+            dirty = tracker.dirty_rois(sig, hA.shape, (max((tA.shape[1] for _, tA in levels), default=cache.width), max((tA.shape[0] for _, tA in levels), default=cache.height)))
+            if dirty == []:
+                tracker.stats['skipped'] += 1
+                if report is not None: report.update(stage=None, timings=timings)
+                return None, 0.0
+            if dirty is not None: rois = dirty if screen is None else VisionEngine._intersect_rois(dirty, screen)
+            tracker.stats['full' if rois is None else 'partial'] += 1
+        for step in pipeline:
+            if not step.get('enabled', True) or (name := step.get('stage')) not in MATCH_STAGE_MAP: continue
+            if stop_event and stop_event.is_set(): break
+            budget, stats = safe_float(step.get('budget'), 0), VisionEngine.stage_stats.setdefault(name, {'runs': 0, 'hits': 0, 'time_ms': 0.0, 'over_budget': 0, 'skipped': 0})
+            if name in ('feature', 'pyautogui') and budget > 0 and cache.stage_cost.get(name, 0) > budget: stats['skipped'] += 1; continue
+            if name == 'pyautogui' and rois is not None: continue  # 区域已被缩小时整帧兜底没有意义
+            t0 = time.perf_counter(); ev = AnyEvent(stop_event, deadline=t0 + budget / 1000) if budget > 0 else stop_event
+            try:
+                if name == 'pyautogui': result = VisionEngine._fallback_locate(cache, haystack, confidence, grayscale)
+                elif name == 'feature': result = VisionEngine._match_array(cache, hA, confidence, ev, grayscale, multiscale, scaling_ratio, 'feature')
+                elif rois is not None: result = VisionEngine._match_rois(cache, hA, rois, confidence, ev, grayscale, multiscale, scaling_ratio, name, unsearched=unsearched)
+                else: result = VisionEngine._match_array(cache, hA, confidence, ev, grayscale, multiscale, scaling_ratio, name)
+            except Exception: result = (None, 0.0)
+            elapsed = (time.perf_counter() - t0) * 1000; timings[name] = round(elapsed, 1)
+            stats['runs'] += 1; stats['time_ms'] += elapsed
+            if name in ('feature', 'pyautogui'): cache.stage_cost[name] = elapsed if name not in cache.stage_cost else 0.7 * cache.stage_cost[name] + 0.3 * elapsed
+            if result[0]:
+                stats['hits'] += 1
+                if tracker is not None: tracker.reset()
+                if report is not None: report.update(stage=name, timings=timings)
+                return result
+            if budget > 0 and elapsed >= budget: stats['over_budget'] += 1; complete = False
+            best = max(best, result[1])
+        if report is not None: report.update(stage=None, timings=timings)
+        if tracker is not None and complete and not (stop_event and stop_event.is_set()): tracker.commit(sig, unsearched)
+        return None, best
+
+    @staticmethod
+    def _match_rois(needle, hA, rois, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, parallel=True, unsearched=None):
+        """只在 rois 内匹配，返回第一个命中的 (Box, 分数)（坐标换算回 hA），全部未命中返回 (None, 最高分)。
+        比最小一级模板还小的 ROI 放不下任何尺度的目标，直接跳过；因中断而未匹配的 ROI 追加到 unsearched（供增量匹配保留其旧签名）"""
+        cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle); best = 0.0
+        mW, mH = (cache.width, cache.height) if strategy == 'feature' else cache.min_size(grayscale, multiscale, scaling_ratio)
+        for i, (x1, y1, x2, y2) in enumerate(rois):
+            if stop_event and stop_event.is_set():
+                if unsearched is not None: unsearched.extend(rois[i:])
+                break
+            if x2 - x1 < mW or y2 - y1 < mH: continue
+            rect, score = VisionEngine._match_array(cache, hA[y1:y2, x1:x2], confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, parallel)
+            if rect: return Box(rect.left + x1, rect.top + y1, rect.width, rect.height), score
+            best = max(best, score)
+        return None, best
+
+    @staticmethod
+    def _incremental_match(needle, haystack, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, tracker, screen=None):
+        cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle)
+        sig, unsearched = tracker.signature(hA), []
+        levels = cache.pyramid(grayscale, multiscale, scaling_ratio)
+        margin = (max((tA.shape[1] for _, tA in levels), default=cache.width), max((tA.shape[0] for _, tA in levels), default=cache.height))
+        rois = tracker.dirty_rois(sig, hA.shape, margin)
+        if rois == [] or (rois is not None and strategy == 'feature'):
+            # 画面自上次未命中以来没有变化（特征匹配无法局部化，只在完全无变化时跳过）
+            if rois == []: tracker.stats['skipped'] += 1; return None, 0.0
+            rois = None
+        if screen:  # 与预筛选候选区域取交集：命中的模板必然同时落在两者之内
+            rois = screen if rois is None else VisionEngine._intersect_rois(rois, screen)
+        if rois is None:
+            tracker.stats['full'] += 1
+            result = VisionEngine._match_array(cache, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy)
+            if not result[0] and strategy != 'feature' and not (stop_event and stop_event.is_set()): result = VisionEngine._fallback_locate(cache, haystack, confidence, grayscale)
+        else:
+            tracker.stats['partial'] += 1
+            result = VisionEngine._match_rois(cache, hA, rois, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, unsearched=unsearched)
+        if stop_event and stop_event.is_set(): return None, 0.0
+        if result[0]: tracker.reset()
+        else: tracker.commit(sig, unsearched)
+        return result
+
+    @staticmethod
+    def _haystack_array(haystack, grayscale):
+        """PIL 图片或 RGB 数组 → 灰度/BGR 数组，结果写入本线程的复用缓冲区"""
+        src = haystack if isinstance(haystack, np.ndarray) else np.asarray(haystack)
+        shape = src.shape[:2] if grayscale else src.shape[:2] + (3,)
+        return cv2.cvtColor(src, cv2.COLOR_RGB2GRAY if grayscale else cv2.COLOR_RGB2BGR, dst=FrameBuffers.get('haystack', shape))
+
+    @staticmethod
+    def _match_template(hA, tA, buffer='match'):
+        """cv2.matchTemplate 的结果写入本线程复用缓冲区，避免每个尺度都分配一张与截图等大的浮点图；
+        持有结果期间还要调用其它匹配（会覆盖 'match' 缓冲）的调用方需传入自己的 buffer 名称"""
+        (hH, hW), (tH, tW) = hA.shape[:2], tA.shape[:2]
+        return cv2.matchTemplate(hA, tA, cv2.TM_CCOEFF_NORMED, result=FrameBuffers.get(buffer, (hH - tH + 1, hW - tW + 1), 'float32'))
+
+    @staticmethod
+    def _match_array(needle, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, parallel=True, shared=None):
+        """在已转换好的截图数组上匹配单个模板，返回 (Box|None, 分数)，不含 pyautogui 兜底。
+        shared 为同一帧内多个模板共用的缓存字典（如截图的特征点）；启用视觉进程池时转交工作进程执行。"""
+        if (procs := VisionEngine._process_pool()):
+            try: result = procs.match_many([needle], hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy)[0]; VisionEngine._proc_failures = 0; return result
+            except Exception as e: VisionEngine._process_failed(e)
+        return VisionEngine._match_array_local(needle, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, parallel, shared)
+
+    @staticmethod
+    def _match_array_local(needle, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, parallel=True, shared=None):
+        cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle)
+        mW, mH = (cache.width, cache.height) if strategy == 'feature' else cache.min_size(grayscale, multiscale, scaling_ratio)
+        if mW > hA.shape[1] or mH > hA.shape[0]: return None, 0.0
+        if strategy == 'feature': return VisionEngine._feature_match_akaze(cache, hA, grayscale=grayscale, shared=shared)
+        if strategy == 'pyramid': best_rect, best_max = VisionEngine._pyramid_match(cache, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, parallel=parallel)
+        elif cache.patch: best_rect, best_max = VisionEngine._patch_match(cache, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio)
+        else: best_rect, best_max = VisionEngine._template_sweep(hA, cache.pyramid(grayscale, multiscale, scaling_ratio), stop_event, confidence=confidence, parallel=parallel)
+        if stop_event and stop_event.is_set(): return None, 0.0
+        if best_rect and best_max >= confidence: return best_rect, best_max
+        return None, max(0.0, best_max)
+
+    @staticmethod
+    def _fallback_locate(needle, haystack, confidence, grayscale):
         try:
-            res = pyautogui.locate(needle, haystack, confidence=confidence, grayscale=grayscale)
+            if HAS_OPENCV and isinstance(haystack, np.ndarray): haystack = Image.fromarray(haystack)
+            res = pyautogui.locate(needle.image if isinstance(needle, NeedleCache) else needle, haystack, confidence=confidence, grayscale=grayscale)
             if res: return Box(res.left, res.top, res.width, res.height), 1.0
         except: pass
         return None, 0.0
 
     @staticmethod
-    def _feature_match_akaze(template, target, min_match_count=4):
+    def match_batch(needles, haystack, confidence, stop_event=None, grayscale=True, multiscale=True, scaling_ratio=1.0, strategy='hybrid', require_all=False, prescreen=False, first_hit=False, scales=None, fallback=True):
+        """单帧批量匹配：截图只转换一次，所有模板共用同一帧（有线程池时并行），返回与 needles 等长的 [(Box|None, 分数), ...]。
+        require_all=True 时串行模式下遇到第一个未命中即停止，其余结果记为 (None, 0.0)；
+        first_hit=True 时遇到第一个命中即取消其余模板的匹配（并行模式下正在进行的匹配也会中止），未完成的记为 (None, 0.0)；prescreen 同 locate。
+        scales 为与 needles 等长的精确缩放比列表（元素为 None 的模板仍按 multiscale/scaling_ratio 扫描）。
+        fallback=False 时 OpenCV 未命中的模板不再逐个做整帧 pyautogui 兜底（轮询调用方每帧只截一次图；无 OpenCV 时仍走 pyautogui）。"""
+        results = [(None, 0.0)] * len(needles)
+        params = [(False, r) if r else (multiscale, scaling_ratio) for r in (scales or [None] * len(needles))]
+        if haystack is None or not needles: return results
+        if not HAS_OPENCV: return [VisionEngine._advanced_match(n, haystack, confidence, stop_event, grayscale, ms, sr, strategy) for n, (ms, sr) in zip(needles, params)]
+        try: hA = VisionEngine._haystack_array(haystack, grayscale)
+        except Exception: return results
+        hW, hH = VisionEngine._image_size(haystack)
+        shared = {'lock': threading.Lock()}
+        
+        if (procs := VisionEngine._process_pool()):
+            # 多进程模式：整帧只写入一次共享内存，全部模板在各工作进程中并行匹配，未命中的再本地兜底
+            valid = [n if n and n.width <= hW and n.height <= hH and not (prescreen and strategy != 'feature' and VisionEngine._prescreen(n, hA, grayscale, ms, sr) == []) else None for n, (ms, sr) in zip(needles, params)]
+            try:
+                results = procs.match_many(valid, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, first_hit=first_hit, params=params); VisionEngine._proc_failures = 0
+                if not fallback or strategy == 'feature' or (stop_event and stop_event.is_set()) or (first_hit and any(r for r, _ in results)): return results
+                return [r if r[0] or not n else VisionEngine._fallback_locate(n, haystack, confidence, grayscale) for n, r in zip(valid, results)]
+            except Exception as e: VisionEngine._process_failed(e)
+        
+        def one(needle, multiscale, scaling_ratio):
+            if not needle or (stop_event and stop_event.is_set()): return None, 0.0
+            if needle.width > hW or needle.height > hH: return None, 0.0
+            try:
+                screen = VisionEngine._prescreen(needle, hA, grayscale, multiscale, scaling_ratio) if prescreen and strategy != 'feature' else None
+                if screen == []: return None, 0.0
+                if screen: result = VisionEngine._match_rois(needle, hA, screen, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, parallel=False)
+                else: result = VisionEngine._match_array(needle, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, parallel=False, shared=shared)
+            except Exception: screen, result = None, (None, 0.0)
+            if not fallback or result[0] or screen or strategy == 'feature' or (stop_event and stop_event.is_set()): return result
+            return VisionEngine._fallback_locate(needle, haystack, confidence, grayscale)
+        
+        if (pool := VisionEngine._match_pool()) and len(needles) > 1:
+            if not first_hit: return [f.result() for f in [pool.submit(one, n, *p) for n, p in zip(needles, params)]]
+            outer, stop_event = stop_event, AnyEvent(stop_event)
+            futures = {pool.submit(one, n, *p): i for i, (n, p) in enumerate(zip(needles, params))}
+            for f in as_completed(futures):
+                results[futures[f]] = f.result()
+                if results[futures[f]][0]: stop_event.set()
+            return [(None, 0.0)] * len(needles) if outer and outer.is_set() else results
+        for i, needle in enumerate(needles):
+            results[i] = one(needle, *params[i])
+            if (require_all and not results[i][0]) or (first_hit and results[i][0]): break
+        return results
+
+    @staticmethod
+    def locate_batch(needles, confidence=0.8, timeout=0, stop_event=None, grayscale=True, multiscale=True, scaling_ratio=1.0, strategy='hybrid', region=None):
+        """与 locate 相同的轮询逻辑，但每轮只截一帧并对全部模板做 match_batch；全部命中时返回屏幕坐标 Box 列表，否则 None"""
+        start_time = time.time()
+        offset_x, offset_y = (region[0], region[1]) if region else (0, 0)
+        capture_bbox = (region[0], region[1], region[0] + region[2], region[1] + region[3]) if region else None
+        while True:
+            if stop_event and stop_event.is_set(): return None
+            haystack = VisionEngine.capture_array(bbox=capture_bbox)
+            if haystack is not None:
+                results = VisionEngine.match_batch(needles, haystack, confidence, stop_event, grayscale, multiscale, scaling_ratio, strategy, require_all=True)
+                if all(r for r, _ in results): return [Box(r.left + offset_x, r.top + offset_y, r.width, r.height) for r, _ in results]
+            if timeout <= 0 or (time.time()-start_time >= timeout): break
+            sleep_unless(stop_event, 0.1 if haystack is not None else 0.5)
+        return None
+
+    @staticmethod
+    def match_all(needle, haystack, confidence, stop_event=None, grayscale=True, multiscale=True, scaling_ratio=1.0, max_results=100, overlap=0.3):
+        """查找全部匹配：各尺度的响应图一次性阈值化并取 3x3 局部极大值，汇总后做非极大值抑制。
+        返回按阅读顺序（先上后下、先左后右）排列的 [(Box, 分数), ...]；无 OpenCV 时退回 pyautogui.locateAll。"""
+        if not needle or haystack is None: return []
+        hW, hH = VisionEngine._image_size(haystack)
+        if not HAS_OPENCV:
+            try: hits = [(Box(r.left, r.top, r.width, r.height), 1.0) for r in pyautogui.locateAll(needle, haystack, confidence=confidence, grayscale=grayscale)]
+            except Exception: return []
+            return sorted(hits, key=lambda h: (h[0].top // max(1, h[0].height // 2), h[0].left))[:max_results]
+        cache = needle if isinstance(needle, NeedleCache) else NeedleCache(needle)
+        hA = VisionEngine._haystack_array(haystack, grayscale)
+        rects, scores, cap = [], [], max(1, max_results) * 50
+        for _, tA in cache.pyramid(grayscale, multiscale, scaling_ratio):
+            if stop_event and stop_event.is_set(): return []
+            tH, tW = tA.shape[:2]
+            if tW > hW or tH > hH: continue
+            res = VisionEngine._match_template(hA, tA)
+            peak = cv2.dilate(res, None, dst=FrameBuffers.get('match_peak', res.shape, 'float32'))
+            ys, xs = np.nonzero((res >= confidence) & (res >= peak))
+            if not len(ys): continue
+            vals = res[ys, xs]
+            if len(vals) > cap: top = np.argpartition(-vals, cap)[:cap]; ys, xs, vals = ys[top], xs[top], vals[top]
+            rects.append(np.column_stack([xs, ys, np.full(len(xs), tW), np.full(len(xs), tH)])); scores.append(vals)
+        if not rects: return []
+        rects, scores = np.concatenate(rects), np.concatenate(scores)
+        hits = [(Box(*(int(v) for v in rects[i])), float(scores[i])) for i in VisionEngine._nms(rects, scores, overlap, max_results)]
+        return sorted(hits, key=lambda h: (h[0].top // max(1, h[0].height // 2), h[0].left))
+
+    @staticmethod
+    def _nms(rects, scores, overlap=0.3, limit=100):
+        """贪心非极大值抑制：按分数从高到低保留候选框，丢弃与已保留框 IoU 超过 overlap 的候选，返回保留的下标"""
+        x1, y1 = rects[:, 0].astype(np.float32), rects[:, 1].astype(np.float32)
+        x2, y2 = x1 + rects[:, 2], y1 + rects[:, 3]; areas = (x2 - x1) * (y2 - y1)
+        order, keep = np.argsort(-scores, kind='stable'), []
+        while order.size and len(keep) < limit:
+            i, rest = order[0], order[1:]; keep.append(i)
+            inter = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None) * np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None)
+            order = rest[inter <= overlap * (areas[i] + areas[rest] - inter)]
+        return keep
+
+    @staticmethod
+    def locate_all(needle, confidence=0.8, timeout=0, stop_event=None, grayscale=True, multiscale=True, scaling_ratio=1.0, region=None, max_results=100):
+        """与 locate 相同的轮询逻辑，但返回本帧内全部命中的屏幕坐标 Box 列表（阅读顺序）；超时仍无命中返回 []"""
+        start_time = time.time()
+        offset_x, offset_y = (region[0], region[1]) if region else (0, 0)
+        capture_bbox = (region[0], region[1], region[0] + region[2], region[1] + region[3]) if region else None
+        while True:
+            if stop_event and stop_event.is_set(): return []
+            haystack = VisionEngine.capture_array(bbox=capture_bbox)
+            if haystack is not None:
+                try: hits = VisionEngine.match_all(needle, haystack, confidence, stop_event, grayscale, multiscale, scaling_ratio, max_results)
+                except Exception: hits = []
+                if hits: return [Box(b.left + offset_x, b.top + offset_y, b.width, b.height) for b, _ in hits]
+            if timeout <= 0 or (time.time()-start_time >= timeout): break
+            sleep_unless(stop_event, 0.1 if haystack is not None else 0.5)
+        return []
+
+    @staticmethod
+    def _match_pool():
+        """按 SETTINGS['match_threads'] 懒加载共享线程池；设置为 1 或更小时返回 None（串行）。
+        线程数变化时只在锁内替换引用、不 shutdown 旧池：正在使用旧池的调用方可继续提交，
+        最后一个引用释放后 ThreadPoolExecutor 的工作线程（只持有弱引用）会自行退出。"""
+        workers = min(32, safe_int(SETTINGS.get('match_threads', 1), 1))
+        if workers <= 1: return None
+        with VisionEngine._pool_lock:
+            if VisionEngine._pool_size != workers:
+                VisionEngine._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='qflow-match')
+                VisionEngine._pool_size = workers
+            return VisionEngine._pool
+
+    @staticmethod
+    def _process_pool():
+        """按 SETTINGS['vision_processes'] 懒加载视觉进程池；为 0、无 OpenCV 或已在工作进程中时返回 None"""
+        workers = min(32, safe_int(SETTINGS.get('vision_processes', 0)))
+        if workers <= 0 or not HAS_OPENCV or multiprocessing.parent_process() is not None: return None
+        with VisionEngine._pool_lock:
+            if VisionEngine._procs is None or VisionEngine._procs.workers != workers:
+                if VisionEngine._procs: VisionEngine._procs.close()
+                VisionEngine._procs = VisionProcessPool(workers)
+            return VisionEngine._procs
+
+    @staticmethod
+    def _log(msg, level='info'):
+        if VisionEngine.on_log: VisionEngine.on_log(msg, level)
+        else: print(msg)
+
+    @staticmethod
+    def _process_failed(error):
+        """进程池调用失败：本次调用回退本进程匹配；进程池已损坏（工作进程崩溃）或连续失败达到上限时才关闭多进程模式"""
+        VisionEngine._proc_failures += 1
+        if not isinstance(error, BrokenProcessPool) and VisionEngine._proc_failures < VisionEngine.PROCESS_FAILURE_LIMIT:
+            VisionEngine._log(f"⚠️ 视觉进程池本次匹配失败，改为本进程匹配 ({VisionEngine._proc_failures}/{VisionEngine.PROCESS_FAILURE_LIMIT}): {error}", "warning"); return
+        VisionEngine._log(f"⚠️ 视觉进程池不可用，回退线程模式: {error}", "error")
+        SETTINGS['vision_processes'] = 0; VisionEngine._proc_failures = 0
+        with VisionEngine._pool_lock:
+            if VisionEngine._procs: VisionEngine._procs.close(); VisionEngine._procs = None
+
+    @staticmethod
+    def shutdown():
+        with VisionEngine._pool_lock:
+            if VisionEngine._procs: VisionEngine._procs.close(); VisionEngine._procs = None
+
+    @staticmethod
+    def _tile_bands(hH, hW, tH, count):
+        """把高 hH 的截图切成最多 count 个水平条带，相邻条带重叠 tH-1 行，保证跨条带的目标不会漏检"""
+        count = min(count, math.ceil(hH * hW / VisionEngine.TILE_PIXELS), max(1, hH // max(1, tH)))
+        if count <= 1: return [(0, hH)]
+        step = math.ceil(hH / count)
+        return [(y, min(hH, y + step + tH - 1)) for y in range(0, hH, step) if y + tH <= hH]
+
+    @staticmethod
+    def _parallel_sweep(pool, hA, levels, stop_event, confidence, offset=(0, 0)):
+        """把 (尺度 × 条带) 分发到线程池；cv2.matchTemplate 会释放 GIL。
+        任一结果达到 confidence 即取消剩余任务，stop_event 同样会中止排队中的任务。"""
+        hH, hW = hA.shape[:2]
+        found = threading.Event()
+        def work(tA, y1, y2):
+            if found.is_set() or (stop_event and stop_event.is_set()): return None, -1
+            tH, tW = tA.shape[:2]
+            _, max_val, _, max_loc = cv2.minMaxLoc(VisionEngine._match_template(hA[y1:y2], tA))
+            if max_val >= confidence: found.set()
+            return Box(max_loc[0] + offset[0], max_loc[1] + y1 + offset[1], tW, tH), max_val
+        
+        # 从扫描区间中心（即预期缩放比）向两侧展开提交，最先达标的通常就是正确尺度
+        center = (levels[0][0] + levels[-1][0]) / 2 if levels else 1.0
+        futures = []
+        for _, tA in sorted(levels, key=lambda lv: abs(lv[0] - center)):
+            tH, tW = tA.shape[:2]
+            if tW > hW or tH > hH: continue
+            futures.extend(pool.submit(work, tA, y1, y2) for y1, y2 in VisionEngine._tile_bands(hH, hW, tH, VisionEngine._pool_size))
+        best_max, best_rect = -1, None
         try:
-            akaze = cv2.AKAZE_create()
-            kp1, des1 = akaze.detectAndCompute(template, None); kp2, des2 = akaze.detectAndCompute(target, None)
-            if des1 is None or des2 is None: return None, 0.0
-            matches = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(des1, des2, k=2)
-            good = [m for m, n in matches if m.distance < 0.75 * n.distance]
+            for f in as_completed(futures):
+                rect, score = f.result()
+                if score > best_max: best_max, best_rect = score, rect
+                if best_max >= confidence or (stop_event and stop_event.is_set()): break
+        finally:
+            for f in futures: f.cancel()
+        # 已在执行中的相邻尺度很快就会结束，收下它们的结果以便在并列达标时取最优尺度
+        for f in futures:
+            if f.cancelled(): continue
+            rect, score = f.result()
+            if score > best_max: best_max, best_rect = score, rect
+        return best_rect, best_max
+
+    @staticmethod
+    def _template_sweep(hA, levels, stop_event=None, offset=(0, 0), confidence=0.99, parallel=True):
+        """在 hA 上依次匹配各尺度模板，返回 (最佳 Box, 最高分)；offset 用于把 ROI 内坐标换算回 hA 所在坐标系"""
+        hH, hW = hA.shape[:2]
+        if parallel and (pool := VisionEngine._match_pool()) and (len(levels) > 1 or hH * hW > VisionEngine.TILE_PIXELS):
+            return VisionEngine._parallel_sweep(pool, hA, levels, stop_event, confidence, offset)
+        best_max, best_rect = -1, None
+        # 带时间预算时大图按行带匹配，使期限检查的粒度从“一个尺度”细化到“一个行带”
+        band = max(1, VisionEngine.TILE_PIXELS // 4 // max(1, hW)) if getattr(stop_event, 'deadline', None) is not None and hH * hW > VisionEngine.TILE_PIXELS else hH
+        for s, tA in levels:
+            if stop_event and stop_event.is_set(): break
+            tH, tW = tA.shape[:2]
+            if tW > hW or tH > hH: continue
+            for y in range(0, hH - tH + 1, band):
+                if y and stop_event.is_set(): break
+                res = VisionEngine._match_template(hA[y:y + band + tH - 1], tA)
+                _, max_val, _, max_loc = cv2.minMaxLoc(res)
+                if max_val > best_max: best_max, best_rect = max_val, Box(max_loc[0] + offset[0], max_loc[1] + y + offset[1], tW, tH)
+            if best_max > 0.99: break
+        return best_rect, best_max
+
+    @staticmethod
+    def _patch_match(cache, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, top_k=3, margin=2):
+        """子块优先：先用模板中方差最大的子块匹配（只搜索能容纳整个模板的位置），再在前 top_k 个候选处用完整模板复核；
+        复核达到阈值后在相邻尺度上精修一次。子块结果图与整模板结果图的坐标一一对应，因此候选位置即模板左上角。"""
+        levels = cache.patch_levels(grayscale, multiscale, scaling_ratio)
+        hH, hW = hA.shape[:2]; best_max, best_rect, best_idx = -1, None, -1
+        for idx, (s, tA, (px, py, pA)) in enumerate(levels):
+            if stop_event and stop_event.is_set(): return None, -1
+            tH, tW = tA.shape[:2]; pH, pW = pA.shape[:2]
+            if tW > hW or tH > hH or pW < 5 or pH < 5: continue
+            res = VisionEngine._match_template(hA[py:hH - tH + py + pH, px:hW - tW + px + pW], pA, 'patch_match')  # 候选复核会写 'match' 缓冲，子块结果图单独存放
+            for _ in range(top_k):
+                _, p_val, _, (mx, my) = cv2.minMaxLoc(res)
+                if p_val < confidence - 0.15: break
+                x1, y1 = max(0, mx - margin), max(0, my - margin)
+                rect, score = VisionEngine._template_sweep(hA[y1:min(hH, my + tH + margin), x1:min(hW, mx + tW + margin)], [(s, tA)], offset=(x1, y1), parallel=False)
+                if score > best_max: best_max, best_rect, best_idx = score, rect, idx
+                res[max(0, my - pH // 2):my + pH // 2 + 1, max(0, mx - pW // 2):mx + pW // 2 + 1] = -1
+            if best_max >= confidence: break
+        if best_rect and best_max >= confidence and len(levels) > 1:
+            m = max(margin, 4); x1, y1 = max(0, best_rect.left - m), max(0, best_rect.top - m)
+            fine = [(s, tA) for s, tA, _ in levels[max(0, best_idx - 1):best_idx + 2]]
+            x2 = min(hW, best_rect.left + max(tA.shape[1] for _, tA in fine) + m); y2 = min(hH, best_rect.top + max(tA.shape[0] for _, tA in fine) + m)
+            rect, score = VisionEngine._template_sweep(hA[y1:y2, x1:x2], fine, stop_event, offset=(x1, y1), parallel=False)
+            if rect and score > best_max: best_max, best_rect = score, rect
+        return best_rect, best_max
+
+    @staticmethod
+    def _pyramid_match(cache, hA, confidence, stop_event, grayscale, multiscale, scaling_ratio, top_k=3, max_candidates=4, parallel=True):
+        """由粗到细搜索：先在 1/8 或 1/4 分辨率上找候选位置，再只在候选附近的小 ROI 内用原分辨率、相邻尺度精匹配。
+        精匹配使用与全图扫描相同的尺度和原图数据，命中时返回的 Box 与分数和 'template' 策略一致。"""
+        levels = cache.pyramid(grayscale, multiscale, scaling_ratio)
+        if not levels: return None, -1
+        min_side = min(min(tA.shape[:2]) for _, tA in levels)
+        factor = next((f for f in (8, 4, 2) if min_side // f >= 6), 0)
+        if not factor: return VisionEngine._template_sweep(hA, levels, stop_event, confidence=confidence, parallel=parallel)
+        
+        hH, hW = hA.shape[:2]
+        cW, cH = max(1, hW // factor), max(1, hH // factor)
+        coarse_hA = cv2.resize(hA, (cW, cH), dst=FrameBuffers.get('coarse', (cH, cW) + hA.shape[2:]), interpolation=cv2.INTER_AREA)
+        candidates = []
+        for idx, (s, cA) in enumerate(cache.coarse_pyramid(factor, grayscale, multiscale, scaling_ratio)):
+            if stop_event and stop_event.is_set(): return None, -1
+            tH, tW = cA.shape[:2]
+            if tW > cW or tH > cH: continue
+            res = VisionEngine._match_template(coarse_hA, cA)
+            for _ in range(top_k):
+                _, max_val, _, (mx, my) = cv2.minMaxLoc(res)
+                if max_val <= 0: break
+                candidates.append((max_val, mx * factor, my * factor, idx))
+                res[max(0, my - tH // 2):my + tH // 2 + 1, max(0, mx - tW // 2):mx + tW // 2 + 1] = -1
+        
+        candidates.sort(key=lambda c: c[0], reverse=True)
+        best_max, best_rect, refined = -1, None, []
+        margin = factor * 2
+        for _, x, y, idx in candidates:
+            if len(refined) >= max_candidates or best_max > 0.99: break
+            if any(abs(x - rx) <= margin and abs(y - ry) <= margin and abs(idx - ri) <= 1 for rx, ry, ri in refined): continue
+            refined.append((x, y, idx))
+            fine_levels = levels[max(0, idx - 1):idx + 2]
+            maxW = max(tA.shape[1] for _, tA in fine_levels); maxH = max(tA.shape[0] for _, tA in fine_levels)
+            x1, y1 = max(0, x - margin), max(0, y - margin)
+            x2, y2 = min(hW, x + maxW + margin), min(hH, y + maxH + margin)
+            rect, score = VisionEngine._template_sweep(hA[y1:y2, x1:x2], fine_levels, stop_event, offset=(x1, y1), parallel=False)
+            if rect and score > best_max: best_max, best_rect = score, rect
+        return best_rect, best_max
+
+    _cv_local = threading.local()
+    FLANN_MIN_DESCRIPTORS = 2000  # 截图描述子超过该数量时 auto 模式改用 FLANN-LSH
+
+    @staticmethod
+    def _akaze():
+        """每个线程一个 AKAZE 实例，避免反复创建且不在线程间共享 OpenCV 对象"""
+        if (akaze := getattr(VisionEngine._cv_local, 'akaze', None)) is None: akaze = VisionEngine._cv_local.akaze = cv2.AKAZE_create()
+        return akaze
+
+    @staticmethod
+    def _haystack_features(target, shared=None):
+        """截图的关键点/描述子与已训练的匹配器；同一帧内通过 shared 只计算一次"""
+        if shared is None: shared = {}
+        with shared.setdefault('lock', threading.Lock()):
+            if 'features' not in shared:
+                kp2, des2 = VisionEngine._akaze().detectAndCompute(target, None); matcher = None
+                if des2 is not None:
+                    mode = SETTINGS.get('feature_matcher', 'auto')
+                    if mode == 'flann' or (mode == 'auto' and len(des2) >= VisionEngine.FLANN_MIN_DESCRIPTORS):
+                        matcher = cv2.FlannBasedMatcher(dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1), dict(checks=50))
+                    else: matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+                    matcher.add([des2]); matcher.train()
+                shared['features'] = (kp2, des2, matcher, threading.Lock())
+            return shared['features']
+
+    @staticmethod
+    def _feature_match_akaze(template, target, min_match_count=4, grayscale=True, shared=None):
+        """template 可以是模板数组或 NeedleCache（使用其缓存的特征点）；target 的特征点经 shared 在同一帧内复用"""
+        try:
+            kp1, des1 = template.features(grayscale) if isinstance(template, NeedleCache) else VisionEngine._akaze().detectAndCompute(template, None)
+            kp2, des2, matcher, matcher_lock = VisionEngine._haystack_features(target, shared)
+            if des1 is None or des2 is None or len(des2) < 2: return None, 0.0
+            with matcher_lock: matches = matcher.knnMatch(des1, k=2)
+            good = [p[0] for p in matches if len(p) == 2 and p[0].distance < 0.75 * p[1].distance]
             if len(good) >= min_match_count:
                 src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
                 dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
                 M, _ = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
                 if M is not None:
-                    h, w = template.shape[:2]
+                    h, w = (template.height, template.width) if isinstance(template, NeedleCache) else template.shape[:2]
                     pts = np.float32([[0, 0], [0, h - 1], [w - 1, h - 1], [w - 1, 0]]).reshape(-1, 1, 2)
                     dst = cv2.perspectiveTransform(pts, M)
                     x_min, y_min = np.min(dst[:, :, 0]), np.min(dst[:, :, 1])
@@ -517,9 +1799,12 @@ class VisionEngine:
         except: return None, 0.0
     
     @staticmethod
-    def compare_images(img1, img2, threshold=0.99):
-        if not img1 or not img2: return False
+    def compare_images(img1, img2, threshold=0.99, downsample=1):
+        if img1 is None or img2 is None: return False
         try:
+            if HAS_OPENCV:
+                detector = StaticDetector(threshold, downsample); detector.reset(img1)
+                return detector.check(img2)
             if img1.size != img2.size: img2 = img2.resize(img1.size, Image.LANCZOS)
             diff = ImageChops.difference(img1.convert('L'), img2.convert('L'))
             return (1.0 - (sum(diff.histogram()[10:]) / (img1.size[0] * img1.size[1]))) >= threshold
@@ -553,17 +1838,268 @@ class LogPanel(tk.Frame):
     def clear(self): 
         self.text_area.config(state='normal'); self.text_area.delete(1.0, 'end'); self.text_area.config(state='disabled')
 
+class VarMemory(dict):
+    """运行时变量表：变量名集合增删时递增 version（只改值不递增），简写 $变量名 的匹配正则按 version 缓存"""
+    __slots__ = ('version', '_short')
+
+    def __init__(self, *args, **kwargs): super().__init__(*args, **kwargs); self.version = 0; self._short = (-1, None)
+
+    # 先修改再递增版本：读到某个 version 后再列出的变量名一定包含该版本之前的全部增删
+    def __setitem__(self, key, value):
+        new = key not in self; super().__setitem__(key, value)
+        if new: self.version += 1
+    def __delitem__(self, key): super().__delitem__(key); self.version += 1
+    def pop(self, key, *default):
+        had = key in self; value = super().pop(key, *default)
+        if had: self.version += 1
+        return value
+    def popitem(self): item = super().popitem(); self.version += 1; return item
+    def setdefault(self, key, default=None):
+        new = key not in self; value = super().setdefault(key, default)
+        if new: self.version += 1
+        return value
+    def update(self, *args, **kwargs): super().update(*args, **kwargs); self.version += 1
+    def clear(self): super().clear(); self.version += 1
+
+    def short_regex(self):
+        """当前变量集合对应的简写匹配正则（长名优先），变量集合未变时直接复用"""
+        version, regex = self._short
+        if version != self.version:
+            version = self.version; regex = self.compile_names(list(self)); self._short = (version, regex)
+        return regex
+
+    @staticmethod
+    def compile_names(keys):
+        names = sorted({k for k in keys if isinstance(k, str) and k}, key=len, reverse=True)
+        return re.compile('\\$(' + '|'.join(map(re.escape, names)) + ')') if names else None
+
+class VarTemplate:
+    """变量模板：解析一次，把字符串拆成字面量与 ${变量名} / {变量名} 占位符片段，渲染时按输出长度线性拼接（不随变量个数增长）。
+    简写 $变量名 的边界取决于当前定义了哪些变量（变量名可含 - . 空格等字符），因此在渲染时按已定义变量名的
+    “长名优先”正则匹配字面量中的 $（$ab 优先于 $a；只定义 a 时 $abc → a 的值 + bc），该正则由 VarMemory 按变量集合版本缓存。
+    未定义的花括号占位符按普通文本处理，其中的 $变量名 照常替换（JSON、脚本代码块里的花括号）。"""
+    PATTERN = re.compile(r'\$\{([^}]*)\}|\{([^{}]*)\}')
+    __slots__ = ('parts', 'has_vars')
+
+    def __init__(self, text):
+        self.parts = []; pos = 0
+        for m in self.PATTERN.finditer(text):
+            if m.start() > pos: self.parts.append(text[pos:m.start()])
+            self.parts.append((m.group(0), m.group(1) if m.group(1) is not None else m.group(2)))  # (原文, 变量名)
+            pos = m.end()
+        if pos < len(text): self.parts.append(text[pos:])
+        self.has_vars = any(not isinstance(p, str) or '$' in p for p in self.parts)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def of(text): return VarTemplate(text)
+
+    @staticmethod
+    def _fmt(v): return '' if v is None else str(v)
+
+    def render(self, memory):
+        out = []; regex = False
+        for part in self.parts:
+            if not isinstance(part, str):
+                if part[1] in memory: out.append(self._fmt(memory[part[1]])); continue
+                part = part[0]
+            if '$' in part:
+                if regex is False: regex = memory.short_regex() if isinstance(memory, VarMemory) else VarMemory.compile_names(list(memory))
+                if regex: part = regex.sub(lambda m: self._fmt(memory.get(m.group(1))), part)
+            out.append(part)
+        return ''.join(out)
+
+class LinkIndex:
+    """连线邻接索引：(source, source_port) → [target] 供引擎 O(1) 查后继；node_id → [link] 供编辑器只重绘/删除相关连线。
+    只增不删，删除连线时由持有方用过滤后的列表重建。"""
+    def __init__(self, links=()):
+        self.succ = {}; self.by_node = {}
+        for link in links: self.add(link)
+
+    def add(self, link):
+        self.succ.setdefault((link['source'], link.get('source_port', 'out')), []).append(link['target'])
+        self.by_node.setdefault(link['source'], []).append(link)
+        if link['target'] != link['source']: self.by_node.setdefault(link['target'], []).append(link)
+
+    def targets(self, node_id, port_name='out'): return self.succ.get((node_id, port_name), [])
+    def links_of(self, node_id): return self.by_node.get(node_id, [])
+
+class PlanStep:
+    """执行计划中的单个节点：预编译含变量占位符的字段、缓存解析后的参数、保存已消除中继点的后继表"""
+    __slots__ = ('id', 'type', 'node', 'data', 'dyn', 'params', 'next', 'fused')
+
+    def __init__(self, node_id, node):
+        self.id, self.type, self.node, self.data = node_id, node['type'], node, node.get('data', {})
+        self.dyn = {k: t for k, v in self.data.items() if isinstance(v, str) and ('$' in v or '{' in v) and (t := VarTemplate.of(v)).has_vars}
+        self.params = {}; self.next = {}; self.fused = 0
+
+    def resolve(self, memory):
+        """执行用参数：只渲染含占位符的字段，没有时直接复用节点数据（不复制）"""
+        if not self.dyn: return self.data
+        data = dict(self.data)
+        for k, t in self.dyn.items(): data[k] = t.render(memory)
+        return data
+
+    def param(self, data, key, default, parse=safe_float):
+        """解析参数：常量字段只解析一次并缓存，含变量的字段每次按替换后的值解析"""
+        if key in self.dyn: return parse(data.get(key, default))
+        if key not in self.params: self.params[key] = parse(self.data.get(key, default))
+        return self.params[key]
+
+class ExecutionPlan:
+    """把项目编译为执行计划（load_project 时生成一次）：
+    - 消除中继点：后继表直接指向中继点链之后的真实节点（有断点的中继点保留）
+    - 合并延时：单入单出、秒数为常量的相邻延时节点合并为一次等待（有断点的不合并）
+    运行中切换断点时由 AutomationCore.set_breakpoint 重新编译
+    - 诊断：挂在不存在节点/已不存在端口上的连线，以及从开始节点不可达的节点"""
+    def __init__(self, project, link_index=None, breakpoints=()):
+        nodes = project.get('nodes', {}); index = link_index or LinkIndex(project.get('links', []))
+        self.steps = {nid: PlanStep(nid, n) for nid, n in nodes.items()}
+        self.breakpoints = set(breakpoints) | {nid for nid, n in nodes.items() if n.get('breakpoint')}
+        for (src, port), targets in index.succ.items():
+            if src in self.steps: self.steps[src].next[port] = self._elide(targets, index)
+        self._fuse_waits(self.breakpoints)
+        self.dangling, self.unreachable = self._diagnose(project.get('links', []), index)
+
+    def targets(self, node_id, port_name='out'): return step.next.get(port_name, ()) if (step := self.steps.get(node_id)) else ()
+
+    def _elide(self, targets, index, seen=()):
+        out = []
+        for t in targets:
+            if not (step := self.steps.get(t)): continue
+            if step.type != 'reroute' or t in self.breakpoints: out.append(t)  # 有断点的中继点保留，执行到它时才能暂停
+            elif t not in seen: out += self._elide(index.targets(t, 'out'), index, seen + (t,))
+        return out
+
+    def _fuse_waits(self, breakpoints):
+        indeg = {}
+        for nid, step in self.steps.items():
+            if step.type == 'reroute' and nid not in breakpoints: continue  # 被消除的中继点的出边已并入上游节点的后继表
+            for targets in step.next.values():
+                for t in targets: indeg[t] = indeg.get(t, 0) + 1
+        waits = {nid: step for nid, step in self.steps.items() if step.type == 'wait' and 'seconds' not in step.dyn}
+        secs = {nid: step.param(step.data, 'seconds', 1.0) for nid, step in waits.items()}; outs = {nid: step.next.get('out', []) for nid, step in waits.items()}
+        for nid, step in waits.items():
+            total, nxt, absorbed = secs[nid], outs[nid], {nid}
+            while len(nxt) == 1 and (t := nxt[0]) in waits and t not in absorbed and t not in breakpoints and indeg.get(t) == 1:
+                total += secs[t]; nxt = outs[t]; absorbed.add(t)
+            if len(absorbed) > 1: step.params['seconds'] = total; step.next['out'] = nxt; step.fused = len(absorbed) - 1
+
+    def _diagnose(self, links, index):
+        title = lambda nid: self.steps[nid].data.get('_user_title') or NODE_CONFIG.get(self.steps[nid].type, {}).get('title', nid)
+        dangling = []
+        for l in links:
+            src, dst, port = l.get('source'), l.get('target'), l.get('source_port', 'out')
+            if src not in self.steps or dst not in self.steps: dangling.append(f"连线 {src} -> {dst} 指向不存在的节点")
+            elif port not in node_outputs(self.steps[src].type, self.steps[src].data): dangling.append(f"[{title(src)}] 的连线挂在已不存在的端口 {PORT_TRANSLATION.get(port, port)}")
+        seen = {nid for nid, step in self.steps.items() if step.type == 'start'}; stack = list(seen)
+        while stack:
+            for l in index.links_of(stack.pop()):
+                if l['target'] not in seen and l['target'] in self.steps: seen.add(l['target']); stack.append(l['target'])
+        unreachable = [title(nid) for nid, step in self.steps.items() if nid not in seen and step.type != 'reroute']
+        return dangling, unreachable
+
+class FlowScheduler:
+    """流程调度器：有上限的工作线程池 + 有界运行队列。
+    单后继的节点链在同一工作线程内顺序执行（不再每跳新建线程），多后继时第一个就地继续、其余入队；
+    工作线程数达到上限时新分支进入队列；队列也满时施加背压：工作线程提交的分支留在本线程，与本线程已有的分支按跳轮转执行
+    （每个分支每轮只走一个节点，发起分支的后继不会被长循环分支饿死），队列腾出空位后多出的分支交回队列；
+    非工作线程（流程入口）阻塞到队列有空位。pending 归零时经条件变量通知等待方，无需轮询。"""
+    IDLE_TIMEOUT = 5.0  # 空闲工作线程等待新任务的最长时间(秒)，超时退出
+
+    def __init__(self, run_step, stop_event, max_workers=50, on_saturated=None, max_queue=None):
+        self.run_step = run_step; self.stop_event = stop_event; self.max_workers = max(1, max_workers); self.on_saturated = on_saturated
+        self.max_queue = max(1, max_queue or self.max_workers)  # 无空闲线程可接手的排队分支上限
+        self.lock = threading.Lock(); self.work_cond = threading.Condition(self.lock); self.done_cond = threading.Condition(self.lock); self.space_cond = threading.Condition(self.lock)
+        self.queue = deque(); self.pending = 0; self.workers = 0; self.idle = 0; self._local = threading.local()
+        self.stats = {'tasks': 0, 'threads': 0, 'peak_workers': 0, 'peak_queue': 0, 'inline': 0}
+
+    def _full(self): return self.workers >= self.max_workers and len(self.queue) - self.idle >= self.max_queue
+
+    def _enqueue(self, item):
+        """（持锁调用）放入运行队列，空闲线程不足时在上限内新建工作线程；返回是否首次出现排队"""
+        self.queue.append(item); saturated = False
+        if len(self.queue) > self.idle:
+            if self.workers < self.max_workers:
+                self.workers += 1; self.stats['threads'] += 1; self.stats['peak_workers'] = max(self.stats['peak_workers'], self.workers)
+                threading.Thread(target=self._worker, daemon=True).start()
+            else:
+                saturated = self.stats['peak_queue'] == 0
+                self.stats['peak_queue'] = max(self.stats['peak_queue'], len(self.queue) - self.idle)
+        self.work_cond.notify()
+        return saturated
+
+    def submit(self, item):
+        """提交新分支；线程与队列都满时工作线程把分支留在本线程轮转执行，入口线程则阻塞到队列有空位"""
+        saturated = False
+        with self.lock:
+            if self.stop_event.is_set(): return
+            chains = getattr(self._local, 'chains', None)
+            if self._full() and chains is None:
+                while self._full() and not self.stop_event.is_set(): self.space_cond.wait()
+                if self.stop_event.is_set(): return
+            self.pending += 1; self.stats['tasks'] += 1
+            if chains is not None and self._full(): self.stats['inline'] += 1; chains.append(item)
+            else: saturated = self._enqueue(item)
+        if saturated and self.on_saturated: self.on_saturated(self.max_workers)
+
+    def _drain(self, chains):
+        """轮转执行本线程持有的分支：每次取队首分支走一跳，第一个后继排回队尾，其余作为新分支提交"""
+        while chains:
+            item = chains.popleft()
+            try: nexts = [] if self.stop_event.is_set() else (self.run_step(item) or [])
+            except Exception: traceback.print_exc(); nexts = []  # 单个分支出错不影响本线程轮转中的其它分支
+            if nexts: chains.append(nexts[0])
+            else:
+                with self.lock:
+                    self.pending -= 1
+                    if self.pending <= 0: self.done_cond.notify_all()
+            for nid in nexts[1:]: self.submit(nid)
+            if len(chains) > 1:
+                with self.lock:
+                    while len(chains) > 1 and not self._full() and not self.stop_event.is_set(): self._enqueue(chains.pop())
+
+    def _worker(self):
+        chains = self._local.chains = deque()
+        try:
+            while True:
+                with self.lock:
+                    while not self.queue:
+                        if self.stop_event.is_set(): return
+                        self.idle += 1; notified = self.work_cond.wait(self.IDLE_TIMEOUT); self.idle -= 1
+                        if not notified and not self.queue: return
+                    if self.stop_event.is_set(): return
+                    chains.append(self.queue.popleft()); self.space_cond.notify()
+                self._drain(chains)
+        finally:
+            with self.lock: self.workers -= 1; self.space_cond.notify()
+
+    def wake(self):
+        """停止时调用：丢弃尚未开始的任务并唤醒所有等待方（工作线程手中的分支在下一跳检查停止后结束）"""
+        with self.lock:
+            self.pending -= len(self.queue); self.queue.clear()
+            self.work_cond.notify_all(); self.done_cond.notify_all(); self.space_cond.notify_all()
+
+    def wait(self):
+        """阻塞到全部任务完成或 stop_event 置位（置位方需调用 wake）"""
+        with self.lock:
+            while self.pending > 0 and not self.stop_event.is_set(): self.done_cond.wait()
+
 class AutomationCore:
     def __init__(self, log_callback, app_instance):
         self.running = False; self.paused = False; self.stop_event = threading.Event(); self.pause_event = threading.Event()
-        self.log = log_callback; self.app = app_instance; self.project = None; self.runtime_memory = {}; self.io_lock = threading.Lock()
-        self.active_threads = 0; self.thread_lock = threading.Lock(); self.scaling_ratio = 1.0; self.breakpoints = set()
-        self.max_threads = 50 
+        self.signal = threading.Condition()  # 停止/暂停/继续时 notify_all，唤醒 _smart_wait 中的等待方
+        self.log = log_callback; self.app = app_instance; self.project = None; self.runtime_memory = VarMemory(); self.io_lock = threading.Lock(); self.trackers = {}
+        VisionEngine.on_log = log_callback  # 视觉引擎的回退/降级提示写入执行日志
+        self.scaling_ratio = 1.0; self.breakpoints = set()
+        self.max_threads = 50; self.scheduler = None; self.link_index = LinkIndex(); self.plan = ExecutionPlan({})
         self.context = {'window_rect': None, 'window_handle': 0, 'window_offset': (0, 0)}
         self.performance_stats = {'nodes_executed': 0, 'errors': 0, 'start_time': None}
 
     def load_project(self, project_data):
         self.project = project_data; self.scaling_ratio = 1.0; self.breakpoints = set(project_data.get('breakpoints', []))
+        self.link_index = LinkIndex(project_data.get('links', []))
+        self.plan = ExecutionPlan(project_data, self.link_index, self.breakpoints)
         dev_scale = self.project.get('metadata', {}).get('dev_scale_x', 1.0); runtime_scale_x, _ = get_scale_factor()
         if dev_scale > 0.1 and runtime_scale_x > 0.1: self.scaling_ratio = runtime_scale_x / dev_scale
         if self.project and 'nodes' in self.project:
@@ -571,19 +2107,24 @@ class AutomationCore:
                 data = node.get('data', {})
                 try:
                     if 'b64' in data and 'image' not in data and (img := ImageUtils.b64_to_img(data['b64'])): self.project['nodes'][nid]['data']['image'] = img
+                    strategy = data.get('match_strategy', 'hybrid')
+                    if 'image' in data: data['_needle_cache'] = VisionEngine.prepare_needle(data['image'], strategy=strategy, patch=data.get('needle_patch') if data.get('use_patch') else None)
                     if 'anchors' in data:
                         for anchor in data['anchors']:
                             if 'b64' in anchor and 'image' not in anchor and (img := ImageUtils.b64_to_img(anchor['b64'])): anchor['image'] = img
+                            if 'image' in anchor: anchor['_needle_cache'] = VisionEngine.prepare_needle(anchor['image'], strategy=strategy)
                     if 'images' in data:
                         for img_item in data['images']:
                             if 'b64' in img_item and 'image' not in img_item and (img := ImageUtils.b64_to_img(img_item['b64'])): img_item['image'] = img
+                            if 'image' in img_item: img_item['_needle_cache'] = VisionEngine.prepare_needle(img_item['image'], scaling_ratio=self.scaling_ratio)
                     if 'b64_preview' in data and (img:=ImageUtils.b64_to_img(data['b64_preview'])): self.project['nodes'][nid]['data']['roi_preview'] = img
                 except Exception: pass
 
     def start(self, start_node_id=None):
         if self.running or not self.project: return
         self.running = True; self.paused = False; self.stop_event.clear(); self.pause_event.set()
-        self.runtime_memory = {}; self.active_threads = 0
+        self.runtime_memory = VarMemory(); self._stop_trackers()
+        self.scheduler = FlowScheduler(self._process_node, self.stop_event, self.max_threads, lambda n: self.log(f"⚠️ 并行分支已占满 {n} 个工作线程，新分支排队等待（队列满时与发起分支在同一线程轮转执行）", "warning"))
         self.context = {'window_rect': None, 'window_handle': 0, 'window_offset': (0, 0)}
         self.performance_stats = {'nodes_executed': 0, 'errors': 0, 'start_time': time.time()}
         self.log("🚀 引擎启动", "exec"); self.app.iconify()
@@ -592,96 +2133,162 @@ class AutomationCore:
     def stop(self):
         if not self.running: return
         self.stop_event.set(); self.pause_event.set(); self.log("🛑 正在停止...", "warning")
+        self._wake_waiters()
         self.app.after(0, self.app.reset_ui_state)
 
     def pause(self): 
-        self.paused = True; self.pause_event.clear(); self.log("⏸️ 流程暂停", "paused")
+        self.paused = True; self.pause_event.clear(); self._wake_waiters(); self.log("⏸️ 流程暂停", "paused")
         self.app.after(0, lambda: self.app.update_debug_btn_state(True))
         
     def resume(self): 
-        self.paused = False; self.pause_event.set(); self.log("▶️ 流程继续", "info")
+        self.paused = False; self.pause_event.set(); self._wake_waiters(); self.log("▶️ 流程继续", "info")
         self.app.after(0, lambda: self.app.update_debug_btn_state(False))
     
+    def _wake_waiters(self):
+        """停止/暂停状态变化时唤醒所有等待方（_smart_wait 与调度器）"""
+        with self.signal: self.signal.notify_all()
+        if self.scheduler and self.stop_event.is_set(): self.scheduler.wake()
+
     def _smart_wait(self, seconds):
-        append_time = time.time() + seconds
-        while time.time() < append_time:
-            if self.stop_event.is_set(): return False
-            self._check_pause(); time.sleep(0.05)
-        return True
+        """等待 seconds 秒：停止时立即返回 False；暂停期间一直挂起到继续或停止（暂停不顺延截止时间）"""
+        deadline = time.time() + seconds
+        with self.signal:
+            while not self.stop_event.is_set():
+                if not self.pause_event.is_set(): self.signal.wait(); continue
+                if (remaining := deadline - time.time()) <= 0: return True
+                self.signal.wait(remaining)
+        return False
     
+    def set_breakpoint(self, node_id, enabled):
+        """运行中切换断点：执行计划已按断点决定了中继点消除与延时合并，这里重新编译，使新断点在被消除/合并的节点上也生效"""
+        (self.breakpoints.add if enabled else self.breakpoints.discard)(node_id)
+        if self.project and (node := self.project.get('nodes', {}).get(node_id)):
+            node['breakpoint'] = bool(enabled)
+            self.plan = ExecutionPlan(self.project, self.link_index, self.breakpoints)
+
     def _check_pause(self, node_id=None):
         if node_id and node_id in self.breakpoints:
             if not self.paused: self.log(f"🔴 命中断点: {node_id}", "paused"); self.pause(); self.app.after(0, self.app.deiconify)
         if not self.pause_event.is_set(): self.pause_event.wait()
     
-    def _get_next_links(self, node_id, port_name='out'): return [l['target'] for l in self.project['links'] if l['source'] == node_id and l.get('source_port') == port_name]
+    def _get_next_links(self, node_id, port_name='out'): return list(self.plan.targets(node_id, port_name))
     
     def _run_flow_engine(self, start_node_id=None):
         try:
             start_nodes = [start_node_id] if start_node_id else [nid for nid, n in self.project['nodes'].items() if n['type'] == 'start']
             if not start_nodes: self.log("未找到开始节点", "error"); return
+            for issue in self.plan.dangling[:5]: self.log(f"⚠️ {issue}", "warning")
+            if not start_node_id and self.plan.unreachable: self.log(f"⚠️ {len(self.plan.unreachable)} 个节点从开始节点不可达: {', '.join(self.plan.unreachable[:5])}{' 等' if len(self.plan.unreachable) > 5 else ''}", "warning")
             for start_id in start_nodes: self._fork_node(start_id)
-            while not self.stop_event.is_set():
-                with self.thread_lock: 
-                    if self.active_threads <= 0: break
-                time.sleep(0.5)
+            self.scheduler.wait()
         except Exception as e: traceback.print_exc(); self.log(f"引擎异常: {str(e)}", "error")
         finally:
             self.running = False
             if self.performance_stats['start_time']:
                 elapsed = time.time() - self.performance_stats['start_time']
                 self.log(f"📊 执行统计: {self.performance_stats['nodes_executed']}个节点, {self.performance_stats['errors']}个错误, 耗时{elapsed:.2f}秒", "info")
-            self.log("🏁 流程结束", "info"); 
+            self._stop_trackers(); self.log("🏁 流程结束", "info"); 
             self.app.highlight_node_safe(None); 
             self.app.after(0, self.app.deiconify); 
             self.app.after(100, self.app.reset_ui_state)
 
     def _fork_node(self, node_id):
-        with self.thread_lock:
-            if node_id not in self.project['nodes']: return
-            if self.active_threads >= self.max_threads: return
-            self.active_threads += 1
-        threading.Thread(target=self._process_node_thread, args=(node_id,), daemon=True).start()
+        """把节点作为新分支交给调度器（由空闲工作线程执行，线程已满时排队）；节点链的逐跳推进见 FlowScheduler._drain"""
+        if node_id in self.project['nodes']: self.scheduler.submit(node_id)
+
+    def _process_node(self, node_id):
+        """执行单个节点并返回需要继续执行的后继节点 ID 列表"""
+        if self.stop_event.is_set(): return []
+        if not (node := self.project['nodes'].get(node_id)): return []
+        self._check_pause(node_id)
+        if self.stop_event.is_set(): return []
+        self.app.highlight_node_safe(node_id, 'running'); self.app.select_node_safe(node_id); plan = self.plan
+        try: 
+            out_port = self._execute_node(node, plan)
+            self.performance_stats['nodes_executed'] += 1
+            if node['type'] in self.INPUT_NODES: VisionEngine.capture_service.invalidate()  # 键鼠输入后屏幕可能已变化，后续节点不复用输入前的帧
+        except Exception as e: 
+            self.log(f"💥 节点[{node_id}]错误: {e}", "error"); 
+            traceback.print_exc(); 
+            self.performance_stats['errors'] += 1
+            out_port = 'fail'
+        if out_port == '__STOP__' or self.stop_event.is_set(): return []
+        
+        if node['type'] != 'reroute':
+            self.log(f"↳ [{node.get('data',{}).get('_user_title','Node')}] -> {PORT_TRANSLATION.get(out_port, out_port)}", "exec")
+        
+        self.app.highlight_node_safe(node_id, 'fail' if out_port in ['timeout', 'no', 'exit', 'else', 'fail'] else 'ok')
+        # 动作节点之间保留 10ms 节奏间隔；控制流快速节点（变量、分支、循环、延时等）不再额外等待
+        if node['type'] not in self.FAST_NODES and self.stop_event.wait(0.01): return []
+        return list(plan.targets(node_id, out_port))  # 与本节点执行时使用同一份计划（运行中切换断点会替换 self.plan）
 
-    def _process_node_thread(self, node_id):
-        try:
-            if self.stop_event.is_set(): return
-            if not (node := self.project['nodes'].get(node_id)): return
-            self._check_pause(node_id)
-            if self.stop_event.is_set(): return
-            self.app.highlight_node_safe(node_id, 'running'); self.app.select_node_safe(node_id)
-            try: 
-                out_port = self._execute_node(node)
-                self.performance_stats['nodes_executed'] += 1
-            except Exception as e: 
-                self.log(f"💥 节点[{node_id}]错误: {e}", "error"); 
-                traceback.print_exc(); 
-                self.performance_stats['errors'] += 1
-                out_port = 'fail'
-            if out_port == '__STOP__' or self.stop_event.is_set(): return
-            
-            if node['type'] != 'reroute':
-                self.log(f"↳ [{node.get('data',{}).get('_user_title','Node')}] -> {PORT_TRANSLATION.get(out_port, out_port)}", "exec")
-            
-            self.app.highlight_node_safe(node_id, 'fail' if out_port in ['timeout', 'no', 'exit', 'else', 'fail'] else 'ok')
-            time.sleep(0.01)
-            for next_id in self._get_next_links(node_id, out_port):
-                if self.stop_event.is_set(): break
-                self._fork_node(next_id)
-        finally:
-            with self.thread_lock: self.active_threads -= 1
+    @staticmethod
+    def _click_point(data, box):
+        rx, ry = data.get('relative_click_pos', (0.5, 0.5))
+        return box.left + (box.width * rx) + safe_int(data.get('offset_x', 0)), box.top + (box.height * ry) + safe_int(data.get('offset_y', 0))
+
+    def _click_box(self, data, box):
+        with self.io_lock:
+            if (act := data.get('click_type', 'click')) != 'none':
+                pyautogui.moveTo(*self._click_point(data, box))
+                getattr(pyautogui, {'click':'click','double_click':'doubleClick','right_click':'rightClick'}.get(act, 'click'))()
+                VisionEngine.capture_service.invalidate()
+
+    def _learn_prior(self, node, region, box):
+        """记录命中位置与尺度（相对搜索区域左上角），同步写回画布节点数据，随 .qflow 保存；下次优先在该位置附近查找"""
+        ox, oy = (region[0], region[1]) if region else (0, 0)
+        old, cache = node['data'].get('match_prior') or {}, node['data'].get('_needle_cache')
+        prior = {'x': int(box.left - ox), 'y': int(box.top - oy), 'w': int(box.width), 'h': int(box.height), 'hits': safe_int(old.get('hits')) + 1}
+        if cache: prior['scale'] = round(box.width / cache.width, 3)
+        node['data']['match_prior'] = prior; self.app.store_node_data_safe(node['id'], 'match_prior', prior)
+
+    def _store_all_hits(self, data, hits):
+        """查找全部模式的结果写入内存变量：{前缀}_count、{前缀}_boxes，以及从 1 开始编号的 {前缀}_{i}_x / {前缀}_{i}_y 点击坐标"""
+        prefix = (data.get('result_var') or 'found').strip()
+        with self.io_lock:
+            for i in range(1, safe_int(self.runtime_memory.get(f'{prefix}_count', 0)) + 1):
+                self.runtime_memory.pop(f'{prefix}_{i}_x', None); self.runtime_memory.pop(f'{prefix}_{i}_y', None)
+            self.runtime_memory[f'{prefix}_count'] = len(hits)
+            self.runtime_memory[f'{prefix}_boxes'] = [list(b) for b in hits]
+            for i, box in enumerate(hits, 1):
+                x, y = self._click_point(data, box)
+                self.runtime_memory[f'{prefix}_{i}_x'], self.runtime_memory[f'{prefix}_{i}_y'] = int(x), int(y)
+
+    @staticmethod
+    def _dpi_scales(items, region, enabled=True):
+        """if_img / race 各模板的精确缩放比：搜索区域只落在同一 DPI 的显示器上时按各图截取时的显示器 DPI 换算，否则该图为 None（多尺度扫描）"""
+        if not enabled: return None
+        scales = [(plan[0][1] if (plan := VisionEngine.dpi_plan(region, safe_float(item.get('capture_dpi'), 0))) and len(plan) == 1 else None) for item in items]
+        return scales if any(scales) else None
+
+    def _stop_trackers(self):
+        for tt in self.trackers.values(): tt.stop()
+        self.trackers = {}
+
+    def _start_tracking(self, name, data, cache, box, confidence):
+        """为刚找到的目标启动后台跟随；点击点随跟踪框写入 {名称}_x / {名称}_y / {名称}_box"""
+        if (old := self.trackers.get(name)): old.stop()
+        click = {k: data[k] for k in ('relative_click_pos', 'offset_x', 'offset_y') if k in data}
+        tt = self.trackers[name] = TargetTracker(cache, box, confidence=confidence, expand=max(0.2, safe_float(data.get('track_expand', 1.0), 1.0)))
+        tt.click = click; self._store_tracked(name, tt, box)
+        tt.follow(self.stop_event, on_update=lambda b: self._store_tracked(name, tt, b))
+
+    def _store_tracked(self, name, tt, box):
+        x, y = self._click_point(tt.click, box)
+        with self.io_lock:  # 跟随回调在跟踪线程上执行，与工作线程的内存写入互斥
+            self.runtime_memory[f'{name}_x'], self.runtime_memory[f'{name}_y'] = int(x), int(y)
+            self.runtime_memory[f'{name}_box'] = [int(v) for v in box]
+
+    def _tracked_point(self, name):
+        """读取跟踪目标的最新点击点；跟踪器不存在或已丢失时返回 None"""
+        if not (tt := self.trackers.get((name or 'target').strip())) or not (box := tt.current(stop_event=self.stop_event)): return None
+        x, y = self._click_point(tt.click, box)
+        return int(x), int(y)
 
     def _replace_variables(self, text):
+        # 同时兼容 {变量名}、${变量名} 和 简写 $变量名 替换模式（见 VarTemplate）
         if not isinstance(text, str): return str(text)
-        try:
-            # 改进：同时兼容 {变量名}、${变量名} 和 简写 $变量名 替换模式
-            for k, v in self.runtime_memory.items(): 
-                val_str = str(v) if v is not None else ""
-                text = text.replace(f'${{{k}}}', val_str)
-                text = text.replace(f'${k}', val_str)
-                text = text.replace(f'{{{k}}}', val_str)
-        except Exception: pass
-        return text
+        return VarTemplate.of(text).render(self.runtime_memory)
     
     def _update_context_rect(self):
         if self.context['window_handle']:
@@ -705,15 +2312,47 @@ class AutomationCore:
             try:
                 WindowEngine.focus_window(self.context['window_handle'])
                 self._update_context_rect()
-                time.sleep(0.05) 
+                self.stop_event.wait(0.05)
             except: pass
 
-    def _execute_node(self, node):
+    # 控制流节点的快速执行器：不维护窗口上下文，参数在执行计划中预解析
+    def _fast_out(self, step, data): return 'out'
+    def _fast_end(self, step, data): self.stop_event.set(); self._wake_waiters(); return '__STOP__'
+    def _fast_wait(self, step, data): return 'out' if self._smart_wait(step.param(data, 'seconds', 1.0)) else '__STOP__'
+
+    def _fast_set_var(self, step, data):
+        with self.io_lock:
+            for name, value in step.param(data, 'batch_vars', [], lambda items: [(i['name'], i['value']) for i in items if i.get('name')]): self.runtime_memory[name] = value
+            if data.get('var_name'): self.runtime_memory[data['var_name']] = data.get('var_value', '')
+        return 'out'
+
+    def _fast_var_switch(self, step, data):
+        if data.get('var_name'):
+            val, target = str(self.runtime_memory.get(data['var_name'], '')), data.get('var_value', '')
+            return 'yes' if ((val == target) if data.get('operator', '=') == '=' else (val != target)) else 'no'
+        vals = [str(self.runtime_memory.get(vn, '')) for vn in step.param(data, 'var_list', '', lambda s: [vn.strip() for vn in s.split(',') if vn.strip()])]
+        for value, port in step.param(data, 'cases', [], lambda cases: [(c.get('value', ''), c.get('id', 'else')) for c in cases]):
+            if all(v == value for v in vals): return port
+        return 'else'
+
+    def _fast_loop(self, step, data):
+        if data.get('infinite', True): return 'loop'
+        with self.io_lock:
+            k = f"loop_{step.id}"; c = self.runtime_memory.get(k, 0)
+            if c < step.param(data, 'count', 3, safe_int): self.runtime_memory[k] = c + 1; return 'loop'
+            self.runtime_memory.pop(k, None); return 'exit'
+
+    INPUT_NODES = ('mouse', 'keyboard')  # 执行后需要作废共享截图缓存的节点（找图节点的点击在 _click_box 内处理）
+    FAST_NODES = {'start': _fast_out, 'reroute': _fast_out, 'end': _fast_end, 'wait': _fast_wait, 'set_var': _fast_set_var, 'var_switch': _fast_var_switch, 'loop': _fast_loop}
+
+    def _execute_node(self, node, plan=None):
         if self.stop_event.is_set(): return '__STOP__'
-        ntype = node['type']
+        step = (plan or self.plan).steps.get(node.get('id')) or PlanStep(node.get('id'), node)
+        ntype = step.type
         
-        # 兼容性动态求值（当字符串包含 '$' 或 '{' 符号时，说明可能包含对应规则的变量占位符，触发翻译解析）
-        data = {k: (self._replace_variables(v) if isinstance(v, str) and ('$' in v or '{' in v) else v) for k, v in node.get('data', {}).items()}
+        # 兼容性动态求值（编译时已把包含变量占位符的字段解析为模板，这里只渲染这些字段）
+        data = step.resolve(self.runtime_memory)
+        if (fast := self.FAST_NODES.get(ntype)): return fast(self, step, data)
         
         # 窗口上下文维护
         if self.context['window_handle']: 
@@ -722,11 +2361,6 @@ class AutomationCore:
         win_offset_x, win_offset_y = self.context['window_offset']
         win_region = self.context['window_rect'] 
 
-        if ntype == 'reroute': return 'out'
-        if ntype == 'start': return 'out'
-        if ntype == 'end': self.stop_event.set(); return '__STOP__'
-        if ntype == 'wait': return 'out' if self._smart_wait(safe_float(data.get('seconds', 1.0))) else '__STOP__'
-        
         if ntype == 'notify':
             msg = data.get('msg', '执行到此节点')
             
@@ -780,16 +2414,12 @@ class AutomationCore:
                 self.log(f"❌ 未找到窗口 (Exe:{target_exe}, Class:{target_class}, Title:{target_title})", "warning")
                 return 'fail'
 
-        if ntype == 'set_var':
-            if 'batch_vars' in data: [self.runtime_memory.update({i['name']:i['value']}) for i in data['batch_vars'] if i.get('name')]
-            if data.get('var_name'): self.runtime_memory[data['var_name']] = data.get('var_value', '')
-            return 'out'
-
         if ntype == 'clipboard':
             mode = data.get('clip_mode', 'read')
             if mode == 'read':
                 if HAS_PYPERCLIP:
-                    self.runtime_memory[data.get('var_name', 'clipboard_data')] = pyperclip.paste()
+                    text = pyperclip.paste()
+                    with self.io_lock: self.runtime_memory[data.get('var_name', 'clipboard_data')] = text
                 else:
                     self.log("⚠️ 未安装 pyperclip，无法读取剪贴板", "warning")
             elif mode == 'write':
@@ -799,17 +2429,8 @@ class AutomationCore:
                     self.log("⚠️ 未安装 pyperclip，无法写入剪贴板", "warning")
             return 'out'
 
-        if ntype == 'var_switch':
-            val = str(self.runtime_memory.get(data.get('var_name',''), ''))
-            op, target = data.get('operator', '='), data.get('var_value', '')
-            if data.get('var_name'): return 'yes' if ((val==target) if op=='=' else (val!=target)) else 'no'
-            vals = [str(self.runtime_memory.get(vn.strip(), '')) for vn in data.get('var_list', '').split(',') if vn.strip()]
-            for case in data.get('cases', []):
-                if all(v == case.get('value', '') for v in vals): return case.get('id', 'else')
-            return 'else'
-        
         if ntype == 'sequence':
-            for i in range(1, safe_int(data.get('num_steps', 3)) + 1):
+            for i in range(1, step.param(data, 'num_steps', 3, safe_int) + 1):
                 if self.stop_event.is_set(): return '__STOP__'
                 target_id = (self._get_next_links(node['id'], str(i)) or [None])[0]
                 if not target_id: continue
@@ -835,7 +2456,7 @@ class AutomationCore:
                     if peak > threshold: found = True; break
                 else: 
                     if peak < threshold: found = True; break
-                time.sleep(0.1)
+                if not self._smart_wait(min(0.1, max(0.0, timeout - (time.time() - start_t)))): return '__STOP__'  # 音量峰值没有事件通知，只能按间隔采样
             return 'yes' if found else 'no'
 
         if ntype == 'if_static':
@@ -853,7 +2474,8 @@ class AutomationCore:
                 abs_y = roi[1]
             target_bbox = (abs_x, abs_y, abs_x + roi[2], abs_y + roi[3])
             start_check = time.time(); static_start = time.time()
-            last_frame = VisionEngine.capture_screen(bbox=target_bbox)
+            detector = StaticDetector(threshold, safe_int(data.get('downsample', 1), 1))
+            detector.reset(VisionEngine.capture_array(bbox=target_bbox))
             while time.time() - start_check < timeout:
                 if self.stop_event.is_set(): return '__STOP__'
                 
@@ -862,18 +2484,16 @@ class AutomationCore:
                     if fg_hwnd != self.context['window_handle']:
                         self.log("⚠️ 窗口失去焦点或被遮挡，拉回前台并重置静止计时...", "warning")
                         self._ensure_window_focus()
-                        time.sleep(0.3)
+                        if not self._smart_wait(0.3): return '__STOP__'
                         static_start = time.time()
-                        last_frame = VisionEngine.capture_screen(bbox=target_bbox)
+                        detector.reset(VisionEngine.capture_array(bbox=target_bbox))
                         continue
                 
-                curr_frame = VisionEngine.capture_screen(bbox=target_bbox)
-                is_static = VisionEngine.compare_images(last_frame, curr_frame, threshold)
-                if is_static:
+                if detector.check(VisionEngine.capture_array(bbox=target_bbox)):
                     if time.time() - static_start >= duration: return 'yes'
                 else:
-                    static_start = time.time(); last_frame = curr_frame
-                time.sleep(0.2)
+                    static_start = time.time()
+                if not self._smart_wait(0.2): return '__STOP__'
             return 'no'
 
         if ntype == 'image':
@@ -881,31 +2501,56 @@ class AutomationCore:
             conf, timeout_val = safe_float(data.get('confidence', 0.9)), max(0.5, safe_float(data.get('timeout', 10.0)))
             search_region = win_region if win_region else None
             if (anchors := data.get('anchors', [])):
-                primary_res = None
-                for i, anchor in enumerate(anchors):
-                    if self.stop_event.is_set(): return '__STOP__'
-                    res = VisionEngine.locate(anchor['image'], confidence=conf, timeout=(timeout_val if i==0 else 2.0), stop_event=self.stop_event, strategy=data.get('match_strategy','hybrid'), region=search_region)
-                    if not res: return 'timeout'
-                    if i == 0: primary_res = res
+                # 所有锚点在同一帧中批量匹配，保证锚点之间的位置关系来自同一画面
+                anchor_hits = VisionEngine.locate_batch([a.get('_needle_cache') or a.get('image') for a in anchors], confidence=conf, timeout=timeout_val, stop_event=self.stop_event, strategy=data.get('match_strategy','hybrid'), region=search_region)
+                if self.stop_event.is_set(): return '__STOP__'
+                if not anchor_hits: return 'timeout'
+                primary_res = anchor_hits[0]
                 if primary_res:
                     off_x, off_y = safe_int(data.get('target_rect_x',0))-anchors[0].get('rect_y',0), safe_int(data.get('target_rect_y',0))-anchors[0].get('rect_y',0)
                     search_region = (max(0, int(primary_res.left+off_x)-15), max(0, int(primary_res.top+off_y)-15), safe_int(data.get('target_rect_w',100))+30, safe_int(data.get('target_rect_h',100))+30)
 
             start_time = time.time()
             auto_scroll = bool(data.get('auto_scroll', False))
+            tracker = DirtyTileTracker() if HAS_OPENCV else None
+            find_all = bool(data.get('find_all', False)); learn_prior = bool(data.get('learn_prior', True))
+            track_name = (data.get('track_name') or 'target').strip() if data.get('track') and not find_all and HAS_OPENCV else None
+            cache = data.get('_needle_cache')
+            # 已记录截图时显示器 DPI 的模板按搜索区域所在显示器的 DPI 只匹配一个精确尺度；每 5 轮做一次完整多尺度扫描兜底
+            plan = VisionEngine.dpi_plan(search_region, safe_float(data.get('capture_dpi'), 0)) if data.get('dpi_exact', False) else None
+            dpi_trackers, attempt = {}, 0
+            pipeline, report = (data.get('pipeline') or DEFAULT_PIPELINE) if data.get('use_pipeline') else None, {}
+            if track_name and cache and (tt := self.trackers.get(track_name)) and tt.token == TargetTracker.key(cache, conf) and (box := tt.current(stop_event=self.stop_event)):
+                # 同一目标仍在跟踪中：直接使用局部搜索得到的最新位置，不再整屏查找
+                self._store_tracked(track_name, tt, box); self._click_box(data, box)
+                return 'found'
             
             while True:
                 if self.stop_event.is_set(): return '__STOP__'
                 self._check_pause()
-                res = VisionEngine.locate(data.get('image'), confidence=conf, timeout=0, stop_event=self.stop_event, region=search_region, strategy=data.get('match_strategy','hybrid'))
+                attempt += 1; exact = plan if plan and attempt % 5 else None
+                if find_all:
+                    ms, sr = (False, exact[0][1]) if exact and len(exact) == 1 else (True, 1.0)
+                    if (hits := VisionEngine.locate_all(data.get('_needle_cache') or data.get('image'), confidence=conf, timeout=0, stop_event=self.stop_event, multiscale=ms, scaling_ratio=sr, region=search_region, max_results=max(1, safe_int(data.get('max_results', 100), 100)))):
+                        self._store_all_hits(data, hits)
+                        for box in (hits if data.get('click_all', False) else hits[:1]):  # 默认只对第一个命中执行动作，其余结果经变量取用
+                            if self.stop_event.is_set(): return '__STOP__'
+                            self._click_box(data, box)
+                        return 'found'
+                    if time.time() - start_time > timeout_val: self._store_all_hits(data, []); break
+                    if not self._smart_wait(0.2): return '__STOP__'
+                    continue
+                if exact:
+                    res = None
+                    for sub, ratio in exact:
+                        if (res := VisionEngine.locate(data.get('_needle_cache') or data.get('image'), confidence=conf, timeout=0, stop_event=self.stop_event, multiscale=False, scaling_ratio=ratio, region=sub, strategy=data.get('match_strategy','hybrid'), tracker=dpi_trackers.setdefault(sub, DirtyTileTracker()) if tracker else None, prior=data.get('match_prior') if learn_prior and sub == search_region else None, prescreen=bool(data.get('prescreen', False)), pipeline=pipeline, report=report)): break
+                else:
+                    res = VisionEngine.locate(data.get('_needle_cache') or data.get('image'), confidence=conf, timeout=0, stop_event=self.stop_event, region=search_region, strategy=data.get('match_strategy','hybrid'), tracker=tracker, prior=data.get('match_prior') if learn_prior else None, prescreen=bool(data.get('prescreen', False)), pipeline=pipeline, report=report)
                 if res:
-                    with self.io_lock:
-                        if (act := data.get('click_type', 'click')) != 'none':
-                            rx, ry = data.get('relative_click_pos', (0.5, 0.5))
-                            tx = res.left + (res.width * rx) + safe_int(data.get('offset_x', 0))
-                            ty = res.top + (res.height * ry) + safe_int(data.get('offset_y', 0))
-                            pyautogui.moveTo(tx, ty)
-                            getattr(pyautogui, {'click':'click','double_click':'doubleClick','right_click':'rightClick'}.get(act, 'click'))()
+                    if pipeline: self.log(f"🎯 命中阶段: {MATCH_STAGE_MAP.get(report.get('stage'), '位置记忆')} ({' / '.join(f'{MATCH_STAGE_MAP.get(k, k)} {v:.0f}ms' for k, v in report.get('timings', {}).items()) or '-'})", "info")
+                    if learn_prior: self._learn_prior(node, search_region, res)
+                    if track_name and cache: self._start_tracking(track_name, data, cache, res, conf)
+                    self._click_box(data, res)
                     return 'found'
                 
                 if time.time() - start_time > timeout_val:
@@ -918,9 +2563,10 @@ class AutomationCore:
                             cy = win_region[1] + win_region[3] // 2
                             pyautogui.moveTo(cx, cy)
                          pyautogui.scroll(safe_int(data.get('scroll_amount', -500)))
-                     time.sleep(0.5)
+                     VisionEngine.capture_service.invalidate()
+                     if not self._smart_wait(0.5): return '__STOP__'
 
-                time.sleep(0.2)
+                if not self._smart_wait(0.2): return '__STOP__'
             return 'timeout'
 
         if ntype == 'mouse':
@@ -929,6 +2575,11 @@ class AutomationCore:
                 action = data.get('mouse_action', 'click')
                 dur = safe_float(data.get('duration', 0.5))
                 coord_mode = data.get('coord_mode', 'relative')
+                if coord_mode == 'tracked' and action != 'scroll':
+                    if not (base := self._tracked_point(data.get('track_name'))):
+                        self.log(f"⚠️ 跟踪目标 '{data.get('track_name') or 'target'}' 不存在或已丢失，跳过鼠标操作", "warning")
+                        return 'out'
+                    win_offset_x, win_offset_y = base
                 
                 if action == 'drag':
                     start_x = safe_int(data.get('start_x', 0)) 
@@ -936,7 +2587,7 @@ class AutomationCore:
                     end_x = safe_int(data.get('end_x', 0))
                     end_y = safe_int(data.get('end_y', 0))
                     
-                    if coord_mode == 'relative' and self.context['window_handle']:
+                    if coord_mode == 'tracked' or (coord_mode == 'relative' and self.context['window_handle']):
                         start_x_screen = start_x + win_offset_x
                         start_y_screen = start_y + win_offset_y
                         end_x_screen = end_x + win_offset_x
@@ -955,7 +2606,7 @@ class AutomationCore:
 
                 else:
                     raw_x, raw_y = safe_int(data.get('x',0)), safe_int(data.get('y',0))
-                    if coord_mode == 'relative' and self.context['window_handle']:
+                    if coord_mode == 'tracked' or (coord_mode == 'relative' and self.context['window_handle']):
                         target_x = raw_x + win_offset_x
                         target_y = raw_y + win_offset_y
                     else:
@@ -1029,14 +2680,6 @@ class AutomationCore:
             except Exception as e: self.log(f"CMD错误: {e}", "error")
             return 'out'
         if ntype == 'web': webbrowser.open(data.get('url')); self._smart_wait(2); return 'out'
-        if ntype == 'loop':
-            if data.get('infinite', True): return 'loop'
-            with self.io_lock:
-                k = f"loop_{node['id']}"; c = self.runtime_memory.get(k, 0)
-                if c < safe_int(data.get('count', 3)): self.runtime_memory[k] = c + 1; return 'loop'
-                else: 
-                    if k in self.runtime_memory: del self.runtime_memory[k]
-                    return 'exit'
         if ntype == 'if_img':
             self._ensure_window_focus()
             if not (imgs := data.get('images', [])): return 'no'
@@ -1046,10 +2689,33 @@ class AutomationCore:
             else:
                 capture_bbox = None
         
-            hay = VisionEngine.capture_screen(bbox=capture_bbox)
-            for img in imgs:
-                if not VisionEngine._advanced_match(img.get('image'), hay, safe_float(data.get('confidence',0.9)), self.stop_event, True, True, self.scaling_ratio, 'hybrid')[0]: return 'no'
-            return 'yes'
+            hay = VisionEngine.capture_array(bbox=capture_bbox)
+            scales = self._dpi_scales(imgs, win_region, data.get('dpi_exact', False))
+            results = VisionEngine.match_batch([img.get('_needle_cache') or img.get('image') for img in imgs], hay, safe_float(data.get('confidence',0.9)), self.stop_event, True, True, self.scaling_ratio, 'hybrid', require_all=True, prescreen=bool(data.get('prescreen', False)), scales=scales)
+            return 'yes' if all(r for r, _ in results) else 'no'
+
+        if ntype == 'race':
+            self._ensure_window_focus()
+            if not (slots := [(i, img) for i, img in enumerate(data.get('images', []), 1) if img.get('_needle_cache') or img.get('image')]): return 'timeout'
+            imgs = [img for _, img in slots]
+            conf, timeout_val = safe_float(data.get('confidence', 0.9)), max(0.5, safe_float(data.get('timeout', 10.0)))
+            capture_bbox = (win_region.left, win_region.top, win_region.left + win_region.width, win_region.top + win_region.height) if win_region else None
+            needles, start_time, attempt = [img.get('_needle_cache') or img.get('image') for img in imgs], time.time(), 0
+            scales = self._dpi_scales(imgs, win_region, data.get('dpi_exact', False))
+            # 单一截图循环：每帧对全部候选图批量匹配，先命中者胜出并取消其余匹配；同一帧多张命中时按图片顺序优先
+            while not self.stop_event.is_set():
+                self._check_pause()
+                attempt += 1
+                if (hay := VisionEngine.capture_array(bbox=capture_bbox)) is not None:
+                    results = VisionEngine.match_batch(needles, hay, conf, self.stop_event, True, True, self.scaling_ratio, 'hybrid', prescreen=bool(data.get('prescreen', False)), first_hit=True, scales=scales if attempt % 5 else None, fallback=False)
+                    if (winner := next((i for i, (r, _) in enumerate(results) if r), None)) is not None:
+                        slot = slots[winner][0]  # 原图片槽位编号（与输出端口顺序一致，空槽位不参与匹配但占编号）
+                        with self.io_lock: self.runtime_memory[f"{(data.get('result_var') or 'race').strip()}_index"] = slot
+                        self.log(f"🏁 竞速命中: 图{slot}", "success")
+                        return imgs[winner]['id']
+                if time.time() - start_time > timeout_val: return 'timeout'
+                if not self._smart_wait(0.1): return '__STOP__'
+            return '__STOP__'
         return 'out'
 
 # --- 5. 历史记录与节点 ---
@@ -1097,12 +2763,7 @@ class GraphNode:
         self.title_text, self.header_color = cfg.get('title', ntype), cfg.get('color', COLORS['bg_header'])
         if '_user_title' not in self.data: self.data['_user_title'] = self.title_text
         
-        self.outputs = cfg.get('outputs', [])
-        if ntype == 'sequence': 
-            self.outputs = [str(i) for i in range(1, safe_int(self.data.get('num_steps', 3)) + 1)] + ['else']
-        elif ntype == 'var_switch':
-            if self.data.get('var_name'): self.outputs = ['yes', 'no']
-            else: self.outputs = [c['id'] for c in self.data.get('cases', [])] + ['else']
+        self.outputs = node_outputs(ntype, self.data)
 
         self.w = NODE_WIDTH
         self.h = 100 
@@ -1115,12 +2776,13 @@ class GraphNode:
         z = self.canvas.zoom
         vx, vy, vw = self.x*z, self.y*z, self.w*z
         self.canvas.delete(f"node_{self.id}")
+        if self.type == 'race': self.outputs = node_outputs(self.type, self.data)
         
         ports_h = max(1, len(self.outputs)) * PORT_STEP_Y
         widgets_h = 0
         self.has_widgets = False
         
-        self.is_visual_node = self.type in ['image', 'if_img', 'if_static']
+        self.is_visual_node = self.type in ['image', 'if_img', 'if_static', 'race']
         self.is_app_node = self.type == 'open_app'
         self.is_bind_win_node = self.type == 'bind_win'
         
@@ -1130,7 +2792,7 @@ class GraphNode:
         img_display_h = 0; toolbar_h = 0
         if self.is_visual_node:
             toolbar_h = 38 
-            if self.type == 'if_img' and self.data.get('images'):
+            if self.type in ('if_img', 'race') and self.data.get('images'):
                 img_list = self.data.get('images', [])
                 if len(img_list) > 0:
                     rows = math.ceil(len(img_list) / 2.0); img_display_h = (rows * 60) + 10 
@@ -1170,6 +2832,8 @@ class GraphNode:
         port_labels = PORT_TRANSLATION.copy()
         if self.type == 'var_switch':
              for c in self.data.get('cases', []): port_labels[c['id']] = f"={c['value']}"
+        elif self.type == 'race':
+             for i, img in enumerate(self.data.get('images', []), 1): port_labels[img['id']] = f"图{i}"
 
         for i, name in enumerate(self.outputs):
             py = self.get_output_port_y(i, visual=True)
@@ -1193,7 +2857,7 @@ class GraphNode:
             self.widgets.append(self.canvas.create_window(vx + vw/2, toolbar_y, window=tool_frame, width=vw-10*z, height=26*z, anchor='n', tags=self.tags))
             
             img_start_y = toolbar_y + 32*z 
-            if self.type == 'if_img' and self.data.get('images'):
+            if self.type in ('if_img', 'race') and self.data.get('images'):
                 imgs = self.data.get('images', []); cell_w = (vw - 12*z) / 2; cell_h = 55 * z
                 for idx, item in enumerate(imgs):
                     if not item.get('image'): continue
@@ -1300,7 +2964,7 @@ class GraphNode:
 class FlowEditor(tk.Canvas):
     def __init__(self,parent,app,**kwargs):
         super().__init__(parent,bg=COLORS['bg_canvas'],highlightthickness=0,**kwargs)
-        self.app,self.nodes,self.links=app,{},[]
+        self.app,self.nodes,self.links,self.link_index=app,{},[],LinkIndex()
         self.selected_node_ids = set(); self.drag_data = {"type": None}; self.wire_start = None; self.temp_wire = None; self.selection_box = None
         self.history = HistoryManager(self); self.zoom=1.0; self.bind_events(); self.full_redraw()
         
@@ -1342,7 +3006,7 @@ class FlowEditor(tk.Canvas):
     
     def delete_node(self,node_id):
         if node_id in self.nodes:
-            self.links = [l for l in self.links if l['source'] != node_id and l['target'] != node_id]
+            self._set_links([l for l in self.links if l['source'] != node_id and l['target'] != node_id])
             self.nodes[node_id].clear_widgets(); self.delete(f"node_{node_id}"); del self.nodes[node_id]; self.redraw_links()
 
     def on_scroll(self, e):
@@ -1376,7 +3040,7 @@ class FlowEditor(tk.Canvas):
             self.drag_data["dragged"] = True; dx = vx - self.drag_data["last_vx"]; dy = vy - self.drag_data["last_vy"]; self.drag_data["last_vx"] = vx; self.drag_data["last_vy"] = vy
             for nid in self.selected_node_ids:
                 if nid in self.nodes: node = self.nodes[nid]; node.x += dx / self.zoom; node.y += dy / self.zoom; node.update_position(dx, dy)
-            self.redraw_links()
+            self.redraw_links(self.selected_node_ids)
         elif self.drag_data["type"]=="box_select":
             if self.selection_box: self.coords(self.selection_box, self.drag_data["start_vx"], self.drag_data["start_vy"], vx, vy)
         elif self.drag_data["type"]=="wire":
@@ -1407,7 +3071,7 @@ class FlowEditor(tk.Canvas):
                 dist = math.hypot(lx-(node.x+15 if is_reroute else node.x), ly-node.get_input_port_y(visual=False))
                 if node.id!=self.wire_start['node'].id and dist < (45/self.zoom):
                     if node.type=='start': continue
-                    self.history.save_state(); self.links.append({'id':str(uuid.uuid4()),'source':self.wire_start['node'].id,'source_port':self.wire_start['port'],'target':node.id}); self.redraw_links(); break
+                    self.history.save_state(); self._add_link({'id':str(uuid.uuid4()),'source':self.wire_start['node'].id,'source_port':self.wire_start['port'],'target':node.id}); self.redraw_links(); break
         self.drag_data,self.wire_start,self.temp_wire={"type":None},None,None
     
     def select_node(self, node_id, add=False):
@@ -1423,9 +3087,16 @@ class FlowEditor(tk.Canvas):
         color = COLORS['wire_hl'] if highlighted else COLORS['wire_active' if state=="active" else 'wire']
         return self.create_line(x1,y1,x1+offset,y1,x2-offset,y2,x2,y2,smooth=True,splinesteps=50,fill=color,width=width,arrow=tk.NONE,tags=("link",)+((f"link_{link_id}",) if link_id else ()))
     
-    def redraw_links(self):
-        self.delete("link"); 
-        for l in self.links:
+    def _add_link(self, link): self.links.append(link); self.link_index.add(link)
+    def _set_links(self, links): self.links = links; self.link_index = LinkIndex(links)
+
+    def redraw_links(self, node_ids=None):
+        """重绘连线；传入 node_ids 时经邻接索引只重绘与这些节点相连的连线（拖动节点时）"""
+        if node_ids is None: self.delete("link"); links = self.links
+        else:
+            links = list({id(l): l for nid in node_ids for l in self.link_index.links_of(nid)}.values())
+            for l in links: self.delete(f"link_{l['id']}")
+        for l in links:
             if l['source'] in self.nodes and l['target'] in self.nodes:
                 n1,n2=self.nodes[l['source']],self.nodes[l['target']]
                 x1 = (n1.x + n1.w)*self.zoom if n1.type != 'reroute' else (n1.x + 15)*self.zoom
@@ -1441,14 +3112,14 @@ class FlowEditor(tk.Canvas):
             tags=self.gettags(item)
             if (nid:=next((t[5:] for t in tags if t.startswith("node_")),None)):
                 if "port_out" in tags: 
-                     self.history.save_state(); self.links=[l for l in self.links if not (l['source']==nid and l.get('source_port')==next((t for t in tags if t in self.nodes[nid].outputs),'out'))]; self.redraw_links(); return
+                     self.history.save_state(); self._set_links([l for l in self.links if not (l['source']==nid and l.get('source_port')==next((t for t in tags if t in self.nodes[nid].outputs),'out'))]); self.redraw_links(); return
                 if "port_in" in tags: 
-                     self.history.save_state(); self.links=[l for l in self.links if not l['target']==nid]; self.redraw_links(); return
+                     self.history.save_state(); self._set_links([l for l in self.links if not l['target']==nid]); self.redraw_links(); return
         lx, ly = self.get_logical_pos(event.x, event.y); node = next((n for n in reversed(list(self.nodes.values())) if n.contains(lx, ly)), None)
         m=tk.Menu(self,tearoff=0,bg=COLORS['bg_card'],fg=COLORS['fg_text'],font=('Microsoft YaHei', int(9 * SCALE_FACTOR)))
         if node:
             m.add_command(label="📥 复制",command=lambda: (self.history.save_state(), self.add_node(node.type, node.x+20, node.y+20, data=copy.deepcopy(node.data), save_history=False)))
-            m.add_command(label="🔴 断点",command=lambda: setattr(node, 'has_breakpoint', not node.has_breakpoint) or node.draw())
+            m.add_command(label="🔴 断点",command=lambda: self.toggle_breakpoint(node))
             m.add_separator()
             m.add_command(label="❌ 删除",command=lambda: (self.history.save_state(), self.delete_node(node.id)),foreground=COLORS['danger'])
         else:
@@ -1466,13 +3137,17 @@ class FlowEditor(tk.Canvas):
         if isinstance(data, dict):
             new_dict = {}
             for k, v in data.items():
-                if k in ['image', 'tk_image', 'roi_preview', '_tk_cache']: continue 
+                if k in ['image', 'tk_image', 'roi_preview', '_tk_cache', '_needle_cache']: continue 
                 if isinstance(v, (Image.Image, ImageTk.PhotoImage)): continue
                 new_dict[k] = self.sanitize_data_for_json(v)
             return new_dict
         elif isinstance(data, list): return [self.sanitize_data_for_json(item) for item in data]
         else: return data
 
+    def toggle_breakpoint(self, node):
+        node.has_breakpoint = not node.has_breakpoint; node.draw()
+        if self.app.core.running: self.app.core.set_breakpoint(node.id, node.has_breakpoint)
+
     def get_data(self):
         nodes_d = {}
         for nid, n in self.nodes.items():
@@ -1481,10 +3156,10 @@ class FlowEditor(tk.Canvas):
             if 'roi_preview' in n.data and 'b64_preview' not in clean_data: clean_data['b64_preview'] = ImageUtils.img_to_b64(n.data['roi_preview'])
             nodes_d[nid]={'id':nid,'type':n.type,'x':int(n.x),'y':int(n.y),'data':clean_data, 'breakpoint': n.has_breakpoint}
         breakpoints = [nid for nid, n in self.nodes.items() if n.has_breakpoint]
-        return {'nodes':nodes_d, 'links':self.links, 'breakpoints': breakpoints, 'metadata':{'dev_scale_x':SCALE_X,'dev_scale_y':SCALE_Y}}
+        return {'nodes':nodes_d, 'links':list(self.links), 'breakpoints': breakpoints, 'metadata':{'dev_scale_x':SCALE_X,'dev_scale_y':SCALE_Y}}
 
     def load_data(self,data):
-        self.delete("all");self.nodes.clear();self.links.clear()
+        self.delete("all");self.nodes.clear();self._set_links([])
         try:
             self.app.core.load_project(data)
             breakpoints = set(data.get('breakpoints', []))
@@ -1504,7 +3179,7 @@ class FlowEditor(tk.Canvas):
                 
                 n = self.add_node(n_data['type'],n_data['x'],n_data['y'],data=d,node_id=nid, save_history=False)
                 if n_data.get('breakpoint', False) or nid in breakpoints: n.has_breakpoint = True; n.draw()
-            self.links=data.get('links',[])
+            self._set_links(data.get('links',[]))
             self.full_redraw()
         except Exception as e: self.app.log(f"❌ 加载失败: {e}", "error")
 
@@ -1625,10 +3300,11 @@ class PropertyPanel(tk.Frame):
             sec = self._create_section("鼠标操作")
             
             # [显式坐标模式] 允许用户自主选择相对或绝对
-            COORD_MODES = {'relative': '相对绑定窗口 (推荐)', 'absolute': '绝对屏幕坐标'}
+            COORD_MODES = {'relative': '相对绑定窗口 (推荐)', 'absolute': '绝对屏幕坐标', 'tracked': '相对跟踪目标'}
             curr_mode = data.get('coord_mode', 'relative')
             self._combo(sec, "坐标模式", 'coord_mode', list(COORD_MODES.values()), COORD_MODES.get(curr_mode, '相对绑定窗口 (推荐)'), 
                         lambda e: self._save('coord_mode', {v:k for k,v in COORD_MODES.items()}.get(e.widget.get()), self.current_node, refresh_ui=True))
+            if curr_mode == 'tracked': self._input(sec, "跟踪名称(坐标为相对点击点的偏移)", 'track_name', data.get('track_name', 'target'))
             
             def on_action_change(e):
                 val = {v:k for k,v in MOUSE_ACTIONS.items()}.get(e.widget.get())
@@ -1693,6 +3369,25 @@ class PropertyPanel(tk.Frame):
             curr_strat = data.get('match_strategy', 'hybrid')
             self._combo(search, "算法", 'match_strategy', list(MATCH_STRATEGY_MAP.values()), MATCH_STRATEGY_MAP.get(curr_strat, '智能混合'), lambda e: self._save('match_strategy', {v:k for k,v in MATCH_STRATEGY_MAP.items()}.get(e.widget.get()), self.current_node, refresh_ui=True))
 
+            self._chk(search, "自定义匹配流水线(替代上方算法)", 'use_pipeline', data.get('use_pipeline', False))
+            if data.get('use_pipeline', False): self._pipeline_editor(search, data)
+            self._chk(search, "记忆命中位置优先查找", 'learn_prior', data.get('learn_prior', True))
+            self._chk(search, "主色预筛选(目标颜色固定时启用)", 'prescreen', data.get('prescreen', False))
+            if data.get('needle_patch'): self._chk(search, "特征子块优先匹配(大模板提速)", 'use_patch', data.get('use_patch', False))
+            if data.get('capture_dpi'): self._chk(search, f"按显示器DPI精确缩放(截图时 {int(safe_float(data['capture_dpi']) * 100)}%)", 'dpi_exact', data.get('dpi_exact', False))
+            if (prior := data.get('match_prior')):
+                tk.Label(search, text=f"📍 上次命中 ({prior.get('x')}, {prior.get('y')}) 缩放 {prior.get('scale', 1.0)} · 累计 {prior.get('hits', 0)} 次", bg=search.cget('bg'), fg=COLORS['fg_sub'], font=('Microsoft YaHei', int(8 * SCALE_FACTOR))).pack(anchor='w')
+                self._btn(search, "🧹 清除位置记忆", lambda: self._save('match_prior', None, self.current_node, refresh_ui=True))
+            self._chk(search, "查找全部匹配", 'find_all', data.get('find_all', False))
+            if data.get('find_all', False):
+                self._input(search, "结果变量前缀", 'result_var', data.get('result_var', 'found'))
+                self._input(search, "最多数量", 'max_results', data.get('max_results', 100), safe_int)
+                self._chk(search, "对每个结果都执行动作(默认只第一个)", 'click_all', data.get('click_all', False))
+            else:
+                self._chk(search, "找到后持续跟踪目标", 'track', data.get('track', False))
+                if data.get('track', False):
+                    self._input(search, "跟踪名称(变量前缀)", 'track_name', data.get('track_name', 'target'))
+                    self._input(search, "搜索窗口(目标尺寸倍数)", 'track_expand', data.get('track_expand', 1.0), safe_float)
             self._chk(search, "未找到时尝试滚动", 'auto_scroll', data.get('auto_scroll', False))
             if data.get('auto_scroll', False):
                 self._input(search, "滚动量(负数向下)", 'scroll_amount', data.get('scroll_amount', -500), safe_int)
@@ -1719,6 +3414,26 @@ class PropertyPanel(tk.Frame):
                 self._btn(sec, "🗑️ 清空所有图片", clear_imgs, bg=COLORS['danger'])
             param = self._create_section("匹配参数")
             self._input(param, "相似度(0.1-1.0)", 'confidence', data.get('confidence', 0.9), safe_float)
+            self._chk(param, "主色预筛选(目标颜色固定时启用)", 'prescreen', data.get('prescreen', False))
+            if any(img.get('capture_dpi') for img in imgs): self._chk(param, "按显示器DPI精确缩放", 'dpi_exact', data.get('dpi_exact', False))
+            self._btn(param, "⚡ 测试当前屏幕匹配", self.start_test_match)
+
+        elif ntype == 'race':
+            sec = self._create_section("竞速候选图")
+            imgs = data.get('images', [])
+            tk.Label(sec, text=f"📚 候选图: {len(imgs)} 张（每张对应一个输出端口，先出现者胜出）", bg=sec.cget('bg'), fg=COLORS['fg_text'], font=('Microsoft YaHei', int(9 * SCALE_FACTOR)), wraplength=int(220 * SCALE_FACTOR), justify='left').pack(anchor='w', pady=(0, 5))
+            self._btn(sec, "📸 截取并添加候选图", self.app.do_snip, bg=COLORS['accent'])
+            if imgs:
+                def clear_imgs():
+                    if messagebox.askyesno("确认清空", "确定要删除所有候选图片吗？对应端口的连线将失效。"):
+                        self._save('images', [], self.current_node, refresh_ui=True)
+                self._btn(sec, "🗑️ 清空所有图片", clear_imgs, bg=COLORS['danger'])
+            param = self._create_section("匹配参数")
+            self._input(param, "相似度(0.1-1.0)", 'confidence', data.get('confidence', 0.9), safe_float)
+            self._input(param, "超时(s)", 'timeout', data.get('timeout', 10.0), safe_float)
+            self._input(param, "结果变量前缀", 'result_var', data.get('result_var', 'race'))
+            self._chk(param, "主色预筛选(目标颜色固定时启用)", 'prescreen', data.get('prescreen', False))
+            if any(img.get('capture_dpi') for img in imgs): self._chk(param, "按显示器DPI精确缩放", 'dpi_exact', data.get('dpi_exact', False))
             self._btn(param, "⚡ 测试当前屏幕匹配", self.start_test_match)
 
         elif ntype == 'if_static':
@@ -1741,6 +3456,7 @@ class PropertyPanel(tk.Frame):
              self._input(param_sec, "静止持续(s)", 'duration', data.get('duration', 5.0), safe_float)
              self._input(param_sec, "最大超时(s)", 'timeout', data.get('timeout', 20.0), safe_float)
              self._input(param_sec, "灵敏度(0-1)", 'threshold', data.get('threshold', 0.98), safe_float)
+             self._input(param_sec, "降采样倍数", 'downsample', data.get('downsample', 1), safe_int)
              monitor_frame = self._create_section("实时测试")
              self.lbl_monitor_status = tk.Label(monitor_frame, text="等待启动...", bg=monitor_frame.cget('bg'), fg=COLORS['fg_sub'], font=('Consolas', 10))
              self.lbl_monitor_status.pack(fill='x', pady=5)
@@ -1835,6 +3551,26 @@ class PropertyPanel(tk.Frame):
             if (path := filedialog.askopenfilename(filetypes=[("Executable", "*.exe"), ("All", "*.*")])): self._save(key, path, target_node, refresh_ui=True)
         lbl_display.bind("<Button-1>", lambda e: pick()); input_container.bind("<Button-1>", lambda e: pick()); self._btn_icon(f, "📂", pick)
         
+    def _pipeline_editor(self, parent, data):
+        """匹配流水线编辑：每个阶段一行（启用 / 时间预算 ms / 上移），自上而下即执行顺序"""
+        target_node, bg = self.current_node, parent.cget('bg')
+        steps = copy.deepcopy(data.get('pipeline') or DEFAULT_PIPELINE)
+        steps += [{'stage': k, 'enabled': False, 'budget': 500} for k in MATCH_STAGE_MAP if k not in {st.get('stage') for st in steps}]
+        def commit(refresh): self._save('pipeline', copy.deepcopy(steps), target_node, refresh_ui=refresh)
+        for i, step in enumerate(steps):
+            row = tk.Frame(parent, bg=bg); row.pack(fill='x', pady=1)
+            var, budget = tk.BooleanVar(value=step.get('enabled', True)), tk.StringVar(value=str(step.get('budget', 0)))
+            def toggle(st=step, v=var): st['enabled'] = v.get(); commit(True)
+            def move_up(i=i): steps[i - 1], steps[i] = steps[i], steps[i - 1]; commit(True)
+            def on_budget(*_, st=step, v=budget): st['budget'] = max(0, safe_int(v.get(), 0)); commit(False)
+            tk.Checkbutton(row, text=f"{i + 1}. {MATCH_STAGE_MAP.get(step.get('stage'), step.get('stage'))}", variable=var, command=toggle, bg=bg, fg='white', selectcolor=COLORS['bg_app'], activebackground=bg, borderwidth=0, highlightthickness=0).pack(side='left')
+            if i: self._btn_icon(row, "↑", move_up, width=2)
+            tk.Label(row, text="ms", bg=bg, fg=COLORS['fg_sub'], font=('Microsoft YaHei', int(8 * SCALE_FACTOR))).pack(side='right')
+            budget.trace_add("write", on_budget)
+            e = tk.Entry(row, textvariable=budget, width=6, bg=COLORS['input_bg'], fg='white', bd=0, insertbackground='white', font=('Microsoft YaHei', int(9 * SCALE_FACTOR)))
+            e.pack(side='right', padx=2, ipady=1); e.bind("<Return>", lambda ev: self.app.editor.focus_set())
+        tk.Label(parent, text="预算为 0 表示不限；未命中时的耗时不超过已启用阶段的预算之和", bg=bg, fg=COLORS['fg_sub'], font=('Microsoft YaHei', int(8 * SCALE_FACTOR)), wraplength=int(220 * SCALE_FACTOR), justify='left').pack(anchor='w')
+
     def _compact_input(self, parent, label, key, val, vfunc=None):
         target_node = self.current_node
         tk.Label(parent, text=label, bg=parent.cget('bg'), fg=COLORS['fg_text'], font=('Microsoft YaHei', int(9 * SCALE_FACTOR))).pack(side='left', padx=(5,2))
@@ -1915,10 +3651,15 @@ class PropertyPanel(tk.Frame):
         self.app.iconify(); time.sleep(0.5); res_txt = "未找到"
         try:
             if self.current_node.type == 'if_img':
-                imgs = self.current_node.data.get('images', []); passed = True; screen = VisionEngine.capture_screen()
-                for img in imgs:
-                    if not VisionEngine._advanced_match(img.get('image'), screen, 0.8, None, True, True, 1.0, 'hybrid')[0]: passed = False; break
+                imgs = self.current_node.data.get('images', []); screen = VisionEngine.capture_screen()
+                passed = all(r for r, _ in VisionEngine.match_batch([img.get('image') for img in imgs], screen, 0.8, require_all=True))
                 res_txt = "✅ 全部满足" if passed else "❌ 条件不满足"
+            elif self.current_node.type == 'race':
+                results = VisionEngine.match_batch([img.get('image') for img in self.current_node.data.get('images', [])], VisionEngine.capture_screen(), 0.8, first_hit=True)
+                res_txt = f"✅ 图{winner + 1} 先命中" if (winner := next((i for i, (r, _) in enumerate(results) if r), None)) is not None else "❌ 均未出现"
+            elif self.current_node.data.get('find_all', False):
+                 hits = VisionEngine.locate_all(self.current_node.data.get('image'), confidence=0.8, max_results=max(1, safe_int(self.current_node.data.get('max_results', 100), 100)))
+                 res_txt = f"✅ 找到 {len(hits)} 处" if hits else "❌ 未找到"
             else:
                  strategy = self.current_node.data.get('match_strategy', 'hybrid')
                  res = VisionEngine.locate(self.current_node.data.get('image'), confidence=0.8, strategy=strategy)
@@ -1940,9 +3681,9 @@ class PropertyPanel(tk.Frame):
         roi = self.current_node.data.get('roi')
         thr = safe_float(self.current_node.data.get('threshold', 0.98))
         dur = safe_float(self.current_node.data.get('duration', 5.0))
-        
-        if self.context['window_handle'] and self.context['window_rect']:
-             win_offset_x, win_offset_y = self.context['window_offset']
+        ctx = self.app.core.context
+        if ctx['window_handle'] and ctx['window_rect']:
+             win_offset_x, win_offset_y = ctx['window_offset']
              abs_x = roi[0] + win_offset_x
              abs_y = roi[1] + win_offset_y
         else:
@@ -1950,18 +3691,18 @@ class PropertyPanel(tk.Frame):
              abs_y = roi[1]
              
         target_bbox = (abs_x, abs_y, abs_x + roi[2], abs_y + roi[3])
-        last_frame = VisionEngine.capture_screen(bbox=target_bbox)
+        detector = StaticDetector(thr, safe_int(self.current_node.data.get('downsample', 1), 1))
+        detector.reset(VisionEngine.capture_array(bbox=target_bbox))
         
         static_start = time.time()
         while self.static_monitor_active and self.current_node and self.current_node.type == 'if_static':
-            curr = VisionEngine.capture_screen(bbox=target_bbox)
-            is_static = VisionEngine.compare_images(last_frame, curr, thr)
+            is_static = detector.check(VisionEngine.capture_array(bbox=target_bbox))
             elapsed = time.time() - static_start if is_static else 0
             if self.lbl_monitor_status.winfo_exists():
-                txt = f"{'🟢 静止' if is_static else '🌊 运动'} | {elapsed:.1f}s / {dur}s"
+                txt = f"{'🟢 静止' if is_static else '🌊 运动'} | {elapsed:.1f}s / {dur}s | 变化 {detector.motion:.1%}"
                 color = COLORS['success'] if elapsed >= dur else (COLORS['fg_text'] if is_static else COLORS['warning'])
                 self.app.after(0, lambda t=txt, c=color: self.lbl_monitor_status.config(text=t, fg=c))
-            if not is_static: static_start = time.time(); last_frame = curr
+            if not is_static: static_start = time.time()
             time.sleep(0.1)
         self.static_monitor_active = False
 
@@ -1980,7 +3721,7 @@ class PropertyPanel(tk.Frame):
 class SettingsDialog(tk.Toplevel):
     def __init__(self, parent, app):
         super().__init__(parent); self.app = app
-        self.title("设置"); self.geometry("400x300"); self.config(bg=COLORS['bg_panel'])
+        self.title("设置"); self.geometry("400x490"); self.config(bg=COLORS['bg_panel'])
         self.resizable(False, False); self.transient(parent); self.grab_set()
         self.app.stop_hotkeys()
         self.protocol("WM_DELETE_WINDOW", self.on_cancel)
@@ -1996,6 +3737,29 @@ class SettingsDialog(tk.Toplevel):
         self._create_hotkey_entry(f_hk, "停止快捷键:", 'stop', 1)
         f_hk.columnconfigure(1, weight=1)
 
+        f_vision = tk.Frame(self, bg=COLORS['bg_panel'], pady=10, padx=20); f_vision.pack(fill='x')
+        tk.Label(f_vision, text="找图并行线程:", bg=COLORS['bg_panel'], fg=COLORS['fg_text']).pack(side='left')
+        self.match_threads_var = tk.StringVar(value=str(SETTINGS.get('match_threads', 1)))
+        tk.Spinbox(f_vision, from_=1, to=32, textvariable=self.match_threads_var, width=6, bg=COLORS['input_bg'], fg='white', buttonbackground=COLORS['btn_bg']).pack(side='right', padx=10)
+
+        f_procs = tk.Frame(self, bg=COLORS['bg_panel'], pady=10, padx=20); f_procs.pack(fill='x')
+        tk.Label(f_procs, text="视觉进程数(0关闭):", bg=COLORS['bg_panel'], fg=COLORS['fg_text']).pack(side='left')
+        self.vision_procs_var = tk.StringVar(value=str(SETTINGS.get('vision_processes', 0)))
+        tk.Spinbox(f_procs, from_=0, to=32, textvariable=self.vision_procs_var, width=6, bg=COLORS['input_bg'], fg='white', buttonbackground=COLORS['btn_bg']).pack(side='right', padx=10)
+
+        f_cap = tk.Frame(self, bg=COLORS['bg_panel'], pady=10, padx=20); f_cap.pack(fill='x')
+        tk.Label(f_cap, text="截图后端:", bg=COLORS['bg_panel'], fg=COLORS['fg_text']).grid(row=0, column=0, sticky='w', pady=5)
+        self.combo_backend = ttk.Combobox(f_cap, values=list(CAPTURE_BACKEND_MAP.values()), state='readonly'); self.combo_backend.set(CAPTURE_BACKEND_MAP.get(SETTINGS.get('capture_backend', 'pil'), 'PIL ImageGrab')); self.combo_backend.grid(row=0, column=1, sticky='ew', padx=10)
+        tk.Label(f_cap, text="回放源:", bg=COLORS['bg_panel'], fg=COLORS['fg_text']).grid(row=1, column=0, sticky='w', pady=5)
+        self.capture_source_var = tk.StringVar(value=SETTINGS.get('capture_source', ''))
+        tk.Entry(f_cap, textvariable=self.capture_source_var, bg=COLORS['input_bg'], fg='white', insertbackground='white').grid(row=1, column=1, sticky='ew', padx=10)
+        tk.Button(f_cap, text="...", command=self._browse_source, bg=COLORS['btn_bg'], fg='white', bd=0, padx=6).grid(row=1, column=2)
+        f_cap.columnconfigure(1, weight=1)
+
+        f_tpl = tk.Frame(self, bg=COLORS['bg_panel'], padx=20); f_tpl.pack(fill='x')
+        self.template_optimize_var = tk.BooleanVar(value=SETTINGS.get('template_optimize', True))
+        tk.Checkbutton(f_tpl, text="截图时自动优化模板(裁边/信息量检查)", variable=self.template_optimize_var, bg=COLORS['bg_panel'], fg=COLORS['fg_text'], selectcolor=COLORS['bg_app'], activebackground=COLORS['bg_panel']).pack(side='left')
+
         btn_frame = tk.Frame(self, bg=COLORS['bg_panel'], pady=20); btn_frame.pack(side='bottom', fill='x')
         tk.Button(btn_frame, text="保存并重启UI", command=self.save, bg=COLORS['accent'], fg='white', bd=0, padx=20).pack(side='right', padx=20)
         tk.Button(btn_frame, text="取消", command=self.on_cancel, bg=COLORS['btn_bg'], fg='white', bd=0, padx=20).pack(side='right')
@@ -2028,9 +3792,16 @@ class SettingsDialog(tk.Toplevel):
         parts.append(sym)
         self.hk_vars[key].set("+".join(parts)); return "break" 
     
+    def _browse_source(self):
+        path = filedialog.askdirectory(parent=self, title="选择回放图片目录") or filedialog.askopenfilename(parent=self, title="选择回放视频", filetypes=[("Video", "*.mp4;*.avi;*.mkv"), ("All", "*.*")])
+        if path: self.capture_source_var.set(path)
+
     def on_cancel(self): self.app.refresh_hotkeys(); self.destroy()
     def save(self):
         SETTINGS['theme'] = self.combo_theme.get(); SETTINGS['hotkey_start'] = self.hk_vars['start'].get(); SETTINGS['hotkey_stop'] = self.hk_vars['stop'].get()
+        SETTINGS['match_threads'] = max(1, safe_int(self.match_threads_var.get(), 1)); SETTINGS['vision_processes'] = max(0, safe_int(self.vision_procs_var.get(), 0))
+        SETTINGS['capture_backend'] = {v: k for k, v in CAPTURE_BACKEND_MAP.items()}.get(self.combo_backend.get(), 'pil'); SETTINGS['capture_source'] = self.capture_source_var.get().strip()
+        SETTINGS['template_optimize'] = bool(self.template_optimize_var.get())
         COLORS.update(THEMES.get(SETTINGS['theme'], THEMES['Dark'])); self.app.refresh_hotkeys(); self.app.restart_ui(); self.destroy()
 
 # --- 8. 主程序 ---
@@ -2071,7 +3842,7 @@ class App(tk.Tk):
         tk.Label(title_bar, text="QFLOW", font=('Impact', 24), bg=COLORS['bg_app'], fg=COLORS['accent']).pack(side='left', padx=(0, 20))
         
         ops = tk.Frame(title_bar, bg=COLORS['bg_app']); ops.pack(side='left')
-        for txt, cmd in [("📂 打开", self.load), ("💾 保存", self.save), ("📝 另存", self.save_as), ("🗑️ 清空", self.clear), ("⚙️ 设置", self.open_settings)]:
+        for txt, cmd in [("📂 打开", self.load), ("💾 保存", self.save), ("📝 另存", self.save_as), ("🗑️ 清空", self.clear), ("🧹 优化模板", self.optimize_templates), ("⚙️ 设置", self.open_settings)]:
             tk.Button(ops, text=txt, command=cmd, bg=COLORS['bg_header'], fg='white', bd=0, padx=10, cursor='hand2', font=('Microsoft YaHei', 9)).pack(side='left', padx=2)
             
         self.btn_run = tk.Button(title_bar, text="▶ 启动", command=lambda: self.toggle_run(None), bg=COLORS['success'], fg='#1f1f1f', font=('Microsoft YaHei', 11, 'bold'), padx=15, bd=0, cursor='hand2'); self.btn_run.pack(side='right')
@@ -2117,7 +3888,7 @@ class App(tk.Tk):
             ("应用控制", ['open_app', 'bind_win', 'cmd', 'web']),
             ("逻辑组件", ['start', 'end', 'loop', 'sequence', 'set_var', 'var_switch', 'clipboard', 'notify']),
             ("动作执行", ['mouse', 'keyboard', 'wait']),
-            ("视觉/感知", ['image', 'if_img', 'if_static', 'if_sound'])
+            ("视觉/感知", ['image', 'if_img', 'race', 'if_static', 'if_sound'])
         ]
         
         for title, items in tool_groups:
@@ -2180,17 +3951,23 @@ class App(tk.Tk):
             img = ImageGrab.grab(bbox=(x1, y1, x2, y2), all_screens=True)
             self.deiconify()
             
+            dpi = monitor_at((x1 + x2) // 2, (y1 + y2) // 2).scale  # 模板所在显示器的 DPI 缩放，运行时据此换算精确尺度
             if (n := self.property_panel.current_node): 
-                if n.type == 'if_img': 
-                    n.data.setdefault('images', []).append({'id': uuid.uuid4().hex, 'image': img, 'tk_image': ImageUtils.make_thumb(img), 'b64': ImageUtils.img_to_b64(img)})
+                if n.type in ('if_img', 'race'): 
+                    if SETTINGS.get('template_optimize', True): img, _ = self._optimize_needle(img, n.data)
+                    n.data.setdefault('images', []).append({'id': uuid.uuid4().hex, 'image': img, 'tk_image': ImageUtils.make_thumb(img), 'b64': ImageUtils.img_to_b64(img), 'capture_dpi': dpi})
                 elif n.type == 'if_static':
                     n.update_data('roi', (x1, y1, x2-x1, y2-y1))
                     n.data['roi_preview'] = img 
                     n.data['b64_preview'] = ImageUtils.img_to_b64(img)
                     n.draw()
                 else: 
+                    opt = {k: v for k, v in n.data.items() if k in ('relative_click_pos', 'offset_x', 'offset_y')}
+                    if SETTINGS.get('template_optimize', True): img, _ = self._optimize_needle(img, opt, adjust_click=True)
                     n.update_data('image', img); n.update_data('tk_image', ImageUtils.make_thumb(img)); n.update_data('b64', ImageUtils.img_to_b64(img))
-                n.draw() 
+                    n.data.pop('match_prior', None); n.data.pop('needle_patch', None)  # 新模板的命中位置与子块需重新计算
+                    n.data.update(opt, capture_dpi=dpi)
+                n.draw(); self.editor.redraw_links()
                 self.property_panel.load_node(n)
             self.log(f"🖼️ 截取成功 ({x1},{y1})", "success")
             
@@ -2198,6 +3975,41 @@ class App(tk.Tk):
             self.deiconify()
             self.log(f"截图失败: {e}", "error")
 
+    def _optimize_needle(self, img, data, adjust_click=False):
+        """对截取的模板执行 ImageUtils.optimize_template：裁边后修正偏移使点击位置不变，记录特征子块，信息量过低时给出警告"""
+        new_img, info = ImageUtils.optimize_template(img)
+        if not info: return img, None
+        l, t, r, b = info['crop']; (W, H), (cw, ch) = img.size, info['size']
+        if adjust_click and any(info['crop']):
+            rx, ry = data.get('relative_click_pos', (0.5, 0.5))
+            data['offset_x'] = int(round(safe_int(data.get('offset_x', 0)) + W * rx - l - cw * rx))
+            data['offset_y'] = int(round(safe_int(data.get('offset_y', 0)) + H * ry - t - ch * ry))
+        if adjust_click and info['patch']: data['needle_patch'] = info['patch']
+        if any(info['crop']): self.log(f"✂️ 模板已裁掉均匀边框 {W}x{H} → {cw}x{ch}", "info")
+        if info['low_entropy']: self.log(f"⚠️ 模板信息量过低 (熵 {info['entropy']} bit)，容易误匹配，建议截取更有特征的区域", "warning")
+        return new_img, info
+
+    def optimize_templates(self):
+        """批量优化当前工程中已有的找图模板（image 节点与 if_img / race 图片列表），可撤销"""
+        targets = [n for n in self.editor.nodes.values() if (n.type == 'image' and isinstance(n.data.get('image'), Image.Image)) or (n.type in ('if_img', 'race') and n.data.get('images'))]
+        if not targets: self.log("没有可优化的模板", "warning"); return
+        self.editor.history.save_state(); cropped = low = 0
+        for n in targets:
+            if n.type == 'image':
+                img, info = self._optimize_needle(n.data['image'], n.data, adjust_click=True)
+                if info and any(info['crop']):
+                    cropped += 1; n.data.pop('match_prior', None)
+                    n.data.update(image=img, tk_image=ImageUtils.make_thumb(img), b64=ImageUtils.img_to_b64(img))
+                low += bool(info and info['low_entropy'])
+            for item in n.data.get('images', []):
+                if not isinstance(item.get('image'), Image.Image): continue
+                img, info = self._optimize_needle(item['image'], n.data)
+                if info and any(info['crop']): cropped += 1; item.update(image=img, tk_image=ImageUtils.make_thumb(img), b64=ImageUtils.img_to_b64(img))
+                low += bool(info and info['low_entropy'])
+            n.draw()
+        if (cur := self.property_panel.current_node) in targets: self.property_panel.load_node(cur)
+        self.log(f"🧹 模板优化完成：检查 {len(targets)} 个节点，裁剪 {cropped} 张，低信息量 {low} 张", "success")
+
     def get_active_bind_window_info(self):
         """查找流程中配置的窗口绑定节点，若窗口处于打开状态，则返回句柄、边界矩形及标题"""
         for nid, node in self.editor.nodes.items():
@@ -2324,6 +4136,11 @@ class App(tk.Tk):
                 self.editor.create_rectangle(n.x * z - 3 * z, n.y * z - 3 * z, (n.x + n.w) * z + 3 * z, (n.y + n.h) * z + 3 * z, outline=color, width=3 * z, tags="hl")
         self.after(0, _task)
     def select_node_safe(self, nid): self.after(0, lambda: self.editor.select_node(nid))
+    def store_node_data_safe(self, nid, key, value):
+        """运行线程回写节点数据（不计入撤销历史、不重绘）"""
+        def _task():
+            if (n := self.editor.nodes.get(nid)): n.data[key] = value
+        self.after(0, _task)
     
     def save(self):
         if self.current_file_path:
@@ -2367,4 +4184,6 @@ class App(tk.Tk):
         self.log("4. 【右键菜单】右键点击 [节点] 可复制或删除；右键点击 [端口] 可清除连线。", "warning")
         self.log("5. 【运行控制】点击上方 [▶ 启动] 或使用快捷键 F9 (启动) / F10 (停止)。", "success")
 
-if __name__ == "__main__": App().mainloop()
\ No newline at end of file
+atexit.register(VisionEngine.shutdown)
+
+if __name__ == "__main__": multiprocessing.freeze_support(); App().mainloop()
\ No newline at end of file
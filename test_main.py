@@ -0,0 +1,62 @@
+"""
+Qflow 回归测试（无显示器的 Linux 上可运行：python -m pytest -q）
+"""
+from main import VarMemory, VarTemplate
+
+
+def render(text, **memory): return VarTemplate.of(text).render(VarMemory(memory))
+
+
+def test_brace_placeholders():
+    assert render('${a}/{b}', a=1, b='x') == '1/x'
+    assert render('{missing} ${missing}', a=1) == '{missing} ${missing}'
+
+
+def test_short_names_longest_first():
+    assert render('$ab $a $abc', a=1, ab=2) == '2 1 2c'
+    assert render('$my-var|$user.name|$first name', **{'my-var': 'X', 'user.name': 'bob', 'first name': 'F'}) == 'X|bob|F'
+    assert render('$none.', none=None) == '.'
+
+
+def test_short_names_inside_json():
+    assert render('{"k": "$v"}', v='X') == '{"k": "X"}'
+    assert render('{"a": {"b": "$v", "c": 1}}', v=2) == '{"a": {"b": "2", "c": 1}}'
+
+
+def test_short_names_inside_shell_braces():
+    assert render('echo {$name}', name='Bob') == 'echo {Bob}'
+    assert render('if (x) { echo $name; }', name='Bob') == 'if (x) { echo Bob; }'
+    assert render('${name:-$name}', name='Bob') == '${name:-Bob}'
+
+
+def test_short_regex_follows_variable_set():
+    memory = VarMemory(a=1)
+    template = VarTemplate.of('$a-b')
+    assert template.render(memory) == '1-b'
+    regex, version = memory.short_regex(), memory.version
+    memory['a'] = 5
+    assert memory.version == version and memory.short_regex() is regex
+    memory['a-b'] = 'long'
+    assert template.render(memory) == 'long'
+    memory.pop('a-b')
+    assert template.render(memory) == '5-b'
+
+
+def test_dirty_edge_roi_at_small_scale():
+    """缩放比 0.6 时贴着屏幕左边缘的小块变化：ROI 比原尺寸模板窄，但能放下实际搜索的 0.6 倍模板"""
+    import cv2
+    import numpy as np
+    from PIL import Image
+    from main import DirtyTileTracker, VisionEngine
+    rng = np.random.default_rng(3)
+    needle = rng.integers(0, 256, (300, 300, 3), np.uint8)
+    target = cv2.resize(needle, (180, 180), interpolation=cv2.INTER_AREA)
+    frame = rng.integers(0, 256, (1080, 1920, 3), np.uint8)
+    frame[400:580, 0:180] = target; frame[400:580, 0:20] = 0
+    cache = VisionEngine.prepare_needle(Image.fromarray(needle))
+    tracker = DirtyTileTracker()
+    match = lambda: VisionEngine._advanced_match(cache, frame, 0.9, None, True, False, 0.6, 'template', tracker)
+    assert match()[0] is None
+    frame[400:580, 0:20] = target[:, :20]
+    box, score = match()
+    assert box is not None and (box.left, box.top, box.width, box.height) == (0, 400, 180, 180) and score > 0.95
@@ -0,0 +1,172 @@
+"""
+Qflow 视觉引擎基准测试（可在无显示器的 Linux 上运行）
+
+生成 1080p / 4K / 多显示器尺寸的合成截图，在已知位置按已知缩放比例植入目标图标，
+分别计时 locate（经回放截图源）、_advanced_match、_feature_match_akaze 与静止检测，
+输出延迟分位数、命中率和峰值内存的 JSON，用于对比两次提交的性能。
+
+用法:
+    python vision_benchmark.py -o before.json
+    python vision_benchmark.py -o after.json --compare before.json
+    python vision_benchmark.py --quick            # 仅 1080p、每项 3 次
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from main import VisionEngine, StaticDetector, SETTINGS
+
+SIZES = {'1080p': (1920, 1080), '4k': (3840, 2160), 'multi': (5760, 1080)}
+STRATEGIES = ['template', 'pyramid', 'feature', 'hybrid']
+PLANT_SCALES = [0.8, 1.0, 1.2]
+NEEDLE_SIZE = 64
+
+def make_needle(seed=7):
+    """合成一个有纹理、有文字的图标作为目标图"""
+    rng = np.random.default_rng(seed); n = NEEDLE_SIZE
+    img = np.zeros((n, n, 3), np.uint8); img[:] = (40, 90, 200)
+    cv2.circle(img, (n // 2, n // 2), n // 3, (250, 250, 250), -1)
+    cv2.rectangle(img, (6, 6), (n // 2, n // 4), (20, 180, 60), -1)
+    cv2.putText(img, 'Qf', (n // 4, n * 3 // 4), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (200, 30, 30), 2, cv2.LINE_AA)
+    img[rng.random((n, n)) < 0.03] = 0
+    return img
+
+def make_haystack(size, needle, scale, seed=0):
+    """合成类似桌面 UI 的背景（色块、边框、文字），在随机位置植入缩放后的目标，返回 (RGB 数组, 植入框)"""
+    w, h = size; rng = np.random.default_rng(seed)
+    img = np.full((h, w, 3), 235, np.uint8)
+    for _ in range(w * h // 20000):
+        x, y = int(rng.integers(0, w)), int(rng.integers(0, h)); bw, bh = int(rng.integers(20, 300)), int(rng.integers(12, 120))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(img, (x, y), (x + bw, y + bh), color, -1 if rng.random() < 0.6 else 1)
+    for _ in range(w * h // 8000):
+        x, y = int(rng.integers(0, w)), int(rng.integers(10, h))
+        text = ''.join(chr(int(c)) for c in rng.integers(65, 91, int(rng.integers(3, 12))))
+        cv2.putText(img, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, float(rng.uniform(0.3, 0.7)), (30, 30, 30), 1, cv2.LINE_AA)
+    tw, th = round(NEEDLE_SIZE * scale), round(NEEDLE_SIZE * scale)
+    planted = cv2.resize(needle, (tw, th), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    x, y = int(rng.integers(0, w - tw)), int(rng.integers(0, h - th))
+    img[y:y + th, x:x + tw] = planted
+    return img, (x, y, tw, th)
+
+def is_hit(box, truth):
+    """命中判定：返回框中心与植入框中心在两个方向上的偏差都不超过植入框宽/高的 1/4"""
+    if not box: return False
+    cx, cy = box[0] + box[2] / 2, box[1] + box[3] / 2
+    tx, ty = truth[0] + truth[2] / 2, truth[1] + truth[3] / 2
+    return abs(cx - tx) <= truth[2] / 4 and abs(cy - ty) <= truth[3] / 4
+
+def measure(fn, repeat, truth=None):
+    """先预热一次，再计时 repeat 次；最后单独开 tracemalloc 跑一次记录峰值内存（不影响计时）"""
+    fn()
+    times, hits = [], 0
+    for _ in range(repeat):
+        t0 = time.perf_counter(); box = fn(); times.append((time.perf_counter() - t0) * 1000)
+        if truth is not None and is_hit(box, truth): hits += 1
+    tracemalloc.start(); fn(); peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    t = np.array(times)
+    stats = {'runs': repeat, 'mean_ms': float(t.mean()), 'min_ms': float(t.min()), 'max_ms': float(t.max()),
+             'p50_ms': float(np.percentile(t, 50)), 'p90_ms': float(np.percentile(t, 90)), 'p99_ms': float(np.percentile(t, 99)),
+             'peak_mem_mb': peak / 2**20}
+    if truth is not None: stats['hit_rate'] = hits / repeat
+    return stats
+
+def bench_matching(sizes, strategies, confidences, repeat, replay_dir):
+    results = []; needle = make_needle()
+    cache = VisionEngine.prepare_needle(Image.fromarray(needle), strategy='template')
+    for size_name in sizes:
+        for i, scale in enumerate(PLANT_SCALES):
+            hay, truth = make_haystack(SIZES[size_name], needle, scale, seed=list(SIZES).index(size_name) * 10 + i)
+            frame_dir = os.path.join(replay_dir, f'{size_name}_{scale}'); os.makedirs(frame_dir, exist_ok=True)
+            Image.fromarray(hay).save(os.path.join(frame_dir, '000.png'))
+            case = {'size': size_name, 'resolution': list(SIZES[size_name]), 'plant_scale': scale, 'truth': list(truth)}
+            for strategy in strategies:
+                for multiscale in (True, False):
+                    for conf in confidences:
+                        params = dict(case, strategy=strategy, multiscale=multiscale, confidence=conf)
+                        am = lambda: VisionEngine._advanced_match(cache, hay, conf, None, True, multiscale, 1.0, strategy)[0]
+                        results.append(dict(params, func='_advanced_match', **measure(am, repeat, truth)))
+                        SETTINGS.update(capture_backend='replay', capture_source=frame_dir, capture_max_age=0)
+                        w, h = SIZES[size_name]
+                        lc = lambda: VisionEngine.locate(cache, confidence=conf, multiscale=multiscale, strategy=strategy, region=(0, 0, w, h))
+                        results.append(dict(params, func='locate', **measure(lc, repeat, truth)))
+                        print(f"  {size_name:6s} s={scale} {strategy:8s} ms={int(multiscale)} c={conf}: "
+                              f"{results[-2]['p50_ms']:8.1f} / {results[-1]['p50_ms']:8.1f} ms  hit={results[-2]['hit_rate']:.0%}", flush=True)
+            gray = cv2.cvtColor(hay, cv2.COLOR_RGB2GRAY)
+            ak = lambda: VisionEngine._feature_match_akaze(cache, gray)[0]
+            results.append(dict(case, func='_feature_match_akaze', **measure(ak, repeat, truth)))
+    return results
+
+def bench_static(sizes, repeat):
+    """静止检测：两帧只差一个小色块；分别计时 compare_images（每次新建）与复用缓冲的 StaticDetector（不同降采样倍数）"""
+    results = []; needle = make_needle()
+    for size_name in sizes:
+        a, _ = make_haystack(SIZES[size_name], needle, 1.0, seed=1); b = a.copy(); b[100:140, 100:180] = 0
+        pa, pb = Image.fromarray(a), Image.fromarray(b)
+        results.append(dict(size=size_name, func='compare_images', **measure(lambda: VisionEngine.compare_images(pa, pb, 0.98), repeat)))
+        for ds in (1, 2, 4):
+            det = StaticDetector(0.98, ds); det.reset(a)
+            results.append(dict(size=size_name, func='StaticDetector.check', downsample=ds, **measure(lambda: det.check(b), repeat)))
+    return results
+
+def compare(current, baseline_path):
+    """按相同参数配对两次结果，打印 p50 变化"""
+    with open(baseline_path, encoding='utf-8') as f: base = json.load(f)
+    ident = lambda r: tuple((k, str(v)) for k, v in sorted(r.items()) if not k.endswith(('_ms', '_mb', '_rate')) and k not in ('runs', 'truth'))
+    index = {ident(r): r for r in base['results']}
+    print(f"\n对比基线 {baseline_path} ({base['meta'].get('commit', '?')[:10]})")
+    for r in current['results']:
+        if (old := index.get(ident(r))) is None: continue
+        delta = (r['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0.0
+        label = ' '.join(f"{k}={v}" for k, v in ident(r) if k not in ('resolution',))
+        extra = f"  hit {old['hit_rate']:.0%}->{r['hit_rate']:.0%}" if 'hit_rate' in r and 'hit_rate' in old else ''
+        print(f"  {label}\n      p50 {old['p50_ms']:.1f} -> {r['p50_ms']:.1f} ms ({delta:+.1f}%){extra}")
+
+def git_commit():
+    try: return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception: return ''
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description='Qflow 视觉引擎基准测试')
+    ap.add_argument('--sizes', default='1080p,4k,multi', help='截图尺寸: ' + ','.join(SIZES))
+    ap.add_argument('--strategies', default=','.join(STRATEGIES))
+    ap.add_argument('--confidence', default='0.8,0.9', help='逗号分隔的相似度阈值')
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--threads', type=int, default=1, help="SETTINGS['match_threads']")
+    ap.add_argument('--quick', action='store_true', help='仅 1080p、每项 3 次')
+    ap.add_argument('-o', '--output', default='vision_benchmark.json')
+    ap.add_argument('--compare', help='与之前输出的 JSON 对比')
+    args = ap.parse_args(argv)
+    sizes = ['1080p'] if args.quick else [s for s in args.sizes.split(',') if s in SIZES]
+    repeat = 3 if args.quick else max(1, args.repeat)
+    strategies = [s for s in args.strategies.split(',') if s in STRATEGIES]
+    confidences = [float(c) for c in args.confidence.split(',')]
+    SETTINGS['match_threads'] = args.threads
+
+    started = time.time()
+    with tempfile.TemporaryDirectory(prefix='qflow_bench_') as replay_dir:
+        results = bench_matching(sizes, strategies, confidences, repeat, replay_dir) + bench_static(sizes, repeat)
+    out = {'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                    'opencv': cv2.__version__, 'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                    'match_threads': args.threads, 'repeat': repeat, 'duration_s': round(time.time() - started, 1),
+                    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10) if resource else None},
+           'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f: json.dump(out, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已写入 {args.output}（{len(results)} 项，耗时 {out['meta']['duration_s']}s）")
+    if args.compare: compare(out, args.compare)
+
+if __name__ == '__main__': main_cli()